@@ -0,0 +1,639 @@
+import argparse
+import concurrent.futures
+import math
+import os
+import re
+import sys
+import time
+import typing
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "oscilloscope"))
+from compressor_remote import BAUD_RATE, BITS_PER_PACKET
+from wav_file import WavWriter
+
+
+# Model of the remote control path: the FSK modulator (comfilter/packetgen.c),
+# the filter unit (comfilter/filter_unit.vhdl, running the microcode in
+# filter_unit_microcode_store.vhdl) and the receiver (com_receiver.vhdl).
+# Each is bit-exact, and works on many bursts at once (one row per burst).
+# The filter has no headroom: at the full level of packetgen.c (0 dB), the
+# 22 kHz filter overshoots 16 bits when the frequency changes, and its
+# registers wrap around as they do in the hardware. The envelope is then
+# briefly wrong, so a few codes (e.g. 0xffca) are lost even without noise.
+# From -0.5 dB down, the filter does not overflow and no codes are lost.
+
+# These should match comfilter/packetgen.c
+UPPER_FREQUENCY = 22000.0
+LOWER_FREQUENCY = 21000.0
+SAMPLE_RATE = 48000
+DATA_BITS = 16
+CRC_BITS = 16
+CRC_POLYNOMIAL = 0x8005
+SAMPLES_PER_BIT = int(SAMPLE_RATE / BAUD_RATE)
+LEADIN_SAMPLES = SAMPLE_RATE // 10
+LEADOUT_SAMPLES = SAMPLE_RATE // 10
+FADE_SAMPLES = LEADOUT_SAMPLES // 10
+AMPLITUDE = 32767 - 1
+
+# These should match comfilter/filter_unit_settings.vhdl and filter_unit.vhdl
+FRACTIONAL_BITS = 14
+ALL_BITS = 16
+A_BITS = 30
+MICROCODE_FILE_NAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "..", "comfilter", "filter_unit_microcode_store.vhdl")
+
+# Registers selected by the multiplexer (filter_unit.vhdl): 10 to 13 are all ones
+ZERO = 0
+R = 1
+Y = 2
+O1 = 3
+O2 = 4
+X = 5
+L = 6
+I0 = 7
+I1 = 8
+I2 = 9
+BANK_SWITCH = 14
+L_OR_X = 15
+NUM_BANKS = 2
+# Inputs of the X register
+PASSTHROUGH_REG_OUT = 0
+PASSTHROUGH_X = 1
+NEGATE_REG_OUT = 2
+# Coefficients of each bank: products of these registers are added to R
+COEFFICIENT_REGISTERS = [I0, I2, O1, O2, L]
+
+# Control lines, by the low 5 bits of the microcode (filter_unit_control_line_decoder.vhdl)
+ADD_A_TO_R = "ADD_A_TO_R"
+LOAD_I0_FROM_INPUT = "LOAD_I0_FROM_INPUT"
+RESTART = "RESTART"
+SEND_Y_TO_OUTPUT = "SEND_Y_TO_OUTPUT"
+SET_X_IN_TO_ABS_O1_REG_OUT = "SET_X_IN_TO_ABS_O1_REG_OUT"
+SET_X_IN_TO_REG_OUT = "SET_X_IN_TO_REG_OUT"
+SET_X_IN_TO_X_AND_CLEAR_Y_BORROW = "SET_X_IN_TO_X_AND_CLEAR_Y_BORROW"
+SHIFT_I0_RIGHT = "SHIFT_I0_RIGHT"
+SHIFT_I1_RIGHT = "SHIFT_I1_RIGHT"
+SHIFT_I2_RIGHT = "SHIFT_I2_RIGHT"
+SHIFT_L_RIGHT = "SHIFT_L_RIGHT"
+SHIFT_O1_RIGHT = "SHIFT_O1_RIGHT"
+SHIFT_O2_RIGHT = "SHIFT_O2_RIGHT"
+SHIFT_R_RIGHT = "SHIFT_R_RIGHT"
+SHIFT_X_RIGHT = "SHIFT_X_RIGHT"
+SHIFT_Y_RIGHT = "SHIFT_Y_RIGHT"
+CONTROL_LINES: typing.List[typing.FrozenSet[str]] = [frozenset(lines) for lines in [
+    [],
+    [LOAD_I0_FROM_INPUT],
+    [SHIFT_I0_RIGHT],
+    [ADD_A_TO_R],
+    [SHIFT_I2_RIGHT],
+    [ADD_A_TO_R, SHIFT_I2_RIGHT],
+    [SHIFT_O1_RIGHT],
+    [ADD_A_TO_R, SHIFT_O1_RIGHT],
+    [SHIFT_O2_RIGHT],
+    [ADD_A_TO_R, SHIFT_O2_RIGHT],
+    [SHIFT_O1_RIGHT, SHIFT_O2_RIGHT],
+    [SHIFT_R_RIGHT],
+    [SHIFT_O1_RIGHT, SHIFT_R_RIGHT],
+    [SHIFT_L_RIGHT],
+    [SHIFT_L_RIGHT, SHIFT_R_RIGHT],
+    [SET_X_IN_TO_ABS_O1_REG_OUT],
+    [SHIFT_O1_RIGHT, SHIFT_X_RIGHT],
+    [SET_X_IN_TO_X_AND_CLEAR_Y_BORROW],
+    [SHIFT_L_RIGHT, SHIFT_X_RIGHT, SHIFT_Y_RIGHT],
+    [SHIFT_L_RIGHT, SHIFT_X_RIGHT],
+    [SET_X_IN_TO_REG_OUT],
+    [SEND_Y_TO_OUTPUT],
+    [SHIFT_I1_RIGHT, SHIFT_I2_RIGHT],
+    [SHIFT_I0_RIGHT, SHIFT_I1_RIGHT],
+]] + [frozenset([RESTART])] * 8
+
+# These should match comfilter/com_receiver.vhdl: the serial input is
+# sampled at 16 times the baud rate (every 10 audio samples)
+TICK_SAMPLES = int(SAMPLE_RATE / (BAUD_RATE * 16.0))
+STABLE_TIME_IN_BITS = 15
+COUNTER_MASK = (1 << 9) - 1
+ZERO_SIGNAL = 0
+ONE_SIGNAL = 1
+READY = 2
+START_BIT = 3
+DATA_BIT = 4
+CRC_BIT = 5
+STOP_BIT = 6
+
+
+def build_packet_bits(data: numpy.ndarray) -> numpy.ndarray:
+    # As packetgen_build_bits: the bits of each packet, sent from bit 0:
+    # a start bit (0), the data, the CRC (bit-reversed) and a stop bit (1)
+    data = numpy.asarray(data, dtype=numpy.int64) & ((1 << DATA_BITS) - 1)
+    crc = numpy.zeros_like(data)
+    for i in range(DATA_BITS):
+        bit_flag = ((data >> i) ^ (crc >> (CRC_BITS - 1))) & 1
+        crc = ((crc << 1) & 0xffff) ^ (bit_flag * CRC_POLYNOMIAL)
+    packet = data.copy()
+    for i in range(CRC_BITS):
+        packet |= ((crc >> i) & 1) << (DATA_BITS + CRC_BITS - 1 - i)
+    packet |= 1 << (DATA_BITS + CRC_BITS)
+    return packet << 1
+
+def get_num_samples(num_codes: int) -> int:
+    return LEADIN_SAMPLES + (num_codes * BITS_PER_PACKET * SAMPLES_PER_BIT) + LEADOUT_SAMPLES
+
+def get_bit_levels(codes: numpy.ndarray) -> numpy.ndarray:
+    # The bit sent during each sample of each burst (one row of codes per burst):
+    # 1 for the lead-in and lead-out, then each packet from bit 0
+    codes = numpy.atleast_2d(codes)
+    packets = build_packet_bits(codes)
+    bits = (packets[:, :, numpy.newaxis] >> numpy.arange(BITS_PER_PACKET)) & 1
+    bits = numpy.repeat(bits.reshape(len(codes), -1), SAMPLES_PER_BIT, axis=1)
+    ones = numpy.ones((len(codes), LEADIN_SAMPLES), dtype=bits.dtype)
+    return numpy.hstack((ones, bits, ones[:, :LEADOUT_SAMPLES])).astype(bool)
+
+def modulate(codes: numpy.ndarray) -> numpy.ndarray:
+    # As packetgen_build_samples, for one channel: the samples of each burst.
+    # The oscillator is computed in single precision, as in C, one sample at
+    # a time for all bursts. Until the first sample where the bursts differ
+    # (at least the lead-in), the oscillator is the same for all of them.
+    levels = get_bit_levels(codes)
+    (num_bursts, num_samples) = levels.shape
+    f32 = numpy.float32
+    pi2 = f32(math.pi * 2.0)
+    upper_delta = f32(float(pi2 / f32(SAMPLE_RATE)) * UPPER_FREQUENCY)
+    lower_delta = f32(float(pi2 / f32(SAMPLE_RATE)) * LOWER_FREQUENCY)
+    deltas = numpy.where(numpy.ascontiguousarray(levels.T), upper_delta, lower_delta).astype(numpy.float32)
+    different = numpy.flatnonzero((levels != levels[:1]).any(axis=0))
+    shared = int(different[0]) if len(different) != 0 else num_samples
+    angles = numpy.zeros((num_samples, num_bursts), dtype=numpy.float32)
+    wrapped = numpy.zeros(num_bursts, dtype=bool)
+    for i in range(1, num_samples):
+        if i == shared + 1:
+            angles[:i, 1:] = angles[:i, :1]
+        width = 1 if i <= shared else num_bursts
+        angle = angles[i, :width]
+        numpy.add(angles[i - 1, :width], deltas[i - 1, :width], out=angle)
+        numpy.greater(angle, pi2, out=wrapped[:width])
+        numpy.subtract(angle, pi2, out=angle, where=wrapped[:width])
+    if shared + 1 >= num_samples:
+        angles[:, 1:] = angles[:, :1]
+
+    # sin in double precision, rounded to single precision, matches sinf
+    # in glibc (the single precision sin in NumPy sometimes differs in the
+    # last bit). C adds 0.5 in double precision, but v + 0.5 is exact in
+    # single precision for |v| < 2 ** 15.
+    half = f32(0.5)
+    values = numpy.sin(angles.astype(numpy.float64)).astype(numpy.float32) * f32(AMPLITUDE)
+    output = numpy.floor(values + half)
+
+    # Fade in the lead-out: the last sample is multiplied by 0 / FADE_SAMPLES,
+    # the one before by 1 / FADE_SAMPLES, and so on
+    scale = numpy.arange(FADE_SAMPLES - 1, -1, -1, dtype=numpy.float32)[:, numpy.newaxis]
+    faded = (output[-FADE_SAMPLES:] * scale) / f32(FADE_SAMPLES)
+    output[-FADE_SAMPLES:] = numpy.floor(faded + half)
+    return output.T.astype(numpy.int16)
+
+def load_microcode(file_name: str = MICROCODE_FILE_NAME) -> typing.List[int]:
+    # The contents of the ROM (SB_RAM512x8): each INIT_n holds 32 bytes,
+    # with the first at the right
+    with open(file_name, "rt") as fd:
+        text = fd.read()
+    rom: typing.List[int] = []
+    for i in range(16):
+        match = re.search(r'INIT_{:X}\s*=>\s*X"([0-9A-Fa-f]{{64}})"'.format(i), text)
+        if match is None:
+            raise ValueError("INIT_{:X} not found in {}".format(i, file_name))
+        rom.extend(reversed(bytes.fromhex(match.group(1))))
+    return rom
+
+def get_filter_coefficients(rom: typing.List[int]) -> numpy.ndarray:
+    # The microcode multiplies by shifting a register into the top of A, then
+    # shifting A right (extending the sign) and adding A to R at selected
+    # steps. A starts at zero, so the sum is the register value times a
+    # constant, modulo 2 ** A_BITS, and the result is taken from the top
+    # ALL_BITS of R. This returns the constants for each bank (rows) and
+    # each register in COEFFICIENT_REGISTERS (columns), as fixed-point
+    # values with A_BITS - ALL_BITS fractional bits.
+    coefficients = numpy.zeros((NUM_BANKS, len(COEFFICIENT_REGISTERS)), dtype=numpy.int64)
+    bank = 0
+    source = ZERO
+    shifts = 0
+    for code in rom:
+        if code == 0xff:
+            break
+        if (code & 0xc0) == 0x80:
+            source = code & 0xf
+            shifts = 0
+            if source == BANK_SWITCH:
+                bank ^= 1
+            continue
+        if code & 0x80:
+            continue                # debug
+        repeat = ALL_BITS if code & 0x40 else 1
+        for _ in range(repeat):
+            if (ADD_A_TO_R in CONTROL_LINES[code & 0x1f]) and (source in COEFFICIENT_REGISTERS):
+                coefficients[bank, COEFFICIENT_REGISTERS.index(source)] += 1 << (A_BITS - shifts)
+            if code & 0x20:
+                shifts += 1
+    return wrap(coefficients, A_BITS)
+
+def wrap(value: numpy.ndarray, bits: int = ALL_BITS) -> numpy.ndarray:
+    # Two's complement wrap-around to the given number of bits
+    half = 1 << (bits - 1)
+    return ((value + half) & ((1 << bits) - 1)) - half
+
+class FilterModel:
+    # The filter unit, for many bursts at once. For each bank, a biquad filter
+    # (y = (c0.x[n] + c2.x[n-2] + c3.y[n-1] + c4.y[n-2]) / 2 ** FRACTIONAL_BITS)
+    # is followed by an envelope detector which decays (L = c.L / 2 **
+    # FRACTIONAL_BITS) and follows the peaks of |y|. The output bit is set when
+    # the envelope for bank 0 exceeds the envelope for bank 1. All registers are
+    # int16, so that NumPy wraps around as the hardware does. The sums of
+    # products are int32 if they cannot overflow, which is faster than int64.
+    def __init__(self, coefficients: numpy.ndarray, num_bursts: int,
+                chunk_size: int = 1024) -> None:
+        limit = int(numpy.abs(coefficients).sum(axis=1).max()) << (ALL_BITS - 1)
+        self.dtype = numpy.int32 if limit < (1 << 31) else numpy.int64
+        self.coefficients: numpy.ndarray = coefficients.astype(self.dtype)
+        self.chunk_size = chunk_size
+        shape = (NUM_BANKS, num_bursts)
+        self.inputs = numpy.zeros((2, num_bursts), dtype=numpy.int16)     # x[n-2], x[n-1]
+        self.o1 = numpy.zeros(shape, dtype=numpy.int16)
+        self.o2 = numpy.zeros(shape, dtype=numpy.int16)
+        self.l = numpy.zeros(shape, dtype=numpy.int16)
+
+    def process(self, samples: numpy.ndarray) -> numpy.ndarray:
+        # Bits sent to the receiver, for each burst (rows) and sample (columns)
+        (c0, c2, c3, c4, cl) = [self.coefficients[:, i:i + 1] for i in range(5)]
+        samples = numpy.asarray(samples).astype(numpy.int16).T
+        output = numpy.zeros(samples.shape, dtype=bool)
+        shift = A_BITS - ALL_BITS
+        (o1, o2, l) = (self.o1, self.o2, self.l)
+        for start in range(0, len(samples), self.chunk_size):
+            # The inputs do not depend on the outputs, so their products
+            # are found for a chunk of samples at once
+            inputs = numpy.concatenate((self.inputs, samples[start:start + self.chunk_size]))
+            self.inputs = inputs[-2:]
+            inputs = inputs[:, numpy.newaxis, :].astype(self.dtype)
+            feed_forward = (c0 * inputs[2:]) + (c2 * inputs[:-2])
+            for (n, f) in enumerate(feed_forward, start):
+                y = ((f + (c3 * o1) + (c4 * o2)) >> shift).astype(numpy.int16)
+                l = ((cl * l) >> shift).astype(numpy.int16)
+                x = numpy.abs(y)
+                l = numpy.where((x - l) < 0, l, x)
+                output[n] = (l[1] - l[0]) < 0
+                (o2, o1) = (o1, y)
+        (self.o1, self.o2, self.l) = (o1, o2, l)
+        return output.T
+
+class MicrocodeFilter:
+    # The filter unit as a literal interpreter of the microcode, one bit at a time
+    # (very slow): used to check FilterModel
+    def __init__(self, rom: typing.List[int]) -> None:
+        self.rom = rom
+        self.reg = {r: 0 for r in (R, Y, X, I0, I1, I2)}
+        self.banked = {r: [0] * NUM_BANKS for r in (O1, O2, L)}
+        self.a = 0
+        self.bank = 0
+        self.mux_register = 0
+        self.x_select = PASSTHROUGH_REG_OUT
+        self.x_borrow = 0
+        self.y_borrow = 0
+
+    def get(self, r: int) -> int:
+        return self.banked[r][self.bank] if r in self.banked else self.reg[r]
+
+    def shift(self, r: int, bit: int) -> None:
+        value = (self.get(r) >> 1) | (bit << (ALL_BITS - 1))
+        if r in self.banked:
+            self.banked[r][self.bank] = value
+        else:
+            self.reg[r] = value
+
+    @staticmethod
+    def borrow(x_in: int, y_in: int, b: int) -> int:
+        if y_in and b:
+            return 1
+        if y_in or b:
+            return 1 - x_in
+        return 0
+
+    def step(self, code: int, sample: int) -> typing.Optional[int]:
+        # Execute one cycle: the result is the output bit, if sent
+        mux = self.mux_register
+        reg_out = 1
+        if mux == ZERO:
+            reg_out = 0
+        elif mux <= I2:
+            reg_out = self.get(mux) & 1
+        if code & 0x80:
+            if not (code & 0x40):
+                self.mux_register = code & 0xf
+                if self.mux_register == BANK_SWITCH:
+                    self.bank ^= 1
+                elif self.mux_register == L_OR_X:
+                    self.mux_register = L if (self.reg[Y] >> (ALL_BITS - 1)) else X
+            return None
+
+        lines = CONTROL_LINES[code & 0x1f]
+        x_out = self.reg[X] & 1
+        negated = reg_out ^ self.x_borrow
+        x_in = [reg_out, x_out, negated][self.x_select]
+        y_in = x_out ^ reg_out ^ self.y_borrow
+        output = None
+        if SHIFT_X_RIGHT in lines:
+            self.x_borrow = self.borrow(0, reg_out, self.x_borrow)
+        if SET_X_IN_TO_ABS_O1_REG_OUT in lines:
+            self.x_borrow = 0
+        if SHIFT_Y_RIGHT in lines:
+            self.y_borrow = self.borrow(x_out, reg_out, self.y_borrow)
+        if SET_X_IN_TO_X_AND_CLEAR_Y_BORROW in lines:
+            self.y_borrow = 0
+        if SEND_Y_TO_OUTPUT in lines:
+            output = self.reg[Y] >> (ALL_BITS - 1)
+
+        a = self.a
+        if code & 0x20:
+            self.a = (a >> 1) | (reg_out << (A_BITS - 1))
+        if ADD_A_TO_R in lines:
+            self.reg[R] = (self.reg[R] + a) & ((1 << A_BITS) - 1)
+        elif SHIFT_R_RIGHT in lines:
+            self.reg[R] >>= 1
+        if LOAD_I0_FROM_INPUT in lines:
+            self.reg[I0] = sample & 0xffff
+        for (line, r, bit) in ((SHIFT_I0_RIGHT, I0, reg_out), (SHIFT_I1_RIGHT, I1, reg_out),
+                               (SHIFT_I2_RIGHT, I2, reg_out), (SHIFT_O1_RIGHT, O1, reg_out),
+                               (SHIFT_O2_RIGHT, O2, reg_out), (SHIFT_L_RIGHT, L, reg_out),
+                               (SHIFT_X_RIGHT, X, x_in), (SHIFT_Y_RIGHT, Y, y_in)):
+            if line in lines:
+                self.shift(r, bit)
+
+        if SET_X_IN_TO_REG_OUT in lines:
+            self.x_select = PASSTHROUGH_REG_OUT
+        elif SET_X_IN_TO_ABS_O1_REG_OUT in lines:
+            negative = self.get(O1) >> (ALL_BITS - 1)
+            self.x_select = NEGATE_REG_OUT if negative else PASSTHROUGH_REG_OUT
+        elif SET_X_IN_TO_X_AND_CLEAR_Y_BORROW in lines:
+            self.x_select = PASSTHROUGH_X
+        return output
+
+    def process(self, samples: numpy.ndarray) -> numpy.ndarray:
+        # Run the microcode once for each sample, from address 0 to RESTART
+        output = numpy.zeros(len(samples), dtype=bool)
+        for (n, sample) in enumerate(samples.tolist()):
+            address = 0
+            while True:
+                code = self.rom[address]
+                lines = CONTROL_LINES[code & 0x1f] if not (code & 0x80) else frozenset()
+                if RESTART in lines:
+                    break
+                repeat = ALL_BITS if (code & 0xc0) == 0x40 else 1
+                for _ in range(repeat):
+                    bit = self.step(code, sample)
+                    if bit is not None:
+                        output[n] = bool(bit)
+                address += 1
+        return output
+
+class ComReceiver:
+    # The receiver, for many bursts at once: the serial signal is sampled
+    # every TICK_SAMPLES samples, and a packet is accepted if its CRC is
+    # valid and the stop bit is 1. The phase of the ticks (0 to
+    # TICK_SAMPLES - 1) can differ for each burst. The whole signal of each
+    # burst is processed at once.
+    def __init__(self, phase: numpy.ndarray) -> None:
+        num_bursts = len(phase)
+        self.phase = numpy.asarray(phase, dtype=numpy.int64)
+        self.state = numpy.full(num_bursts, ZERO_SIGNAL, dtype=numpy.int8)
+        self.counter = numpy.zeros(num_bursts, dtype=numpy.int64)
+        self.crc = numpy.zeros(num_bursts, dtype=numpy.int64)
+        self.data = numpy.zeros(num_bursts, dtype=numpy.int64)
+        self.serial = numpy.zeros(num_bursts, dtype=bool)      # serial_in_copy
+
+    def process(self, serial: numpy.ndarray) -> typing.List[typing.List[int]]:
+        # The codes received from each burst. Each tick takes the filter output
+        # for the previous sample, and the state machine sees the value from
+        # the previous tick.
+        (num_bursts, num_samples) = serial.shape
+        received: typing.List[typing.List[int]] = [[] for _ in range(num_bursts)]
+        rows = numpy.arange(num_bursts)
+        previous = numpy.hstack((numpy.ones((num_bursts, 1), dtype=bool), serial))
+        state = self.state
+        counter = self.counter
+        first_tick = (TICK_SAMPLES - 1 - self.phase) % TICK_SAMPLES
+        for tick in range(0, num_samples + TICK_SAMPLES, TICK_SAMPLES):
+            n = first_tick + tick
+            active = n < num_samples
+            if not active.any():
+                break
+            old = self.serial
+            new = numpy.where(active, previous[rows, numpy.minimum(n, num_samples)], old)
+            reached_8 = (counter & 7) == 7
+            reached_16 = (counter & 15) == 15
+            is_state = [active & (state == s) for s in range(STOP_BIT + 1)]
+
+            # CRC and data bits are captured from the new value
+            capture = (is_state[DATA_BIT] | is_state[CRC_BIT]) & reached_16
+            apply_bit = ((self.crc >> (CRC_BITS - 1)) ^ new) & 1
+            self.crc = numpy.where(capture,
+                    ((self.crc << 1) & 0xffff) ^ (apply_bit * CRC_POLYNOMIAL), self.crc)
+            capture_data = is_state[DATA_BIT] & reached_16
+            self.data = numpy.where(capture_data,
+                    (self.data >> 1) | (new.astype(numpy.int64) << (DATA_BITS - 1)), self.data)
+            accept = is_state[STOP_BIT] & reached_16 & old & (self.crc == 0)
+            for i in numpy.flatnonzero(accept).tolist():
+                received[i].append(int(self.data[i]))
+
+            next_state = state.copy()
+            next_counter = numpy.where(active, (counter + 1) & COUNTER_MASK, counter)
+            next_state[is_state[ZERO_SIGNAL] & old] = ONE_SIGNAL
+            next_state[is_state[ONE_SIGNAL] & ~old] = ZERO_SIGNAL
+            next_state[is_state[ONE_SIGNAL] & old & ((counter >> 4) == STABLE_TIME_IN_BITS)] = READY
+            next_state[is_state[READY] & ~old] = START_BIT
+            next_state[is_state[START_BIT] & reached_8] = numpy.where(old, ZERO_SIGNAL, DATA_BIT)[
+                    is_state[START_BIT] & reached_8]
+            next_state[is_state[DATA_BIT] & reached_16 & ((counter >> 4) == DATA_BITS - 1)] = CRC_BIT
+            next_state[is_state[CRC_BIT] & reached_16 & ((counter >> 4) == CRC_BITS - 1)] = STOP_BIT
+            next_state[is_state[STOP_BIT] & reached_16] = numpy.where(old, READY, ZERO_SIGNAL)[
+                    is_state[STOP_BIT] & reached_16]
+            reset_counter = (is_state[ZERO_SIGNAL] | is_state[READY]
+                    | (is_state[START_BIT] & reached_8 & ~old)
+                    | (next_state != state) & (is_state[DATA_BIT] | is_state[CRC_BIT]))
+            next_counter[reset_counter] = 0
+            self.crc[is_state[READY]] = 0
+
+            state = next_state
+            counter = next_counter
+            self.serial = new
+
+        self.state = state
+        self.counter = counter
+        return received
+
+class ErrorCounts:
+    def __init__(self) -> None:
+        self.bursts = 0
+        self.bad_bursts = 0     # bursts where the codes received differ from the codes sent
+        self.codes = 0
+        self.missed = 0         # codes sent but not received
+        self.wrong = 0          # codes received but not sent
+
+    def add(self, sent: numpy.ndarray, received: typing.List[typing.List[int]]) -> None:
+        for (codes, got) in zip(sent.tolist(), received):
+            remaining = list(got)
+            for code in codes:
+                if code in remaining:
+                    remaining.remove(code)
+                else:
+                    self.missed += 1
+            self.wrong += len(remaining)
+            self.codes += len(codes)
+            self.bursts += 1
+            if codes != got:
+                self.bad_bursts += 1
+
+    def merge(self, other: "ErrorCounts") -> None:
+        self.bursts += other.bursts
+        self.bad_bursts += other.bad_bursts
+        self.codes += other.codes
+        self.missed += other.missed
+        self.wrong += other.wrong
+
+def add_noise(signal: numpy.ndarray, level: float, noise: typing.Optional[float],
+            rng: numpy.random.Generator) -> numpy.ndarray:
+    # Scale the signal by level (dB) and add white noise with an RMS level of
+    # noise (dB relative to full scale), as 16-bit samples. Single precision
+    # is plenty for the noise, and twice as fast.
+    f32 = numpy.float32
+    output = signal.astype(f32) * f32(10.0 ** (level / 20.0))
+    if noise is not None:
+        gaussian = rng.standard_normal(signal.shape, dtype=f32)
+        gaussian *= f32(32767.0 * (10.0 ** (noise / 20.0)))
+        output += gaussian
+    output += f32(0.5)
+    return numpy.clip(numpy.floor(output, out=output), -32768, 32767, out=output).astype(numpy.int16)
+
+class Batch:
+    # Bursts processed together by one worker process, with their own random
+    # numbers, so that the results do not depend on the number of workers
+    def __init__(self, coefficients: numpy.ndarray, num_bursts: int, num_codes: int,
+                level: float, noise: typing.Optional[float], seed: numpy.random.SeedSequence,
+                codes: typing.Optional[typing.List[int]]) -> None:
+        self.coefficients = coefficients
+        self.num_bursts = num_bursts
+        self.num_codes = num_codes
+        self.level = level
+        self.noise = noise
+        self.seed = seed
+        self.codes = codes
+
+def run_batch(batch: Batch) -> ErrorCounts:
+    # Send bursts of random codes (or the given codes) through the model
+    rng = numpy.random.default_rng(batch.seed)
+    if batch.codes is not None:
+        sent = numpy.tile(numpy.array(batch.codes, dtype=numpy.int64), (batch.num_bursts, 1))
+    else:
+        sent = rng.integers(0, 1 << DATA_BITS, (batch.num_bursts, batch.num_codes))
+    signal = add_noise(modulate(sent), batch.level, batch.noise, rng)
+    serial = FilterModel(batch.coefficients, batch.num_bursts).process(signal)
+    receiver = ComReceiver(rng.integers(0, TICK_SAMPLES, batch.num_bursts))
+    counts = ErrorCounts()
+    counts.add(sent, receiver.process(serial))
+    return counts
+
+def measure_errors(coefficients: numpy.ndarray, num_bursts: int, num_codes: int,
+            level: float, noise: typing.Optional[float], batch_size: int,
+            seed: numpy.random.SeedSequence,
+            codes: typing.Optional[typing.List[int]] = None,
+            executor: typing.Optional[concurrent.futures.Executor] = None) -> ErrorCounts:
+    sizes = [min(batch_size, num_bursts - start) for start in range(0, num_bursts, batch_size)]
+    batches = [Batch(coefficients, size, num_codes, level, noise, batch_seed, codes)
+               for (size, batch_seed) in zip(sizes, seed.spawn(len(sizes)))]
+    counts = ErrorCounts()
+    for batch_counts in (executor.map(run_batch, batches) if executor is not None
+                         else map(run_batch, batches)):
+        counts.merge(batch_counts)
+    return counts
+
+def check_model(rom: typing.List[int], coefficients: numpy.ndarray, signal: numpy.ndarray) -> bool:
+    # Compare FilterModel with the microcode interpreter for one signal
+    expect = MicrocodeFilter(rom).process(signal)
+    got = FilterModel(coefficients, 1).process(signal[numpy.newaxis, :])[0]
+    different = numpy.flatnonzero(expect != got)
+    if len(different) != 0:
+        print("check: FilterModel differs from the microcode at sample {} ({} samples)".format(
+            different[0], len(different)))
+        return False
+    print("check: FilterModel matches the microcode for {} samples".format(len(signal)))
+    return True
+
+def parse_code(text: str) -> int:
+    value = int(text, 0)
+    if not (0 <= value < (1 << DATA_BITS)):
+        raise argparse.ArgumentTypeError("code must be 16 bits")
+    return value
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Model the remote control path (FSK modulator, filter unit and receiver)")
+    parser.add_argument("--bursts", "-n", type=int, default=1000,
+        help="number of bursts to send (default 1000)")
+    parser.add_argument("--codes", type=int, default=1,
+        help="number of random codes in each burst (default 1)")
+    parser.add_argument("--code", type=parse_code, nargs="+",
+        help="send these codes in each burst, instead of random codes")
+    parser.add_argument("--level", type=float, nargs="+", default=[0.0],
+        help="signal levels to try (dB, default 0: the level from packetgen.c)")
+    parser.add_argument("--noise", type=float, nargs="+",
+        help="noise levels to try (RMS, dB relative to full scale, default: no noise)")
+    parser.add_argument("--batch", type=int, default=1024,
+        help="bursts processed at a time (default 1024)")
+    parser.add_argument("--seed", type=int, default=1,
+        help="random seed (default 1)")
+    parser.add_argument("--jobs", "-j", type=int,
+        help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--check", type=int, default=0, metavar="SAMPLES",
+        help="check the filter model against the microcode, for this many "
+            "samples of the first burst (slow)")
+    parser.add_argument("--wav", metavar="output.wav",
+        help="write the first burst (without noise) to a WAV file, "
+            "as played by the Windows program (com)")
+    args = parser.parse_args()
+
+    seed = numpy.random.SeedSequence(args.seed)
+    rom = load_microcode()
+    coefficients = get_filter_coefficients(rom)
+    num_codes = len(args.code) if args.code is not None else args.codes
+    noises: typing.List[typing.Optional[float]] = list(args.noise) if args.noise else [None]
+
+    if args.wav is not None:
+        first = numpy.array(args.code if args.code is not None else [0], dtype=numpy.int64)
+        signal = modulate(first)[0]
+        with WavWriter(args.wav, 2, SAMPLE_RATE) as wav:
+            wav.write(numpy.column_stack((signal, signal)))
+        print("{}: {} samples".format(args.wav, len(signal)))
+
+    if args.check > 0:
+        first = numpy.array(args.code if args.code is not None else [0x1234], dtype=numpy.int64)
+        signal = add_noise(modulate(first), args.level[0], noises[0],
+                           numpy.random.default_rng(seed.spawn(1)[0]))[0, :args.check]
+        if not check_model(rom, coefficients, signal):
+            sys.exit(1)
+
+    print("{} bursts of {} codes ({:1.3f} s each)".format(args.bursts, num_codes,
+            get_num_samples(num_codes) / SAMPLE_RATE))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        print("level (dB)  noise (dB)  bad bursts  missed codes  wrong codes  code error rate  bursts/s")
+        for level in args.level:
+            for noise in noises:
+                start_time = time.monotonic()
+                counts = measure_errors(coefficients, args.bursts, num_codes, level, noise,
+                                        args.batch, seed.spawn(1)[0], args.code, executor)
+                elapsed = time.monotonic() - start_time
+                print("{:10.1f}  {:>10}  {:10d}  {:12d}  {:11d}  {:15.6f}  {:8.0f}".format(
+                    level, "none" if noise is None else "{:1.1f}".format(noise),
+                    counts.bad_bursts, counts.missed, counts.wrong,
+                    (counts.missed + counts.wrong) / max(1, counts.codes),
+                    counts.bursts / elapsed if elapsed > 0.0 else 0.0), flush=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+
+import argparse
+import concurrent.futures
+import contextlib
+import itertools
+import json
+import math
+import os
+import sys
+import time
+import typing
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "oscilloscope"))
+from compressor_remote import SET_ADJUST_1, SET_ADJUST_2, set_adjust
+from wav_file import WavWriter, get_24_bit_samples, load_wav_file
+
+
+# Model of compressor.vhdl, as used by compressor_main.vhdl. The results are
+# bit-exact: the peak level is a 24-bit fixed-point value, with 1.0 at bit 23,
+# and the 15-bit audio magnitude is compared with bits 22..8. The volume is
+# an 11-bit fixed-point value, with 1.0 at bit 10.
+PEAK_BITS = 24
+FIXED_POINT = 1
+PEAK_AUDIO_LOW = 8
+PEAK_AUDIO_MASK = 0x7fff
+PEAK_LOW_BITS = (1 << PEAK_AUDIO_LOW) - 1
+VOLUME_ONE = 1 << 10
+ADJUST_MASK = VOLUME_ONE - 1
+MUL_MASK = (1 << 25) - 1        # the multiplier result, without its top bit
+TOP_SHIFT = 13                  # the multiplier result is shifted to the top of the dividend
+OVER_MASK = 0xf << 15           # divider result bits which must be zero
+DEFAULT_WINDOW_SIZE = 1 << 20   # frames processed at a time
+
+# Modes (mode_definitions.vhdl) which pass the audio through the compressor
+COMPRESS_MAX = 0
+COMPRESS_2 = 1
+COMPRESS_1 = 2
+ATTENUATE_2 = 3
+COMPRESS_VIDEO = 4
+MODE_NAMES = {"CX": COMPRESS_MAX, "C2": COMPRESS_2, "C1": COMPRESS_1,
+              "A2": ATTENUATE_2, "CV": COMPRESS_VIDEO}
+
+class CompressorGenerics:
+    # Generics of the compressor entity: the defaults are used by compressor_main
+    def __init__(self, max_amplification: float = 21.1, sample_rate: int = 48000,
+                decay_rate: float = 1.0, delay1_size_log_2: int = 8,
+                num_delays: int = 31) -> None:
+        self.max_amplification = max_amplification
+        self.sample_rate = sample_rate
+        self.decay_rate = decay_rate
+        self.delay1_size_log_2 = delay1_size_log_2
+        self.num_delays = num_delays
+
+    @staticmethod
+    def convert_to_bits(amplitude: float) -> int:
+        # VHDL conversion of a Real to a Natural rounds to the nearest integer
+        return int(math.floor((amplitude * (1 << (PEAK_BITS - FIXED_POINT))) + 0.5))
+
+    @property
+    def peak_divisor(self) -> int:
+        # The peak level is divided by this for each left sample
+        return self.convert_to_bits(10.0 ** (self.decay_rate / 10.0 / self.sample_rate))
+
+    @property
+    def peak_minimum(self) -> int:
+        return self.convert_to_bits(10.0 ** (- self.max_amplification / 10.0))
+
+    @property
+    def peak_maximum(self) -> int:
+        return self.convert_to_bits(1.0) - 1
+
+    def delay_size(self, bypass: bool) -> int:
+        # Entries (samples) in the delay: each delay1 holds 2 ** delay1_size_log_2,
+        # but only one when bypassed, which applies to all except the first
+        size = 1 << self.delay1_size_log_2
+        if bypass:
+            return size + self.num_delays - 1
+        return size * self.num_delays
+
+def adjust_value(command: int, decibels: float) -> int:
+    # The adjust setting sent by compressor_remote.py (10 bits)
+    codes: typing.List[int] = []
+    set_adjust(codes, command, decibels)
+    return codes[0] & ADJUST_MASK
+
+class ModeControls:
+    # The compressor inputs chosen by compressor_main.vhdl for a mode
+    def __init__(self, mode: int, adjust_1: int, adjust_2: int) -> None:
+        if mode not in MODE_NAMES.values():
+            raise ValueError("Mode {} does not use the compressor".format(mode))
+        self.compressor_enable = mode != ATTENUATE_2
+        self.delay_bypass = mode in (ATTENUATE_2, COMPRESS_VIDEO)
+        if mode == COMPRESS_1:
+            self.volume = adjust_1 & ADJUST_MASK
+        elif mode in (ATTENUATE_2, COMPRESS_2, COMPRESS_VIDEO):
+            self.volume = adjust_2 & ADJUST_MASK
+        else:
+            self.volume = VOLUME_ONE
+
+def to_sign_magnitude(data: numpy.ndarray) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    # As convert_to_sign_magnitude: -32768 becomes magnitude 0x7fff
+    data = data.astype(numpy.int32)
+    return (data < 0, numpy.minimum(numpy.abs(data), PEAK_AUDIO_MASK))
+
+class CompressorOutput:
+    def __init__(self, data: numpy.ndarray, peak_level: numpy.ndarray, over_errors: int) -> None:
+        self.data = data                # output frames (left, right), 16-bit
+        self.peak_level = peak_level    # peak_level used for each output sample
+        self.over_errors = over_errors  # divider results too large for the output
+
+class Compressor:
+    # The compressor from synchronisation onwards. Samples pass through the delay
+    # (a FIFO shared by both channels) and the peak level is clamped to each
+    # sample as it enters and leaves, so the volume is reduced before a loud
+    # sample is output. The peak level decays for each left output, unless
+    # it is at the minimum (maximum amplification). When the compressor is
+    # disabled, the peak level is held at the maximum (1.0).
+    #
+    # The left sample which synchronises the compressor arrives in reset and is
+    # not stored, so the delay begins with the following right sample, and
+    # outputs are labelled left, right, left... from the first, as in
+    # compressor.vhdl.
+    def __init__(self, controls: ModeControls,
+                generics: typing.Optional[CompressorGenerics] = None) -> None:
+        self.generics = generics if generics is not None else CompressorGenerics()
+        self.controls = controls
+        self.delay_size = self.generics.delay_size(controls.delay_bypass)
+        self.minimum = self.generics.peak_minimum >> PEAK_AUDIO_LOW
+        self.peak_divisor = self.generics.peak_divisor
+        self.pending = numpy.zeros(0, dtype=numpy.int16)    # samples in the delay
+        self.synchronised = False
+
+        # Peak level register (reset value), minimum_flag, peak_divider_done and
+        # the peak level for the most recent left output (the peak division input)
+        self.peak_level = (self.minimum << PEAK_AUDIO_LOW) | PEAK_LOW_BITS
+        self.minimum_flag = True
+        self.peak_divider_done = False
+        self.left_peak_level = 0
+
+    def process(self, frames: numpy.ndarray) -> CompressorOutput:
+        # Input frames (left, right), 16-bit: the first frame given synchronises the
+        # compressor. Outputs are produced once the delay is full, as whole frames:
+        # samples for an incomplete frame are kept in the delay until the next call.
+        samples = numpy.asarray(frames, dtype=numpy.int16).reshape(-1)
+        if not self.synchronised:
+            samples = samples[1:]
+            self.synchronised = True
+        stored = numpy.concatenate((self.pending, samples))
+        num_events = max(0, len(stored) - self.delay_size) & ~1
+        (negative, fifo_out) = to_sign_magnitude(stored[:num_events])
+        (_, audio_in) = to_sign_magnitude(stored[self.delay_size:self.delay_size + num_events])
+        self.pending = stored[num_events:]
+
+        # Clamping to the input and then to the FIFO output is the same
+        # as a single clamp to the larger of the two
+        if self.controls.compressor_enable:
+            peak_level = self.peak_envelope(numpy.maximum(audio_in, fifo_out))
+        else:
+            peak_level = numpy.full(num_events, self.generics.peak_maximum, dtype=numpy.int64)
+
+        # Multiply by the volume, then divide by the peak level
+        mul = (fifo_out.astype(numpy.int64) * self.controls.volume) & MUL_MASK
+        result = (mul << TOP_SHIFT) // peak_level
+        over_errors = int(numpy.count_nonzero(result & OVER_MASK))
+        magnitude = (result & PEAK_AUDIO_MASK).astype(numpy.int32)
+        data = numpy.where(negative, -magnitude, magnitude).astype(numpy.int16)
+        return CompressorOutput(data.reshape(-1, 2), peak_level.reshape(-1, 2), over_errors)
+
+    def peak_envelope(self, clamp: numpy.ndarray) -> numpy.ndarray:
+        # The peak level for each output (left, right, left...) when the compressor
+        # is enabled, given the larger of the input and FIFO output magnitudes.
+        # Each step depends on the previous one, so this is a loop: the peak
+        # level is held below 1.0 (bit 23 is never set) so that bits 22..8
+        # are simply peak_level >> 8.
+        minimum = self.minimum
+        minimum_level = (minimum << PEAK_AUDIO_LOW) | PEAK_LOW_BITS
+        peak_divisor = self.peak_divisor
+        shift = PEAK_BITS - FIXED_POINT
+        peak_level = self.peak_level
+        minimum_flag = self.minimum_flag
+        peak_divider_done = self.peak_divider_done
+        left_peak_level = self.left_peak_level
+        output: typing.List[int] = []
+        append = output.append
+        clamp_list = clamp.tolist()
+        for (left, right) in zip(clamp_list[0::2], clamp_list[1::2]):
+            # Before the left output, the result of the peak division started
+            # for the previous left output is loaded (discarding any clamp for the
+            # right output), unless the peak level is at the minimum
+            if peak_divider_done and not minimum_flag:
+                peak_level = (left_peak_level << shift) // peak_divisor
+            if (peak_level >> PEAK_AUDIO_LOW) <= left:
+                peak_level = (left << PEAK_AUDIO_LOW) | PEAK_LOW_BITS
+                minimum_flag = False
+            if (peak_level >> PEAK_AUDIO_LOW) <= minimum:
+                peak_level = minimum_level
+                minimum_flag = True
+            left_peak_level = peak_level
+            peak_divider_done = True
+            append(peak_level)
+
+            if (peak_level >> PEAK_AUDIO_LOW) <= right:
+                peak_level = (right << PEAK_AUDIO_LOW) | PEAK_LOW_BITS
+                minimum_flag = False
+            if (peak_level >> PEAK_AUDIO_LOW) <= minimum:
+                peak_level = minimum_level
+                minimum_flag = True
+            append(peak_level)
+
+        self.peak_level = peak_level
+        self.minimum_flag = minimum_flag
+        self.peak_divider_done = peak_divider_done
+        self.left_peak_level = left_peak_level
+        return numpy.array(output, dtype=numpy.int64)
+
+class LevelMeter:
+    # Peak and RMS level of 16-bit frames, accumulated over windows
+    def __init__(self) -> None:
+        self.peak = 0
+        self.sum_squares = 0.0
+        self.count = 0
+
+    def add(self, data: numpy.ndarray) -> None:
+        if data.size != 0:
+            data = data.astype(numpy.float64)
+            self.peak = max(self.peak, int(numpy.abs(data).max()))
+            self.sum_squares += float(numpy.square(data).sum())
+            self.count += data.size
+
+    def rms_decibels(self) -> typing.Optional[float]:
+        if self.sum_squares == 0.0:
+            return None
+        return 10.0 * math.log10(self.sum_squares / self.count / float(1 << 30))
+
+def get_16_bit_frames(samples: numpy.ndarray) -> numpy.ndarray:
+    # The compressor input is the upper 16 bits of the 24-bit audio
+    return (get_24_bit_samples(samples) >> 8).astype(numpy.uint16).view(numpy.int16)
+
+def compress_wav_file(wav_file_name: str, controls: ModeControls,
+            output_file_name: typing.Optional[str] = None,
+            generics: typing.Optional[CompressorGenerics] = None,
+            window_size: int = DEFAULT_WINDOW_SIZE) -> typing.Dict[str, typing.Any]:
+    # Compress a 2-channel WAV file one window at a time, optionally writing
+    # the output as a 16-bit WAV file. The result is a summary of the levels.
+    start_time = time.perf_counter()
+    (samples, wav_format) = load_wav_file(wav_file_name)
+    if wav_format.channels != 2:
+        raise ValueError("WAV file must have 2 channels")
+
+    compressor = Compressor(controls, generics)
+    input_meter = LevelMeter()
+    output_meter = LevelMeter()
+    over_errors = 0
+    num_output_frames = 0
+    with contextlib.ExitStack() as stack:
+        writer: typing.Optional[WavWriter] = None
+        if output_file_name is not None:
+            writer = stack.enter_context(WavWriter(output_file_name, 2, wav_format.sample_rate))
+        for window_start in range(0, wav_format.num_frames, window_size):
+            frames = get_16_bit_frames(samples[window_start:window_start + window_size])
+            output = compressor.process(frames)
+            input_meter.add(frames)
+            output_meter.add(output.data)
+            over_errors += output.over_errors
+            num_output_frames += len(output.data)
+            if writer is not None:
+                writer.write(output.data)
+
+    seconds = time.perf_counter() - start_time
+    return {"input_frames": wav_format.num_frames,
+            "output_frames": num_output_frames,
+            "sample_rate": wav_format.sample_rate,
+            "input_peak": input_meter.peak,
+            "input_rms_db": input_meter.rms_decibels(),
+            "output_peak": output_meter.peak,
+            "output_rms_db": output_meter.rms_decibels(),
+            "over_errors": over_errors,
+            "seconds": seconds,
+            "speed": (wav_format.num_frames / wav_format.sample_rate / seconds
+                      if wav_format.sample_rate != 0 and seconds > 0.0 else None)}
+
+class Job:
+    # One WAV file with one mode and adjust setting (in decibels, as for compressor_remote.py)
+    def __init__(self, wav_file_name: str, mode_name: str,
+                adjust_1: typing.Optional[float], adjust_2: typing.Optional[float],
+                output_dir: typing.Optional[str]) -> None:
+        self.wav_file_name = wav_file_name
+        self.mode_name = mode_name
+        self.adjust_1 = adjust_1
+        self.adjust_2 = adjust_2
+        self.output_dir = output_dir
+
+    @property
+    def output_file_name(self) -> typing.Optional[str]:
+        if self.output_dir is None:
+            return None
+        name = os.path.splitext(os.path.basename(self.wav_file_name))[0] + "_" + self.mode_name
+        for adjust in (self.adjust_1, self.adjust_2):
+            if adjust is not None:
+                name += "_{:g}dB".format(adjust)
+        return os.path.join(self.output_dir, name + ".wav")
+
+def run_job(job: Job) -> typing.Dict[str, typing.Any]:
+    # Run one job in a worker process: the result is a summary
+    summary: typing.Dict[str, typing.Any] = {"file": job.wav_file_name, "mode": job.mode_name}
+    try:
+        adjust_1 = adjust_value(SET_ADJUST_1, job.adjust_1 if job.adjust_1 is not None else 0.0)
+        adjust_2 = adjust_value(SET_ADJUST_2, job.adjust_2 if job.adjust_2 is not None else 0.0)
+        controls = ModeControls(MODE_NAMES[job.mode_name], adjust_1, adjust_2)
+        summary["adjust_1"] = job.adjust_1
+        summary["adjust_2"] = job.adjust_2
+        summary["volume"] = controls.volume
+        output_file_name = job.output_file_name
+        if output_file_name is not None:
+            summary["output"] = output_file_name
+        summary.update(compress_wav_file(job.wav_file_name, controls, output_file_name))
+    except Exception as e:
+        summary["error"] = "{}: {}".format(type(e).__name__, e)
+    return summary
+
+def make_jobs(wav_file_names: typing.List[str], mode_names: typing.List[str],
+            adjust_1: typing.List[float], adjust_2: typing.List[float],
+            output_dir: typing.Optional[str]) -> typing.List[Job]:
+    # Every combination of file, mode and the adjust settings used by the mode
+    jobs: typing.List[Job] = []
+    for (wav_file_name, mode_name) in itertools.product(wav_file_names, mode_names):
+        mode = MODE_NAMES[mode_name]
+        adjust_1_sweep: typing.List[typing.Optional[float]] = [None]
+        adjust_2_sweep: typing.List[typing.Optional[float]] = [None]
+        if mode == COMPRESS_1:
+            adjust_1_sweep = list(adjust_1)
+        elif mode in (ATTENUATE_2, COMPRESS_2, COMPRESS_VIDEO):
+            adjust_2_sweep = list(adjust_2)
+        for (a1, a2) in itertools.product(adjust_1_sweep, adjust_2_sweep):
+            jobs.append(Job(wav_file_name, mode_name, a1, a2, output_dir))
+    return jobs
+
+def find_wav_files(paths: typing.List[str]) -> typing.List[str]:
+    file_names: typing.List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            for (root, _, names) in os.walk(path):
+                for name in names:
+                    if os.path.splitext(name)[1].lower() == ".wav":
+                        file_names.append(os.path.join(root, name))
+        else:
+            file_names.append(path)
+
+    return sorted(file_names)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Model the FPGA compressor (compressor.vhdl) for 2-channel WAV files")
+    parser.add_argument("inputs", nargs="+", metavar="input.wav",
+        help="WAV files and directories containing them")
+    parser.add_argument("--mode", "-m", action="append", choices=sorted(MODE_NAMES),
+        help="compressor mode, as on the rotary control (may be repeated, default CX)")
+    parser.add_argument("--adjust-1", type=float, nargs="+", default=[0.0],
+        help="volume for C1 mode (decibels, must be <= 0.0): "
+            "several values are a sweep", metavar="LEVEL")
+    parser.add_argument("--adjust-2", type=float, nargs="+", default=[0.0],
+        help="volume for C2, A2, CV modes (decibels, must be <= 0.0): "
+            "several values are a sweep", metavar="LEVEL")
+    parser.add_argument("--output-dir", metavar="DIR",
+        help="write the output of each run to a 16-bit WAV file in DIR")
+    parser.add_argument("--jobs", "-j", type=int,
+        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--summary", metavar="FILE",
+        help="write the summary to FILE instead of standard output")
+    args = parser.parse_args()
+
+    jobs = make_jobs(find_wav_files(args.inputs), args.mode or ["CX"],
+                     args.adjust_1, args.adjust_2, args.output_dir)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    all_ok = True
+    with contextlib.ExitStack() as stack:
+        fd = sys.stdout
+        if args.summary is not None:
+            fd = stack.enter_context(open(args.summary, "wt"))
+
+        # One JSON line per run, in the order of the jobs
+        executor = stack.enter_context(
+            concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs))
+        for summary in executor.map(run_job, jobs):
+            fd.write(json.dumps(summary) + "\n")
+            fd.flush()
+            all_ok = all_ok and ("error" not in summary) and (summary["over_errors"] == 0)
+
+    if not all_ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+
+import hashlib
+import json
+import os
+import typing
+
+
+# Generated files are only rewritten when their content changes, so that
+# their timestamps (and the results of analysis and synthesis) are kept.
+# The cache records the hash of the inputs used to generate each file and
+# the hash of its content: if the inputs are unchanged and the file has not
+# been modified, the file is reused without generating it again.
+CACHE_FILE_NAME = "cache.json"
+READ_SIZE = 1 << 20
+
+
+def hash_file(file_name: str) -> str:
+    h = hashlib.sha256()
+    with open(file_name, "rb") as fd:
+        block = fd.read(READ_SIZE)
+        while len(block) != 0:
+            h.update(block)
+            block = fd.read(READ_SIZE)
+    return h.hexdigest()
+
+def hash_inputs(file_names: typing.Iterable[str], *values: object) -> str:
+    # Hash of the contents of the input files, and other inputs (e.g. options)
+    h = hashlib.sha256()
+    for file_name in file_names:
+        h.update("{}\n{}\n".format(file_name, hash_file(file_name)).encode("utf-8"))
+    for value in values:
+        h.update("{!r}\n".format(value).encode("utf-8"))
+    return h.hexdigest()
+
+class GeneratedCache:
+    def __init__(self, output_dir: str) -> None:
+        self.cache_file_name = os.path.join(output_dir, CACHE_FILE_NAME)
+        self.entries: typing.Dict[str, typing.Dict[str, str]] = {}
+        try:
+            with open(self.cache_file_name, "rt") as fd:
+                self.entries = json.load(fd)
+        except (OSError, ValueError):
+            pass
+
+    def is_current(self, file_name: str, input_hash: str) -> bool:
+        # True if the file was generated from the same inputs and has not changed since
+        entry = self.entries.get(file_name)
+        return ((entry is not None) and (entry.get("inputs") == input_hash)
+                and os.path.isfile(file_name) and (entry.get("content") == hash_file(file_name)))
+
+    def reuse(self, file_names: typing.List[str], input_hash: str) -> bool:
+        # True (and report it) if all of the files are current
+        if not all(self.is_current(file_name, input_hash) for file_name in file_names):
+            return False
+        for file_name in file_names:
+            print("{}: reused".format(file_name))
+        return True
+
+    def write(self, file_name: str, content: str, input_hash: str) -> None:
+        # Write the file, unless it already has this content
+        # (newlines are converted as for a file opened in text mode)
+        data = content.replace("\n", os.linesep).encode("utf-8")
+        content_hash = hashlib.sha256(data).hexdigest()
+        if os.path.isfile(file_name) and (hash_file(file_name) == content_hash):
+            print("{}: unchanged".format(file_name))
+        else:
+            with open(file_name, "wb") as fd:
+                fd.write(data)
+            print("{}: written".format(file_name))
+
+        self.entries[file_name] = {"inputs": input_hash, "content": content_hash}
+        with open(self.cache_file_name, "wt") as fd:
+            json.dump(self.entries, fd, indent=4)
@@ -1,6 +1,8 @@
 
+import io
 import sys
 import typing
+from generated_cache import GeneratedCache, hash_inputs
 
 
 PAYLOAD = [
@@ -46,7 +48,13 @@ def generate(index: int) -> typing.Tuple[int, int]:
     return (left, right)
 
 def main() -> None:
-    with open("app/generated/match_rom.vhdl", "wt") as fd:
+    file_name = "app/generated/match_rom.vhdl"
+    cache = GeneratedCache("app/generated")
+    input_hash = hash_inputs([__file__])
+    if cache.reuse([file_name], input_hash):
+        return
+
+    with io.StringIO() as fd:
         fd.write("""
 library ieee;
 use ieee.std_logic_1164.all;
@@ -78,6 +86,7 @@ begin
     end process;
 end structural;
 """)
+        cache.write(file_name, fd.getvalue(), input_hash)
 
 if __name__ == "__main__":
     main()
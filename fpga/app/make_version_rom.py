@@ -1,5 +1,7 @@
 
 import subprocess
+import sys
+from generated_cache import GeneratedCache, hash_inputs
 
 
 def main() -> None:
@@ -9,9 +11,18 @@ def main() -> None:
     git_hash = git_hash.strip()
     if (p.wait() == 0) and len(git_hash) != 0:
         bits = int(git_hash[:8], 16)
-                     
-    with open("app/generated/version_rom.vhdl", "wt") as fd:
-        fd.write("""
+    else:
+        git_hash = ""
+        print("warning: git rev-parse HEAD failed: version ROM is {:08x}".format(bits),
+              file=sys.stderr)
+
+    file_name = "app/generated/version_rom.vhdl"
+    cache = GeneratedCache("app/generated")
+    input_hash = hash_inputs([__file__], git_hash)
+    if cache.reuse([file_name], input_hash):
+        return
+
+    cache.write(file_name, """
 library ieee;
 use ieee.std_logic_1164.all;
 
@@ -26,8 +37,7 @@ begin
     -- bits:
 data_out <= "{:032b}";
 end architecture structural;
-""".format(git_hash, bits, bits))
+""".format(git_hash, bits, bits), input_hash)
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,226 @@
+
+import argparse
+import os
+import sys
+import typing
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "oscilloscope"))
+from make_match_rom import generate, REPEAT_SIZE, TRUE_MARKER_POSITION
+from wav_file import get_24_bit_samples, load_wav_file
+
+
+# Model of matcher.vhdl: the ROM is read from address 0 (the marker frame)
+# onwards, alternating left and right. The match levels are numbered as
+# in sync_out: the lowest level seen since synchronisation is reported.
+RESET = 0
+ROUND_16 = 1
+EXACT_16 = 2
+EXACT_24 = 3
+MATCH_NAMES = {RESET: "RESET", ROUND_16: "ROUND_16", EXACT_16: "EXACT_16", EXACT_24: "EXACT_24"}
+ROM_SIZE = REPEAT_SIZE * 2
+SEARCH_SIZE = 1 << 12           # events searched at a time for a synchronised run
+FIRST_WINDOW_SIZE = ROM_SIZE << 6       # events checked at a time in a synchronised
+MAX_WINDOW_SIZE = ROM_SIZE << 14        # run (doubling): multiples of ROM_SIZE
+
+
+def get_match_rom() -> numpy.ndarray:
+    # The contents of match_rom.vhdl, as written by make_match_rom.py
+    rom = numpy.zeros(ROM_SIZE, dtype=numpy.int32)
+    for i in range(REPEAT_SIZE):
+        (rom[i << 1], rom[(i << 1) | 1]) = generate((i + TRUE_MARKER_POSITION) % REPEAT_SIZE)
+    return rom
+
+def match_assessment(a_in: numpy.ndarray, b_in: numpy.ndarray) -> numpy.ndarray:
+    # As match_assessment in matcher.vhdl, for a previous match of RESET:
+    # the result for other previous matches is the lower of the two levels.
+    # The difference of the upper 16 bits, plus 1, is 0, 1 or 2 for a match.
+    d = (((a_in >> 8) - (b_in >> 8)) + 1) & 0xffff
+    level = numpy.where(d == 1, EXACT_16, ROUND_16).astype(numpy.int8)
+    level[(d == 1) & ((a_in & 0xff) == (b_in & 0xff))] = EXACT_24
+    level[d > 2] = RESET
+    return level
+
+def interleave(left: numpy.ndarray, right: numpy.ndarray) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    # Convert left and right samples (24-bit, e.g. from AudioData) to the
+    # sequence of strobes seen by the matcher: (data, is_left) for each
+    data = numpy.column_stack((left, right)).flatten().astype(numpy.int32)
+    is_left = numpy.zeros(len(data), dtype=bool)
+    is_left[0::2] = True
+    return (data, is_left)
+
+class MatcherOutput:
+    # The outputs of the matcher after each strobe
+    def __init__(self, num_events: int) -> None:
+        self.sync = numpy.zeros(num_events, dtype=numpy.int8)           # sync_out
+        self.sample_rate = numpy.zeros(num_events, dtype=numpy.int32)   # sample_rate_out
+
+class OutputChanges:
+    # Outputs are recorded only when they are set, then expanded by to_array
+    def __init__(self) -> None:
+        self.events: typing.List[numpy.ndarray] = []
+        self.values: typing.List[numpy.ndarray] = []
+
+    def add(self, events: numpy.ndarray, values: numpy.ndarray) -> None:
+        self.events.append(events)
+        self.values.append(values)
+
+    def to_array(self, num_events: int, dtype: typing.Any) -> numpy.ndarray:
+        # Each output holds the most recent value set (initially 0)
+        events = numpy.concatenate([numpy.zeros(1, dtype=numpy.int64)] + self.events)
+        values = numpy.concatenate([numpy.zeros(1, dtype=dtype)] + self.values)
+        order = numpy.argsort(events, kind="stable")
+        (events, values) = (events[order], values[order])
+        return numpy.repeat(values, numpy.diff(events, append=num_events)).astype(dtype)
+
+def model_matcher(data: numpy.ndarray, is_left: numpy.ndarray,
+            sync: typing.Optional[numpy.ndarray] = None) -> MatcherOutput:
+    # Outputs of the matcher for a sequence of strobes: data is the audio_in value
+    # (24 bits) at each strobe, is_left is set for left_strobe_in (otherwise
+    # right_strobe_in), and sync is sync_in (default: always 1).
+    #
+    # The matcher is synchronised from the first left sample after a reset, which
+    # gives the sample rate (address 0). Then each sample must match the ROM
+    # (at least ROUND_16), alternating left and right, until a sample fails
+    # and the matcher is reset again. Each synchronised run is checked as a
+    # whole by check_run. Runs which fail at the second sample (the usual case
+    # when the input is not the test pattern) are found SEARCH_SIZE events at
+    # a time, and followed without NumPy.
+    num_events = len(data)
+    data = numpy.asarray(data, dtype=numpy.int32)
+    is_left = numpy.asarray(is_left, dtype=bool)
+    if sync is None:
+        sync = numpy.ones(num_events, dtype=bool)
+    sync = numpy.asarray(sync, dtype=bool)
+    rom = get_match_rom()
+    sync_changes = OutputChanges()
+    rate_changes = OutputChanges()
+    failures: typing.List[int] = []
+
+    position = 0
+    while position < num_events:
+        # Left samples in the reset state (right samples leave it unchanged).
+        # The following sample must be the marker at address 1, or the run
+        # fails immediately.
+        end = min(position + SEARCH_SIZE, num_events)
+        lefts = numpy.flatnonzero(is_left[position:end]) + position
+        after = numpy.minimum(lefts + 1, num_events - 1)
+        good_start = (sync[lefts] & (lefts + 1 < num_events) & ~is_left[after] & sync[after]
+                      & (match_assessment(data[after], rom[1]) != RESET))
+
+        starts: typing.List[int] = []
+        good_start_list = good_start.tolist()
+        sync_list = sync[lefts].tolist()
+        run_start = None
+        for (i, start) in enumerate(lefts.tolist()):
+            if start < position:
+                continue
+            starts.append(start)
+            if not sync_list[i]:
+                failures.append(start)
+                position = start + 1
+            elif not good_start_list[i]:
+                failures.append(start + 1)
+                position = start + 2
+            else:
+                run_start = start
+                break
+
+        rate_changes.add(numpy.array(starts, dtype=numpy.int64), data[starts] >> 8)
+        if run_start is not None:
+            failure = check_run(data, is_left, sync, rom, run_start, sync_changes, rate_changes)
+            failures.append(failure)
+            position = failure + 1
+        else:
+            position = max(position, end)
+
+    failure_events = numpy.array([f for f in failures if f < num_events], dtype=numpy.int64)
+    sync_changes.add(failure_events, numpy.full(len(failure_events), RESET, dtype=numpy.int8))
+    output = MatcherOutput(num_events)
+    output.sync = sync_changes.to_array(num_events, numpy.int8)
+    output.sample_rate = rate_changes.to_array(num_events, numpy.int32)
+    return output
+
+def check_run(data: numpy.ndarray, is_left: numpy.ndarray, sync: numpy.ndarray,
+            rom: numpy.ndarray, start: int, sync_changes: OutputChanges,
+            rate_changes: OutputChanges) -> int:
+    # Follow a synchronised run beginning with the left sample at start (address 0),
+    # recording the outputs. The result is the event that fails (and resets
+    # the matcher), or the number of events if the run continues to the end.
+    # Events are checked in windows which begin at address 0.
+    num_events = len(data)
+    current_match = EXACT_24        # the level reported once something has matched
+    window_start = start
+    window_size = FIRST_WINDOW_SIZE
+    while window_start < num_events:
+        size = min(window_size, num_events - window_start)
+        window = slice(window_start, window_start + size)
+        address = numpy.tile(numpy.arange(ROM_SIZE), window_size // ROM_SIZE)[:size]
+        is_first = address == 0
+        m = match_assessment(data[window], numpy.tile(rom, window_size // ROM_SIZE)[:size])
+        m[is_first] = EXACT_24
+        fail = (is_left[window] != ((address & 1) == 0)) | ~sync[window] | (m == RESET)
+        if window_start == start:
+            fail[0] = False     # checked by model_matcher
+        failures = numpy.flatnonzero(fail)
+        end = int(failures[0]) if len(failures) != 0 else size
+
+        # Matching samples: the left sample at address 0 gives the sample rate
+        # (and is not compared), and the match is reported after each right
+        # sample at the final address. A left sample at address 0 sets the
+        # sample rate even if sync_in resets the matcher.
+        first = numpy.flatnonzero(is_first[:end + 1] & is_left[window][:end + 1]) + window_start
+        if window_start == start:
+            first = first[1:]   # recorded by model_matcher
+        rate_changes.add(first, data[first] >> 8)
+        last = numpy.flatnonzero(address[:end] == (ROM_SIZE - 1))
+        if len(last) != 0:
+            level = numpy.minimum.accumulate(m[:last[-1] + 1])
+            level = numpy.minimum(level[last], current_match)
+            sync_changes.add(last + window_start, level)
+            current_match = int(level[-1])
+
+        if end < size:
+            return window_start + end
+        current_match = min(current_match, int(m.min()))
+        window_start += size
+        window_size = min(window_size * 2, MAX_WINDOW_SIZE)
+
+    return num_events
+
+def describe_changes(output: MatcherOutput, is_left: numpy.ndarray,
+            sample_rate_scale: int = 100) -> typing.List[str]:
+    # Report changes of sync_out (by frame), as in the test_top_level test bench
+    frames = numpy.cumsum(is_left) - 1
+    changes = numpy.flatnonzero(numpy.diff(output.sync, prepend=RESET) != 0)
+    text: typing.List[str] = []
+    for index in changes.tolist():
+        sync = int(output.sync[index])
+        if sync == RESET:
+            text.append("frame {}: matcher desynchronised".format(frames[index]))
+        else:
+            text.append("frame {}: matcher synchronised, {} (sync_out = {:02b}), "
+                        "sample rate = {}".format(frames[index], MATCH_NAMES[sync], sync,
+                        output.sample_rate[index] * sample_rate_scale))
+    return text
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Model the FPGA matcher (matcher.vhdl) for a 2-channel WAV file")
+    parser.add_argument("wav_file", metavar="input.wav")
+    args = parser.parse_args()
+
+    (samples, wav_format) = load_wav_file(args.wav_file)
+    if wav_format.channels != 2:
+        parser.error("WAV file must have 2 channels")
+    samples = get_24_bit_samples(samples)
+    (data, is_left) = interleave(samples[:, 0], samples[:, 1])
+    output = model_matcher(data, is_left)
+    for line in describe_changes(output, is_left):
+        print(line)
+    print("{} frames: final sync_out = {:02b} ({})".format(wav_format.num_frames,
+            output.sync[-1] if len(output.sync) != 0 else RESET,
+            MATCH_NAMES[int(output.sync[-1]) if len(output.sync) != 0 else RESET]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import socket, argparse, typing, time
+from compressor_remote import (UDP_PORT, SET_ADJUST_1, SET_ADJUST_2, COMMAND_MASK, MODE_NAMES,
+                               decode_message, describe_code, get_air_time)
+
+# Stands in for the Windows program (com/com.cpp) and the device: receives
+# the UDP messages sent by compressor_remote.py, decodes the codes in the same
+# way, and applies them to a model of the registers set by com_rot and the
+# ADC driver in app/compressor_main.vhdl. With --realtime, each message takes
+# as long as it would to play as sound, like the real receiver.
+
+class DeviceState:
+    def __init__(self) -> None:
+        self.remote_mode: typing.Optional[int] = None      # None: set by the rotary switch
+        self.preemph = 0
+        self.adjust_1: typing.Optional[int] = None         # None: read from the ADC
+        self.adjust_2: typing.Optional[int] = None
+        self.errors_cleared = 0
+
+    def apply(self, code: int) -> None:
+        command = code & COMMAND_MASK
+        if command == SET_ADJUST_1:
+            self.adjust_1 = code & 0x3ff
+        elif command == SET_ADJUST_2:
+            self.adjust_2 = code & 0x3ff
+        elif command != 0:
+            if code & (1 << 7):
+                self.preemph = (code >> 6) & 1
+            if code & (1 << 2):
+                self.remote_mode = (code >> 3) & 0xf
+            if code & (1 << 0):
+                self.errors_cleared += 1
+            if code & (1 << 1):
+                # Mode clear: pre-emphasis is cleared, and ADC polling
+                # resumes, replacing the adjust values
+                self.remote_mode = None
+                self.preemph = 0
+                self.adjust_1 = None
+                self.adjust_2 = None
+
+    def describe(self) -> str:
+        def value(v: typing.Optional[int]) -> str:
+            return "ADC" if v is None else str(v)
+
+        mode = "rotary switch"
+        if self.remote_mode is not None:
+            mode = (MODE_NAMES[self.remote_mode] if self.remote_mode < len(MODE_NAMES)
+                    else str(self.remote_mode))
+        return "mode {}, adjust 1 {}, adjust 2 {}, pre-emphasis {}".format(
+                mode, value(self.adjust_1), value(self.adjust_2), self.preemph)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Receive and decode compressor remote control messages")
+    parser.add_argument("--host", default="127.0.0.1",
+        help="address to listen on (default 127.0.0.1, use 0.0.0.0 for broadcasts)")
+    parser.add_argument("--port", type=int, default=UDP_PORT,
+        help="UDP port (default {})".format(UDP_PORT))
+    parser.add_argument("--realtime", action="store_true",
+        help="take as long as the receiver would to play each message as sound")
+    parser.add_argument("--quiet", "-q", action="store_true",
+        help="do not show each code")
+    parser.add_argument("--count", type=int, default=0,
+        help="stop after receiving this many codes (default 0, no limit)")
+    args = parser.parse_args()
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind((args.host, args.port))
+    print("listening on {}:{}".format(args.host, args.port), flush=True)
+
+    state = DeviceState()
+    num_messages = num_invalid = num_codes = 0
+    air_time = 0.0
+    start_time: typing.Optional[float] = None
+    try:
+        while (args.count == 0) or (num_codes < args.count):
+            (data, address) = s.recvfrom(65536)
+            if start_time is None:
+                start_time = time.monotonic()
+            codes = decode_message(data)
+            if codes is None:
+                num_invalid += 1
+                print("invalid message of {} bytes from {}".format(len(data), address[0]))
+                continue
+
+            num_messages += 1
+            num_codes += len(codes)
+            air_time += get_air_time(len(codes))
+            for code in codes:
+                state.apply(code)
+                if not args.quiet:
+                    print("{:04x} {}".format(code, describe_code(code)))
+            if not args.quiet:
+                print("message {}: {} codes: {}".format(num_messages, len(codes), state.describe()),
+                      flush=True)
+            if args.realtime:
+                time.sleep(get_air_time(len(codes)))
+    except KeyboardInterrupt:
+        pass
+
+    elapsed = time.monotonic() - start_time if start_time is not None else 0.0
+    print("{} messages ({} invalid), {} codes in {:1.3f} s, {:1.1f} s as sound".format(
+            num_messages + num_invalid, num_invalid, num_codes, elapsed, air_time))
+    print("final state: {}".format(state.describe()))
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import socket, argparse, typing, struct, math, sys
+import socket, argparse, typing, struct, math, sys, time, threading, queue, shlex
 
 # These should match the bit positions in the "com_rot" block
 # in app/compressor_main.vhdl
@@ -13,6 +13,20 @@ SET_PREEMPH = (1 << 14) | (1 << 7)
 UDP_PORT = 1967
 UDP_TARGET = ("255.255.255.255", UDP_PORT)
 
+# These should match com/com.cpp: the header, and the most codes in one message
+HEADER = b"COM\n"
+MAX_CODES = 100
+
+# These should match comfilter/packetgen.c: each code is sent as a packet
+# of 34 bits at 300 baud, with 0.1s of lead-in and lead-out for each message
+BAUD_RATE = 300.0
+BITS_PER_PACKET = 16 + 16 + 2
+LEAD_IN_OUT_TIME = 0.2
+
+COMMAND_MASK = 3 << 14
+MODE_NAMES = ["CX", "C2", "C1", "A2", "CV", "P", "DBG_SPDIF", "DBG_SUBCODES",
+              "DBG_COMPRESS", "DBG_ADCS", "DBG_VERSION"]
+
 CodeList = typing.List[int]
 
 def set_adjust(codes: CodeList, command: int, decibels: typing.Optional[float]) -> None :
@@ -29,13 +43,145 @@ def set_mode(codes: CodeList, number: int, flag: bool) -> None:
     if flag:
         codes.append(SET_MODE | (number << 3))
 
+def encode_message(codes: CodeList) -> bytes:
+    return HEADER + struct.pack(">" + str(len(codes)) + "H", *codes)
+
+def decode_message(data: bytes) -> typing.Optional[CodeList]:
+    # As the receiver (com/com.cpp): None if the message is not valid,
+    # and codes after the first MAX_CODES are ignored
+    if ((len(data) <= len(HEADER)) or ((len(data) % 2) != 0)
+            or (data[:len(HEADER)] != HEADER)):
+        return None
+    count = min((len(data) - len(HEADER)) // 2, MAX_CODES)
+    return list(struct.unpack_from(">" + str(count) + "H", data, len(HEADER)))
+
+def get_air_time(num_codes: int) -> float:
+    # Time taken to send a message as sound
+    return LEAD_IN_OUT_TIME + ((num_codes * BITS_PER_PACKET) / BAUD_RATE)
+
+def describe_code(code: int) -> str:
+    command = code & COMMAND_MASK
+    if command == SET_ADJUST_1:
+        return "adjust 1 = {}".format(code & 0x3ff)
+    if command == SET_ADJUST_2:
+        return "adjust 2 = {}".format(code & 0x3ff)
+    if command == 0:
+        return "do nothing"
+    text = []
+    if code & (1 << 7):
+        text.append("pre-emphasis = {}".format((code >> 6) & 1))
+    if code & (1 << 2):
+        mode = (code >> 3) & 0xf
+        text.append("mode = {}".format(MODE_NAMES[mode] if mode < len(MODE_NAMES) else mode))
+    if code & (1 << 1):
+        text.append("mode clear")
+    if code & (1 << 0):
+        text.append("error clear")
+    return ", ".join(text) if len(text) != 0 else "do nothing"
+
+def get_coalesce_key(code: int) -> typing.Optional[int]:
+    # Codes which set a single register, so that only the latest value
+    # matters: the key identifies the register. Other codes (e.g. mode clear,
+    # which also clears pre-emphasis and returns the adjust values to the ADCs)
+    # are kept in order, and codes are not coalesced across them.
+    command = code & COMMAND_MASK
+    if command in (SET_ADJUST_1, SET_ADJUST_2):
+        return command
+    if command == (1 << 14):
+        flags = code & 0x87     # bits 6 downto 3 are values
+        if flags == (SET_PREEMPH & 0xff):
+            return SET_PREEMPH
+        if flags == (SET_MODE & 0xff):
+            return SET_MODE
+        if code == RESET_ERROR:
+            return RESET_ERROR
+    return None
+
 def send_codes(codes: CodeList) -> None:
-    data = b"COM\n" + struct.pack(">" + str(len(codes)) + "H", *codes)
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    s.sendto(data, UDP_TARGET)
+    s.sendto(encode_message(codes), UDP_TARGET)
 
-def main() -> None:
+class ControlSession:
+    # Sends codes through one socket, for scripts which make many changes.
+    # Queued codes are coalesced (a later value for a register replaces
+    # an earlier one which has not been sent) and sent in batches of up to
+    # MAX_CODES. Batches are rate limited: by default, the next batch is
+    # not sent until the previous one has been played as sound.
+    def __init__(self, target: typing.Tuple[str, int] = UDP_TARGET,
+                 min_interval: typing.Optional[float] = None) -> None:
+        self.target = target
+        self.min_interval = min_interval
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.pending: CodeList = []
+        self.next_send_time = 0.0
+        self.num_queued = 0
+        self.num_sent = 0
+        self.num_batches = 0
+        self.sent: typing.Dict[int, int] = {}       # the last code sent for each register
+        self.last_batch: CodeList = []
+
+    def queue(self, codes: CodeList) -> None:
+        for code in codes:
+            key = get_coalesce_key(code)
+            if key is not None:
+                for i in reversed(range(len(self.pending))):
+                    other_key = get_coalesce_key(self.pending[i])
+                    if other_key is None:
+                        break
+                    if other_key == key:
+                        del self.pending[i]
+                        break
+            self.pending.append(code)
+            self.num_queued += 1
+
+    def get_wait_time(self) -> float:
+        # Seconds until the next batch may be sent
+        return max(0.0, self.next_send_time - time.monotonic())
+
+    def send_batch(self) -> CodeList:
+        # Send the next batch now, if any codes are pending
+        batch = self.pending[:MAX_CODES]
+        if len(batch) == 0:
+            return batch
+        del self.pending[:len(batch)]
+        self.socket.sendto(encode_message(batch), self.target)
+        interval = self.min_interval if self.min_interval is not None else get_air_time(len(batch))
+        self.next_send_time = time.monotonic() + interval
+        self.num_sent += len(batch)
+        self.num_batches += 1
+        for code in batch:
+            key = get_coalesce_key(code)
+            self.sent[key if key is not None else code] = code
+        self.last_batch = batch
+        return batch
+
+    def poll(self) -> CodeList:
+        # Send a batch if one is pending and the rate limit allows
+        if self.get_wait_time() > 0.0:
+            return []
+        return self.send_batch()
+
+    def flush(self) -> CodeList:
+        # Send everything pending, waiting as required
+        sent: CodeList = []
+        while len(self.pending) != 0:
+            time.sleep(self.get_wait_time())
+            sent.extend(self.send_batch())
+        return sent
+
+    def close(self) -> None:
+        self.flush()
+        self.socket.close()
+
+    def __enter__(self) -> "ControlSession":
+        return self
+
+    def __exit__(self, *args: typing.Any) -> None:
+        self.close()
+
+def make_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
     parser.add_argument("--adjust-1", type=float,
         help="set volume for C1 mode (decibels, "
@@ -75,7 +221,9 @@ def main() -> None:
         help="enable/disable pre-emphasis bit in output stream",
         metavar="True/False")
 
-    args = parser.parse_args()
+    return parser
+
+def get_codes(args: argparse.Namespace) -> CodeList:
     codes: CodeList = []
 
     set_adjust(codes, SET_ADJUST_1, args.adjust_1)
@@ -106,11 +254,72 @@ def main() -> None:
     if args.reset_mode:
         codes.append(RESET_MODE)
 
+    return codes
+
+def print_codes(codes: CodeList) -> None:
+    for code in codes:
+        print("sent: {:04x} {}".format(code, describe_code(code)), flush=True)
+
+def run_session(parser: argparse.ArgumentParser, target: typing.Tuple[str, int],
+                min_interval: typing.Optional[float]) -> None:
+    # Read commands from standard input, one per line, using the same options as
+    # the command line (e.g. "--adjust-2 -6 -c2"). Lines are read by a thread,
+    # so that commands can be queued while waiting to send the next batch.
+    lines: "queue.Queue[typing.Optional[str]]" = queue.Queue()
+
+    def read_lines() -> None:
+        for line in sys.stdin:
+            lines.put(line)
+        lines.put(None)
+
+    threading.Thread(target=read_lines, daemon=True).start()
+    with ControlSession(target, min_interval) as session:
+        while True:
+            try:
+                line = lines.get(timeout=session.get_wait_time() if session.pending else None)
+            except queue.Empty:
+                line = ""
+            if line is None:
+                break
+            if line.strip() != "":
+                try:
+                    session.queue(get_codes(parser.parse_args(shlex.split(line))))
+                except SystemExit:
+                    pass        # argparse has reported the error
+            print_codes(session.poll())
+
+        print_codes(session.flush())
+
+    print("{} codes queued, {} sent in {} batches".format(
+        session.num_queued, session.num_sent, session.num_batches))
+
+def main() -> None:
+    parser = make_parser()
+    parser.add_argument("--target", default=UDP_TARGET[0],
+        help="address to send to (default {}, broadcast)".format(UDP_TARGET[0]),
+        metavar="HOST")
+    parser.add_argument("--port", type=int, default=UDP_PORT,
+        help="UDP port (default {})".format(UDP_PORT))
+    parser.add_argument("--session", action="store_true",
+        help="read commands from standard input, one per line, and send them "
+            "in batches through one socket")
+    parser.add_argument("--interval", type=float,
+        help="with --session, the minimum time between batches (seconds, "
+            "default: the time to play the previous batch as sound)")
+    args = parser.parse_args()
+    target = (args.target, args.port)
+
+    if args.session:
+        run_session(make_parser(), target, args.interval)
+        return
+
+    codes = get_codes(args)
     if len(codes) == 0:
         print("Use --help for instructions")
         return
 
-    send_codes(codes)
+    with ControlSession(target) as session:
+        session.queue(codes)
 
 if __name__ == "__main__":
     main()
@@ -31,4 +31,24 @@ package body debug_textio is
         std.textio.write(l, value);
     end write;
 
+    procedure readline (file f: std.textio.Text; l: inout Line) is
+    begin
+        std.textio.readline(f, l);
+    end readline;
+
+    procedure read (l: inout Line; value: out Integer; good: out Boolean) is
+    begin
+        std.textio.read(l, value, good);
+    end read;
+
+    procedure read (l: inout Line; value: out Integer) is
+    begin
+        std.textio.read(l, value);
+    end read;
+
+    procedure read (l: inout Line; value: out Character) is
+    begin
+        std.textio.read(l, value);
+    end read;
+
 end debug_textio;
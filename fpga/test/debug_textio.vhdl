@@ -11,4 +11,9 @@ package debug_textio is
     procedure write (l: inout Line; value: in Time);
     procedure write (l: inout Line; value: in Real);
 
+    procedure readline (file f: std.textio.Text; l: inout Line);
+    procedure read (l: inout Line; value: out Integer; good: out Boolean);
+    procedure read (l: inout Line; value: out Integer);
+    procedure read (l: inout Line; value: out Character);
+
 end debug_textio;
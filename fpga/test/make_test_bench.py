@@ -1,13 +1,119 @@
 
-import typing, enum, struct
+import argparse, typing, enum, io, sys, os
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "oscilloscope"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+import picoscope_decode, spdif_encode, wav_file
+from picoscope_decode import read_csv_chunks, summarise_csv_file, get_thresholds, Digitiser
+from wav_file import load_wav_file, get_32_bit_samples
+from spdif_encode import HeaderType, bmc_encode
+from generated_cache import GeneratedCache, hash_inputs
 
 GAP = 1e5                       # nanoseconds - gap between test files
 SINGLE = 1e9 / (44100 * 128)    # nanoseconds - length of single pulse
+WAV_FRAMES = 200                # frames used from each WAV file by default
+B_HEADER_INTERVAL = 100         # frames between B headers
+OUTPUT_FILE_NAME = "test/generated/test_signal_generator.vhdl"
+
+# Test data, in order: each WAV file is used at every quality
+CSV_FILE_NAMES = [
+    "../examples/20220502-32k.csv",
+    "../examples/20220502-44k.csv",
+    "../examples/20220502-48k.csv",
+    "../examples/test_48000_24_bit.csv",
+    "../examples/test_44100_24_bit.csv",
+]
+WAV_FILE_NAME = "test/test_44100_data"
+RUNS_PER_LINE = 16              # in the data file written by print_run_lengths
+
+VHDL_HEADER = """
+library work;
+use work.all;
+
+library ieee;
+use ieee.std_logic_1164.all;
+
+use debug_textio.all;
+
+entity test_signal_generator is
+    port (
+        done_out        : out std_logic;
+        clock_out       : out std_logic;
+        raw_data_out    : out std_logic
+    );
+end test_signal_generator;
+
+architecture structural of test_signal_generator is
+    signal done     : std_logic := '0';
+    signal r        : std_logic := '0';
+    signal clock    : std_logic := '0';
+begin
+    done_out <= done;
+    raw_data_out <= r;
+    clock_out <= clock;
 
-class HeaderType(enum.Enum):
-    B = enum.auto()
-    W = enum.auto()
-    M = enum.auto()
+    process
+    begin
+        while done = '0' loop
+            clock <= '1';
+            wait for 10 ns;
+            clock <= '0';
+            wait for 10 ns;
+        end loop;
+        wait;
+    end process;
+"""
+
+# Test data written as VHDL statements (one per state change)
+INLINE_PROCESS_START = """
+    process
+        variable l : line;
+    begin
+        r <= '0';
+        done <= '0';
+"""
+INLINE_PROCESS_END = """
+        done <= '1';
+        wait;
+    end process;
+end structural;
+"""
+
+# Test data read from a file written by RunLengthWriter
+TEXTIO_PROCESS = """
+    process
+        file data_file  : std.textio.text open read_mode is "{data_file_name}";
+        variable l      : line;
+        variable c      : character;
+        variable delay  : integer;
+        variable count  : integer;
+        variable good   : boolean;
+    begin
+        r <= '0';
+        done <= '0';
+        while not std.textio.endfile (data_file) loop
+            readline (data_file, l);
+            if l'length > 0 and l (l'low) = '#' then
+                read (l, c);
+                writeline (output, l);
+            else
+                loop
+                    read (l, delay, good);
+                    exit when not good;
+                    read (l, count);
+                    for i in 1 to count loop
+                        wait for delay * 1 ns;
+                        r <= not r;
+                    end loop;
+                end loop;
+            end if;
+        end loop;
+        done <= '1';
+        wait;
+    end process;
+end structural;
+"""
 
 class Quality(enum.Enum):
     ROUND_16 = enum.auto()
@@ -15,49 +121,23 @@ class Quality(enum.Enum):
     EXACT_24 = enum.auto()
 
 def read_csv_file(csv_file_name: str, state_change_time: typing.List[float]) -> None:
-
-    # Read raw data
-    analogue: typing.List[float] = []
-    times: typing.List[float] = []
-    time_scale = 1e-6 * 1e9
-    for line in open(csv_file_name, "rt"):
-        fields = line.rstrip().split(",")
-        try:
-            t = float(fields[0])
-            v = float(fields[1])
-        except Exception:
-            if line.startswith("(ms)"):
-                time_scale = 1e-3 * 1e9
-            elif line.startswith("(us)"):
-                time_scale = 1e-6 * 1e9
-            elif line.startswith("(ns)"):
-                time_scale = 1e-9 * 1e9
-
-            continue
-
-        times.append(t)
-        analogue.append(v)
-        t0 = t
-
-
-    # Digitise, convert to BMC
-    average = sum(analogue) / len(analogue)
-    threshold1 = average * 1.1
-    threshold0 = average / 1.1
-    t0 = (times[0] * time_scale) - GAP
-    state = state0 = False
-    for i in range(len(analogue)):
-        if analogue[i] > threshold1:
-            state = True
-        elif analogue[i] < threshold0:
-            state = False
-
-        if state != state0:
-            # Record state change time
-            t = times[i] * time_scale
-            state_change_time.append(max(1.0, t - t0))
-            t0 = t
-            state0 = state
+    # First pass: get the signal level
+    summary = summarise_csv_file(csv_file_name)
+
+    # Second pass: digitise, convert to BMC, one chunk at a time
+    digitiser = Digitiser(*get_thresholds(summary.average))
+    t0 = (summary.first_time * summary.time_scale * 1e9) - GAP
+    state0 = False
+    for (times, analogue, time_scale) in read_csv_chunks(csv_file_name):
+        digital = digitiser.digitise(analogue)
+        previous = numpy.concatenate(([state0], digital[:-1]))
+        state0 = bool(digital[-1])
+
+        # Record state change times
+        t = times[numpy.flatnonzero(digital != previous)] * (time_scale * 1e9)
+        if len(t) != 0:
+            state_change_time.extend(numpy.maximum(1.0, numpy.diff(t, prepend=t0)).tolist())
+            t0 = float(t[-1])
 
 def bmc_packetise(audio: int, header: HeaderType, state_change_time: typing.List[float]) -> None:
     bits = 0
@@ -93,112 +173,143 @@ def bmc_packetise(audio: int, header: HeaderType, state_change_time: typing.List
             state_change_time.append(SINGLE * 2)
         data = data >> 1
 
+def quantise(audio: numpy.ndarray, quality: Quality) -> numpy.ndarray:
+    # Reduce 32-bit samples to the given quality; rounding is to the nearest
+    # 16-bit value, with ties to even (like Python's round())
+    audio = audio.astype(numpy.uint64)
+    if quality == Quality.ROUND_16:
+        upper = audio >> numpy.uint64(16)
+        lower = audio & numpy.uint64(0xffff)
+        up = (lower > 0x8000) | ((lower == 0x8000) & ((upper & numpy.uint64(1)) != 0))
+        audio = (upper + up) << numpy.uint64(16)
+    elif quality == Quality.EXACT_16:
+        audio = (audio >> numpy.uint64(16)) << numpy.uint64(16)
+    return audio
+
 def print_banner(fd: typing.IO, banner: str) -> None:
     fd.write("""write (l, String'("{}")); writeline (output, l);\n""".format(banner))
 
-def print_data(fd: typing.IO, state_change_time: typing.List[float]) -> None:
-    for td in state_change_time:
-        fd.write("wait for {:1.0f} ns; ".format(td))
-        fd.write("r <= not r;\n")
-
-def wav_to_test_data(fd: typing.IO, wav_file_name: str, quality: Quality) -> None:
-    state_change_time: typing.List[float] = []
-    with open(wav_file_name, "rb") as fd2:
-        fd2.seek(0x2c, 0) # skip to start of data
-        for i in range(200):
-            # Read two 32-bit samples
-            (left, right) = struct.unpack("<II", fd2.read(8))
-
-            if quality == Quality.ROUND_16:
-                left = round(left / (1 << 16)) << 16
-                right = round(right / (1 << 16)) << 16
-            elif quality == Quality.EXACT_16:
-                left = (left >> 16) << 16
-                right = (right >> 16) << 16
-
-            if (i % 100) == 0:
-                # Use a B header for the left channel, W for right
-                bmc_packetise(left, HeaderType.B, state_change_time)
-                bmc_packetise(right, HeaderType.W, state_change_time)
-            else:
-                # Use a M header for the left channel, W for right
-                bmc_packetise(left, HeaderType.M, state_change_time)
-                bmc_packetise(right, HeaderType.W, state_change_time)
-
-    state_change_time.append(GAP)
-    print_banner(fd, "Start of {} with quality = {}".format(wav_file_name, quality))
-    print_data(fd, state_change_time)
-
-def csv_to_test_data(fd: typing.IO, csv_file_name: str) -> None:
+def print_data(fd: typing.IO, state_change_time: typing.Iterable[float]) -> None:
+    # Encoded data has only a few distinct times, so each is formatted once
+    (times, index) = numpy.unique(numpy.asarray(state_change_time, dtype=float), return_inverse=True)
+    lines = numpy.array(["wait for {:1.0f} ns; r <= not r;\n".format(td) for td in times.tolist()],
+                        dtype=object)
+    fd.write("".join(lines[index].tolist()))
+
+def print_run_lengths(fd: typing.IO, state_change_time: typing.Iterable[float]) -> None:
+    # Data file format: pairs of numbers (time in ns, number of state changes
+    # separated by that time), RUNS_PER_LINE pairs per line. The times are
+    # rounded as in print_data.
+    times = numpy.round(numpy.asarray(state_change_time, dtype=float)).astype(numpy.int64)
+    if len(times) == 0:
+        return
+    starts = numpy.flatnonzero(numpy.diff(times, prepend=times[0] - 1) != 0)
+    counts = numpy.diff(starts, append=len(times))
+    runs = numpy.column_stack((times[starts], counts))
+    whole = (len(runs) // RUNS_PER_LINE) * RUNS_PER_LINE
+    if whole != 0:
+        numpy.savetxt(fd, runs[:whole].reshape(-1, RUNS_PER_LINE * 2), fmt="%d")
+    if whole != len(runs):
+        numpy.savetxt(fd, runs[whole:].reshape(1, -1), fmt="%d")
+
+class TestDataWriter:
+    # Writes the test data as VHDL statements within the test signal generator process
+    def __init__(self, fd: typing.IO) -> None:
+        self.fd = fd
+
+    def banner(self, banner: str) -> None:
+        print_banner(self.fd, banner)
+
+    def data(self, state_change_time: typing.Iterable[float]) -> None:
+        print_data(self.fd, state_change_time)
+
+class RunLengthWriter(TestDataWriter):
+    # Writes the test data to a separate file, which is replayed by the
+    # test signal generator process using textio: banner lines begin with "#"
+    def banner(self, banner: str) -> None:
+        self.fd.write("#{}\n".format(banner))
+
+    def data(self, state_change_time: typing.Iterable[float]) -> None:
+        print_run_lengths(self.fd, state_change_time)
+
+def wav_to_test_data(writer: TestDataWriter, wav_file_name: str, quality: Quality,
+            num_frames: typing.Optional[int] = WAV_FRAMES) -> None:
+    # Encode the first num_frames frames of the WAV file (or all of them, if None),
+    # using the sample rate from the WAV header for the pulse width
+    (samples, wav_format) = load_wav_file(wav_file_name)
+    if wav_format.channels != 2:
+        raise ValueError("WAV file must have 2 channels")
+
+    audio = quantise(get_32_bit_samples(samples[:num_frames]), quality)
+
+    # Use a B header for the left channel every B_HEADER_INTERVAL frames, M otherwise;
+    # W for right
+    headers = numpy.full(audio.shape, HeaderType.W)
+    headers[:, 0] = HeaderType.M
+    headers[::B_HEADER_INTERVAL, 0] = HeaderType.B
+
+    single = 1e9 / (wav_format.sample_rate * 128)
+    state_change_time = numpy.append(bmc_encode(audio.flatten(), headers.flatten(), single), GAP)
+    writer.banner("Start of {} with quality = {}".format(wav_file_name, quality))
+    writer.data(state_change_time)
+
+def csv_to_test_data(writer: TestDataWriter, csv_file_name: str) -> None:
     state_change_time: typing.List[float] = []
     read_csv_file(csv_file_name, state_change_time)
     state_change_time.append(GAP)
-    print_banner(fd, "Start of " + csv_file_name)
-    print_data(fd, state_change_time)
+    writer.banner("Start of " + csv_file_name)
+    writer.data(state_change_time)
+
+def write_test_data(writer: TestDataWriter, wav_file_names: typing.List[str],
+            seconds: typing.Optional[float]) -> None:
+    # read input files
+    for csv_file_name in CSV_FILE_NAMES:
+        csv_to_test_data(writer, csv_file_name)
+    for quality in (Quality.EXACT_24, Quality.EXACT_16, Quality.ROUND_16):
+        wav_to_test_data(writer, WAV_FILE_NAME, quality)
+    for wav_file_name in wav_file_names:
+        num_frames = None
+        if seconds is not None:
+            num_frames = int(seconds * load_wav_file(wav_file_name)[1].sample_rate)
+        for quality in Quality:
+            wav_to_test_data(writer, wav_file_name, quality, num_frames)
 
 def main() -> None:
-    # generate test bench
-    with open("test/generated/test_signal_generator.vhdl", "wt") as fd:
-        fd.write(f"""
-library work;
-use work.all;
-
-library ieee;
-use ieee.std_logic_1164.all;
-
-use debug_textio.all;
-
-entity test_signal_generator is
-    port (
-        done_out        : out std_logic;
-        clock_out       : out std_logic;
-        raw_data_out    : out std_logic
-    );
-end test_signal_generator;
+    parser = argparse.ArgumentParser(description="Generate the test signal for the FPGA test bench")
+    parser.add_argument("--wav", metavar="input.wav", action="append", default=[],
+        help="also encode this 2-channel WAV file (at each quality), after the usual test data")
+    parser.add_argument("--seconds", type=float, default=None,
+        help="length of audio to use from each --wav file (default: all)")
+    parser.add_argument("--data-file", metavar="data.txt", default=None,
+        help="write the test data to this file, to be read by the test bench during "
+            "simulation, rather than into the VHDL source")
+    args = parser.parse_args()
+
+    # reuse the test bench if the inputs (including this generator) are unchanged
+    output_file_names = [OUTPUT_FILE_NAME]
+    if args.data_file is not None:
+        output_file_names.append(args.data_file)
+    cache = GeneratedCache(os.path.dirname(OUTPUT_FILE_NAME))
+    input_hash = hash_inputs(CSV_FILE_NAMES + [WAV_FILE_NAME] + args.wav
+                + [__file__, picoscope_decode.__file__, spdif_encode.__file__,
+                   wav_file.__file__],
+                args.seconds, args.data_file)
+    if cache.reuse(output_file_names, input_hash):
+        return
 
-architecture structural of test_signal_generator is
-    signal done     : std_logic := '0';
-    signal r        : std_logic := '0';
-    signal clock    : std_logic := '0';
-begin
-    done_out <= done;
-    raw_data_out <= r;
-    clock_out <= clock;
-
-    process
-    begin
-        while done = '0' loop
-            clock <= '1';
-            wait for 10 ns;
-            clock <= '0';
-            wait for 10 ns;
-        end loop;
-        wait;
-    end process;
-
-    process
-        variable l : line;
-    begin
-        r <= '0';
-        done <= '0';
-""")
-        # read input files
-        csv_to_test_data(fd, "../examples/20220502-32k.csv")
-        csv_to_test_data(fd, "../examples/20220502-44k.csv")
-        csv_to_test_data(fd, "../examples/20220502-48k.csv")
-        csv_to_test_data(fd, "../examples/test_48000_24_bit.csv")
-        csv_to_test_data(fd, "../examples/test_44100_24_bit.csv")
-        wav_to_test_data(fd, "test/test_44100_data", Quality.EXACT_24)
-        wav_to_test_data(fd, "test/test_44100_data", Quality.EXACT_16)
-        wav_to_test_data(fd, "test/test_44100_data", Quality.ROUND_16)
-
-        fd.write("""
-        done <= '1';
-        wait;
-    end process;
-end structural;
-""")
+    # generate test bench
+    with io.StringIO() as fd:
+        fd.write(VHDL_HEADER)
+        if args.data_file is None:
+            fd.write(INLINE_PROCESS_START)
+            write_test_data(TestDataWriter(fd), args.wav, args.seconds)
+            fd.write(INLINE_PROCESS_END)
+        else:
+            fd.write(TEXTIO_PROCESS.format(data_file_name=args.data_file))
+            with io.StringIO() as fd2:
+                write_test_data(RunLengthWriter(fd2), args.wav, args.seconds)
+                cache.write(args.data_file, fd2.getvalue(), input_hash)
+        cache.write(OUTPUT_FILE_NAME, fd.getvalue(), input_hash)
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,201 @@
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import tracemalloc
+import typing
+import numpy
+
+from binary_capture import BinaryCaptureHeader, SAMPLE_FORMATS, binary_decode_chunks, write_header
+from picoscope_decode import DEFAULT_CHUNK_SIZE, picoscope_decode_chunks
+from spdif_decode import (ADAPTIVE_PREFIX, AdaptiveBiphaseMarkDecoder,
+                BiphaseMarkDecoder, SubframeDecoder, AudioData,
+                estimate_unit, get_best_hold_time, get_run_lengths, join_audio_data)
+from sigtest import REPEAT_SIZE, examine_audio_data, get_pattern_block
+from spdif_encode import HeaderType, bmc_encode
+from stats import Stats
+
+STAGES = ["parse", "digitise", "bmc", "subframe", "check"]
+BLOCK_SIZE = 192        # frames per S/PDIF block (B preamble)
+LOW_LEVEL = 0.0         # mV
+HIGH_LEVEL = 60.0       # mV
+
+
+def generate_pulses(sample_rate: int) -> numpy.ndarray:
+    # Pulse widths (in units of the S/PDIF clock pulse width) for enough frames
+    # that the test pattern and the B preamble both repeat exactly
+    num_frames = int(numpy.lcm(REPEAT_SIZE, BLOCK_SIZE))
+    (left, right) = get_pattern_block(sample_rate)
+    audio = numpy.tile(numpy.stack((left, right), axis=1), (num_frames // REPEAT_SIZE, 1))
+
+    headers = numpy.full(audio.shape, HeaderType.W)
+    headers[:, 0] = HeaderType.M
+    headers[::BLOCK_SIZE, 0] = HeaderType.B
+
+    # The encoder expects 32-bit samples, as found in a WAV file
+    return bmc_encode(audio.flatten() << 8, headers.flatten())
+
+def generate_capture(num_samples: int, sample_rate: int, oversampling: float,
+            noise: float, jitter: float, chunk_size: int,
+            drift: float = 0.0, seed: int = 1) -> typing.Iterator[numpy.ndarray]:
+    # Generate the analogue signal (in mV) seen by an oscilloscope with
+    # oversampling samples per S/PDIF clock pulse. Jitter is the standard
+    # deviation of each edge time, and noise is the standard deviation of
+    # each sample, both relative to the pulse width and signal level.
+    # Drift is the change in the pulse width by the end of the capture,
+    # relative to the pulse width at the start.
+    rng = numpy.random.default_rng(seed)
+    template = numpy.cumsum(generate_pulses(sample_rate)) * oversampling
+    period = template[-1]
+
+    repeat = 0
+    edges = numpy.zeros(0)
+    edges_before = 0
+    for start in range(0, num_samples, chunk_size):
+        end = min(start + chunk_size, num_samples)
+
+        # Get enough edges to cover this chunk
+        while (len(edges) == 0) or (edges[-1] < end):
+            new_edges = (repeat * period) + template
+            new_edges += new_edges * new_edges * (drift / (2.0 * num_samples))
+            new_edges += rng.normal(0.0, jitter * oversampling, len(new_edges))
+            edges = numpy.concatenate((edges, new_edges))
+            repeat += 1
+
+        # Discard edges before this chunk
+        used = int(numpy.searchsorted(edges, start, side="right"))
+        edges_before += used
+        edges = edges[used:]
+
+        # The level is given by the number of edges so far
+        count = numpy.searchsorted(edges, numpy.arange(start, end), side="right") + edges_before
+        level = numpy.where((count & 1) != 0, HIGH_LEVEL, LOW_LEVEL)
+        yield level + rng.normal(0.0, noise * (HIGH_LEVEL - LOW_LEVEL), len(level))
+
+def write_capture(file_name: str, file_format: str, num_samples: int,
+            sample_rate: int, oversampling: float, noise: float, jitter: float,
+            chunk_size: int, drift: float = 0.0) -> None:
+    osc_period = 1.0 / (sample_rate * 128 * oversampling)
+    chunks = generate_capture(num_samples, sample_rate, oversampling, noise, jitter,
+                            chunk_size, drift)
+    if file_format == "csv":
+        with open(file_name, "wt") as fd:
+            fd.write("Time,Channel A\n(us),(mV)\n\n")
+            start = 0
+            for analogue in chunks:
+                times = (numpy.arange(start, start + len(analogue)) * osc_period) / 1e-6
+                numpy.savetxt(fd, numpy.column_stack((times, analogue)),
+                            fmt="%.8f", delimiter=",")
+                start += len(analogue)
+    else:
+        info = numpy.iinfo(SAMPLE_FORMATS[file_format])
+        offset = (HIGH_LEVEL + LOW_LEVEL) / 2.0
+        scale = (HIGH_LEVEL - LOW_LEVEL) * 2.0 / (info.max - info.min - 1)
+        with open(file_name, "wb") as fd:
+            for analogue in chunks:
+                codes = numpy.clip(numpy.round((analogue - offset) / scale), info.min, info.max)
+                codes.astype(SAMPLE_FORMATS[file_format]).tofile(fd)
+        write_header(file_name, BinaryCaptureHeader(file_format, osc_period, scale, offset))
+
+def run_benchmark(file_name: str, chunk_size: int, stats: Stats,
+            adaptive: bool = False) -> AudioData:
+    if file_name.endswith(".csv"):
+        (chunks, _) = picoscope_decode_chunks(file_name, chunk_size, stats)
+    else:
+        (chunks, _) = binary_decode_chunks(file_name, chunk_size, stats)
+
+    bmc: typing.Optional[BiphaseMarkDecoder] = None
+    subframes = SubframeDecoder(stats)
+    audio: typing.List[AudioData] = []
+    for digital in chunks:
+        with stats.stage("bmc"):
+            if bmc is None:
+                (runs, _) = get_run_lengths(digital)
+                if adaptive:
+                    prefix = runs[:ADAPTIVE_PREFIX]
+                    bmc = AdaptiveBiphaseMarkDecoder(
+                            estimate_unit(prefix, get_best_hold_time(prefix)), 0, stats)
+                else:
+                    bmc = BiphaseMarkDecoder(get_best_hold_time(runs), 0, stats)
+            packets = bmc.feed(digital)
+
+        with stats.stage("subframe"):
+            audio.append(subframes.decode(packets))
+
+    with stats.stage("subframe"):
+        if bmc is not None:
+            audio.append(subframes.decode(bmc.flush()))
+        audio.append(subframes.flush())
+        return join_audio_data(audio)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure decoder throughput using a synthetic capture")
+    parser.add_argument("--samples", type=float, default=1e6,
+        help="length of the capture in oscilloscope samples (default 1e6)")
+    parser.add_argument("--sample-rate", type=int, default=44100,
+        help="audio sample rate (default 44100)")
+    parser.add_argument("--oversampling", type=float, default=2.2,
+        help="oscilloscope samples per S/PDIF clock pulse (default 2.2)")
+    parser.add_argument("--noise", type=float, default=0.02,
+        help="signal noise, relative to the signal level (default 0.02)")
+    parser.add_argument("--jitter", type=float, default=0.02,
+        help="edge jitter, relative to the clock pulse width (default 0.02)")
+    parser.add_argument("--drift", type=float, default=0.0,
+        help="change in the clock pulse width by the end of the capture, "
+            "relative to the start (default 0)")
+    parser.add_argument("--format", choices=["csv"] + sorted(SAMPLE_FORMATS), default="int8",
+        help="capture file format (default int8)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+        help="samples per chunk (default {})".format(DEFAULT_CHUNK_SIZE))
+    parser.add_argument("--adaptive", action="store_true",
+        help="track the S/PDIF clock while decoding")
+    parser.add_argument("--no-memory", action="store_true",
+        help="do not measure peak memory (tracemalloc slows some stages)")
+    parser.add_argument("--json", action="store_true",
+        help="print the results as JSON")
+    args = parser.parse_args()
+
+    num_samples = int(args.samples)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_name = os.path.join(temp_dir, "capture." + ("csv" if args.format == "csv" else "bin"))
+        write_capture(file_name, args.format, num_samples, args.sample_rate,
+                    args.oversampling, args.noise, args.jitter, args.chunk_size, args.drift)
+
+        stats = Stats()
+        if not args.no_memory:
+            tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            audio = run_benchmark(file_name, args.chunk_size, stats, args.adaptive)
+            with stats.stage("check"):
+                verdict = examine_audio_data(audio[:-1].view(numpy.recarray))
+        tracemalloc.stop()
+
+    results = {
+        "samples": num_samples,
+        "frames": len(audio),
+        "passed": verdict.passed,
+        "clean_bits": verdict.clean_bits,
+        "stats": stats.to_json(),
+    }
+    if args.json:
+        print(json.dumps(results, indent=4))
+        return
+
+    print("{} samples, {} frames, test pattern {}".format(num_samples, len(audio),
+            "{}-bit clean".format(verdict.clean_bits) if verdict.passed
+            else (verdict.reason or "not clean")))
+    print("{:10s} {:>10s} {:>14s} {:>12s}".format("stage", "time (s)", "Msamples/s", "peak (MB)"))
+    for stage in STAGES:
+        stage_time = stats.stage_time.get(stage, 0.0)
+        print("{:10s} {:10.3f} {:14.1f} {:>12s}".format(stage, stage_time,
+                num_samples / max(stage_time, 1e-9) / 1e6,
+                "-" if args.no_memory else "{:1.1f}".format(
+                    stats.stage_peak_memory.get(stage, 0) / 1e6)))
+
+if __name__ == "__main__":
+    main()
+
@@ -0,0 +1,141 @@
+
+import argparse
+import json
+import os
+import typing
+import numpy
+from picoscope_decode import (DEFAULT_CHUNK_SIZE, Digitiser, digitise_chunks,
+                get_thresholds, read_csv_file)
+from spdif_decode import RawDigitalSignal
+from stats import Stats
+
+
+# A binary capture is a file of raw little-endian ADC codes (int8 or int16),
+# with a JSON sidecar file giving the sample interval (in seconds) and
+# the scaling from ADC codes to the oscilloscope's voltage units:
+#
+#    voltage = (code * scale) + offset
+#
+SAMPLE_FORMATS: typing.Dict[str, numpy.dtype] = {
+    "int8": numpy.dtype("<i1"),
+    "int16": numpy.dtype("<i2"),
+}
+
+class BinaryCaptureHeader:
+    def __init__(self, sample_format: str, sample_interval: float,
+                scale: float, offset: float) -> None:
+        if sample_format not in SAMPLE_FORMATS:
+            raise ValueError("Unsupported sample format: " + sample_format)
+        if scale <= 0.0:
+            raise ValueError("Scale must be positive")
+        self.sample_format = sample_format
+        self.sample_interval = sample_interval
+        self.scale = scale
+        self.offset = offset
+
+def get_header_file_name(bin_file_name: str) -> str:
+    return os.path.splitext(bin_file_name)[0] + ".json"
+
+def header_from_json(header: typing.Dict[str, typing.Any]) -> BinaryCaptureHeader:
+    return BinaryCaptureHeader(header["sample_format"], header["sample_interval"],
+                header["scale"], header["offset"])
+
+def header_to_json(header: BinaryCaptureHeader) -> typing.Dict[str, typing.Any]:
+    return {
+        "sample_format": header.sample_format,
+        "sample_interval": header.sample_interval,
+        "scale": header.scale,
+        "offset": header.offset,
+    }
+
+def read_header(bin_file_name: str) -> BinaryCaptureHeader:
+    with open(get_header_file_name(bin_file_name), "rt") as fd:
+        return header_from_json(json.load(fd))
+
+def write_header(bin_file_name: str, header: BinaryCaptureHeader) -> None:
+    with open(get_header_file_name(bin_file_name), "wt") as fd:
+        json.dump(header_to_json(header), fd, indent=4)
+        fd.write("\n")
+
+def load_binary_capture(bin_file_name: str) -> typing.Tuple[numpy.ndarray, BinaryCaptureHeader]:
+    # The ADC codes are memory-mapped, not read: pages are
+    # loaded from the page cache as they are digitised
+    header = read_header(bin_file_name)
+    codes = numpy.memmap(bin_file_name, dtype=SAMPLE_FORMATS[header.sample_format], mode="r")
+    return (codes, header)
+
+def get_code_digitiser(header: BinaryCaptureHeader, average: float) -> Digitiser:
+    # The thresholds for the signal midpoint (a voltage) are converted
+    # to ADC codes, so that the codes can be compared directly
+    (threshold0, threshold1) = get_thresholds(average)
+    return Digitiser((threshold0 - header.offset) / header.scale,
+                     (threshold1 - header.offset) / header.scale)
+
+def binary_decode_chunks(bin_file_name: str,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+            stats: typing.Optional[Stats] = None,
+            ) -> typing.Tuple[typing.Iterator[RawDigitalSignal], float]:
+    stats = stats if stats is not None else Stats()
+    (codes, header) = load_binary_capture(bin_file_name)
+
+    # First pass: get the signal level, in ADC codes
+    with stats.stage("parse"):
+        total = 0
+        minimum = numpy.iinfo(codes.dtype).max
+        maximum = numpy.iinfo(codes.dtype).min
+        for i in range(0, len(codes), chunk_size):
+            chunk = codes[i:i + chunk_size]
+            total += int(chunk.sum(dtype=numpy.int64))
+            minimum = min(minimum, int(chunk.min()))
+            maximum = max(maximum, int(chunk.max()))
+
+    osc_period = header.sample_interval
+    osc_freq = 1.0 / osc_period
+    average = ((total / len(codes)) * header.scale) + header.offset
+    print("Oscilloscope clock period {:1.3f} microseconds".format(osc_period * 1e6))
+    print("Oscilloscope clock frequency {:1.3f} MHz".format(osc_freq / 1e6))
+    print("Signal peak-to-peak: {:1.3f} to {:1.3f}".format(
+        (minimum * header.scale) + header.offset,
+        (maximum * header.scale) + header.offset))
+    print("Signal midpoint: {:1.3f}".format(average))
+
+    # Second pass: digitise
+    digitiser = get_code_digitiser(header, average)
+    chunks = digitise_chunks((numpy.asarray(codes[i:i + chunk_size])
+                for i in range(0, len(codes), chunk_size)), digitiser, stats)
+
+    return (chunks, osc_period)
+
+def csv_to_binary(csv_file_name: str, bin_file_name: str, sample_format: str = "int16") -> None:
+    (times, analogue, time_scale) = read_csv_file(csv_file_name)
+
+    # Scale the signal to fill the range of the ADC codes
+    info = numpy.iinfo(SAMPLE_FORMATS[sample_format])
+    minimum = float(analogue.min())
+    maximum = float(analogue.max())
+    offset = (maximum + minimum) / 2.0
+    scale = max(maximum - minimum, 1e-9) / (info.max - info.min - 1)
+    codes = numpy.clip(numpy.round((analogue - offset) / scale), info.min, info.max)
+
+    header = BinaryCaptureHeader(sample_format,
+                time_scale * ((times[-1] - times[0]) / (len(times) - 1)),
+                scale, offset)
+    codes.astype(SAMPLE_FORMATS[sample_format]).tofile(bin_file_name)
+    write_header(bin_file_name, header)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Convert oscilloscope CSV files to binary captures")
+    parser.add_argument("csv_files", nargs="+", metavar="input.csv")
+    parser.add_argument("--format", choices=sorted(SAMPLE_FORMATS), default="int16",
+        help="ADC code format (default int16)")
+    args = parser.parse_args()
+
+    for csv_file_name in args.csv_files:
+        bin_file_name = os.path.splitext(csv_file_name)[0] + ".bin"
+        csv_to_binary(csv_file_name, bin_file_name, args.format)
+        print("{} -> {}".format(csv_file_name, bin_file_name))
+
+if __name__ == "__main__":
+    main()
+
@@ -0,0 +1,179 @@
+
+import typing
+import numpy
+from stats import Stats
+
+
+# Channel status: one bit per frame (from the left channel), in blocks of
+# 192 frames beginning with a B preamble. Bit numbers are as in IEC 60958,
+# where bit 0 is the first bit of the block. See
+# https://www.minidisc.org/manuals/an22.pdf for a description.
+BLOCK_SIZE = 192
+PROFESSIONAL_BIT = 0
+NON_AUDIO_BIT = 1
+
+# Consumer format
+COPY_BIT = 2                # 1: copy permitted (copyright not asserted)
+PRE_EMPHASIS_BIT = 3        # 1: 50/15 microsecond pre-emphasis
+CATEGORY_POSITION = 8
+RATE_POSITION = 24
+WORD_LENGTH_POSITION = 32
+
+# Sample rate codes (bits 24-27, bit 24 is the least significant)
+CONSUMER_RATES = {
+    0b0000: 44100,
+    0b0010: 48000,
+    0b0011: 32000,
+    0b0100: 22050,
+    0b0110: 24000,
+    0b1000: 88200,
+    0b1001: 768000,
+    0b1010: 96000,
+    0b1100: 176400,
+    0b1110: 192000,
+}
+
+# Word length codes (bits 33-35), giving the length when bit 32 is 0;
+# add 4 bits when bit 32 is 1
+CONSUMER_WORD_LENGTHS = {
+    0b001: 16,
+    0b010: 18,
+    0b100: 19,
+    0b101: 20,
+    0b110: 17,
+}
+
+# Professional format
+PRO_EMPHASIS_POSITION = 2
+PRO_RATE_POSITION = 6
+PRO_RATES = {
+    0b10: 48000,            # bit 7 set
+    0b01: 44100,            # bit 6 set
+    0b11: 32000,
+}
+PRO_EMPHASIS = {
+    0b001: False,
+    0b011: True,            # 50/15 microseconds
+    0b111: True,            # CCITT J.17
+}
+
+# Fields compared between consecutive blocks by check_channel_status
+STATUS_FIELDS = ["professional", "audio", "copy_permitted", "pre_emphasis",
+                 "category", "sample_rate", "word_length"]
+
+
+def get_field(bits: numpy.ndarray, position: int, size: int) -> int:
+    # Value of bits [position, position + size), least significant bit first
+    value = 0
+    for i in range(size):
+        value |= int(bits[position + i]) << i
+    return value
+
+class ChannelStatus:
+    # The information in one block of channel status bits. Fields which
+    # are not given by the block (or are not understood) are None.
+    def __init__(self, bits: numpy.ndarray) -> None:
+        self.bits = bits
+        self.professional = bool(bits[PROFESSIONAL_BIT])
+        self.audio = not bits[NON_AUDIO_BIT]
+        self.copy_permitted: typing.Optional[bool] = None
+        self.pre_emphasis: typing.Optional[bool] = None
+        self.category: typing.Optional[int] = None
+        self.sample_rate: typing.Optional[int] = None
+        self.word_length: typing.Optional[int] = None
+
+        if self.professional:
+            self.pre_emphasis = PRO_EMPHASIS.get(get_field(bits, PRO_EMPHASIS_POSITION, 3))
+            self.sample_rate = PRO_RATES.get(get_field(bits, PRO_RATE_POSITION, 2))
+        else:
+            self.copy_permitted = bool(bits[COPY_BIT])
+            self.pre_emphasis = bool(bits[PRE_EMPHASIS_BIT])
+            self.category = get_field(bits, CATEGORY_POSITION, 8)
+            self.sample_rate = CONSUMER_RATES.get(get_field(bits, RATE_POSITION, 4))
+            self.word_length = CONSUMER_WORD_LENGTHS.get(
+                    get_field(bits, WORD_LENGTH_POSITION + 1, 3))
+            if (self.word_length is not None) and bits[WORD_LENGTH_POSITION]:
+                self.word_length += 4
+
+    def subcode_register(self) -> int:
+        # The first 32 bits, as in the subcode register of channel_decoder.vhdl
+        # (and the D2 debug mode): bit 0 of the block is the MSB
+        value = 0
+        for i in range(32):
+            value = (value << 1) | int(self.bits[i])
+        return value
+
+    def describe(self) -> str:
+        text = ["professional" if self.professional else "consumer"]
+        if not self.audio:
+            text.append("non-audio")
+        text.append("{} Hz".format(self.sample_rate)
+                    if self.sample_rate is not None else "sample rate not indicated")
+        if self.word_length is not None:
+            text.append("{}-bit".format(self.word_length))
+        if self.pre_emphasis is not None:
+            text.append("pre-emphasis" if self.pre_emphasis else "no pre-emphasis")
+        if self.copy_permitted is not None:
+            text.append("copy permitted" if self.copy_permitted else "copyright asserted")
+        if self.category is not None:
+            text.append("category {:02x}".format(self.category))
+        return ", ".join(text)
+
+def check_channel_status(previous: ChannelStatus, current: ChannelStatus) -> typing.List[str]:
+    # Fields which changed between consecutive blocks
+    return [name for name in STATUS_FIELDS
+            if getattr(previous, name) != getattr(current, name)]
+
+class ChannelStatusDecoder:
+    # Collects channel status bits into blocks. The bits are supplied in
+    # pieces of any size, along with a flag for each bit which is set if the
+    # frame began with a B preamble, and the frame position. Each call returns
+    # the blocks that were completed. The most recent block is kept, and if
+    # the next block is the same, it is not decoded again. Blocks of the
+    # wrong size and changes between consecutive blocks are counted in stats.
+    def __init__(self, stats: typing.Optional[Stats] = None) -> None:
+        self.stats = stats if stats is not None else Stats()
+        self.last: typing.Optional[ChannelStatus] = None
+        self.bits = numpy.zeros(0, dtype=bool)
+        self.position: typing.Optional[int] = None    # position of the block start
+        self.num_blocks = 0
+
+    def feed(self, bits: numpy.ndarray, block_starts: numpy.ndarray,
+                positions: numpy.ndarray) -> typing.List[ChannelStatus]:
+        completed: typing.List[ChannelStatus] = []
+        wrong_size: typing.List[int] = []
+        changed: typing.List[int] = []
+        start = 0
+        for index in numpy.flatnonzero(block_starts).tolist() + [None]:
+            if self.position is not None:
+                # (a block which is too long is not kept in full)
+                self.bits = numpy.concatenate((self.bits, bits[start:index]))[:BLOCK_SIZE + 1]
+            if index is None:
+                break
+
+            # B preamble: the previous block is complete
+            if self.position is not None:
+                if len(self.bits) != BLOCK_SIZE:
+                    wrong_size.append(self.position)
+                elif (self.last is not None) and numpy.array_equal(self.bits, self.last.bits):
+                    completed.append(self.last)
+                else:
+                    status = ChannelStatus(self.bits)
+                    if (self.last is not None) and check_channel_status(self.last, status):
+                        changed.append(self.position)
+                    self.last = status
+                    completed.append(status)
+
+            self.position = int(positions[index])
+            self.bits = numpy.zeros(0, dtype=bool)
+            start = index
+
+        self.num_blocks += len(completed)
+        self.stats.add("status_wrong_size", wrong_size)
+        self.stats.add("status_changed", changed)
+        return completed
+
+    def restart(self) -> None:
+        # Discard the incomplete block, e.g. after a break in the signal
+        self.bits = numpy.zeros(0, dtype=bool)
+        self.position = None
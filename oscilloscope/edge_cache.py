@@ -0,0 +1,185 @@
+
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import typing
+import zipfile
+import numpy
+from binary_capture import get_header_file_name
+from picoscope_decode import HYSTERESIS
+from spdif_decode import RunLengths
+
+
+# A persistent cache of digitised captures, so that each capture is parsed
+# and digitised only once. The decoder needs only the run lengths of the
+# digital signal and the position of its first edge (from get_run_lengths),
+# with the oscilloscope's sample period: these are stored in a compressed
+# NumPy file, named by a hash of the contents of the capture and the settings
+# of the digitiser. When the cache is larger than its limit, the least recently
+# used files are removed. Each file is written atomically and the time of last
+# use is the modification time of the file, so that worker processes can share
+# the cache without any locking.
+CACHE_VERSION = 1
+DEFAULT_CACHE_SIZE = 1 << 30        # bytes
+ENTRY_EXTENSION = ".npz"
+HASH_EXTENSION = ".json"
+HASH_CHUNK_SIZE = 1 << 20           # bytes
+
+class CachedEdges:
+    def __init__(self, runs: RunLengths, first_edge: int, osc_period: float) -> None:
+        self.runs = runs
+        self.first_edge = first_edge
+        self.osc_period = osc_period
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+def hash_file(file_name: str) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_name, "rb") as fd:
+        while True:
+            data = fd.read(HASH_CHUNK_SIZE)
+            if len(data) == 0:
+                return digest.hexdigest()
+            digest.update(data)
+
+def get_compact_runs(runs: RunLengths) -> numpy.ndarray:
+    # Run lengths are positive and usually small: the smallest unsigned
+    # type is used, before compression
+    if len(runs) == 0:
+        return runs.astype(numpy.uint8)
+    return runs.astype(numpy.min_scalar_type(int(runs.max())))
+
+class EdgeCache:
+    def __init__(self, directory: str, max_size: int = DEFAULT_CACHE_SIZE) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, name: str, extension: str) -> str:
+        return os.path.join(self.directory, name + extension)
+
+    def get_content_hash(self, file_name: str) -> str:
+        # Hashing a large capture takes a while, so the hash is remembered for
+        # as long as the file has the same name, size and modification time
+        info = os.stat(file_name)
+        identity = [os.path.abspath(file_name), info.st_size, info.st_mtime_ns]
+        memo_file_name = self.get_path(hash_bytes(json.dumps(identity).encode()), HASH_EXTENSION)
+        try:
+            with open(memo_file_name, "rt") as fd:
+                memo = json.load(fd)
+            if memo["file"] == identity:
+                touch(memo_file_name)
+                return str(memo["hash"])
+        except (OSError, ValueError, KeyError):
+            pass
+
+        content_hash = hash_file(file_name)
+        self.write(memo_file_name, lambda fd: fd.write(
+                json.dumps({"file": identity, "hash": content_hash}).encode()))
+        return content_hash
+
+    def get_key(self, file_name: str) -> str:
+        # The key depends on the contents of the capture (and of the JSON file
+        # giving the scale of a binary capture), and on the digitiser settings
+        contents = [self.get_content_hash(file_name)]
+        if file_name.lower().endswith(".bin"):
+            with open(get_header_file_name(file_name), "rb") as fd:
+                contents.append(hash_bytes(fd.read()))
+        return hash_bytes(json.dumps({"version": CACHE_VERSION, "contents": contents,
+                                      "hysteresis": HYSTERESIS}).encode())
+
+    def load(self, key: str) -> typing.Optional[CachedEdges]:
+        entry_file_name = self.get_path(key, ENTRY_EXTENSION)
+        try:
+            with numpy.load(entry_file_name) as data:
+                edges = CachedEdges(data["runs"].astype(numpy.int64),
+                                    int(data["first_edge"]), float(data["osc_period"]))
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+        touch(entry_file_name)
+        return edges
+
+    def store(self, key: str, edges: CachedEdges) -> None:
+        self.write(self.get_path(key, ENTRY_EXTENSION), lambda fd: numpy.savez_compressed(fd,
+                runs=get_compact_runs(edges.runs), first_edge=edges.first_edge,
+                osc_period=edges.osc_period))
+        self.evict()
+
+    def write(self, file_name: str, write_data: typing.Callable[[typing.BinaryIO], typing.Any]) -> None:
+        # Write to a temporary file, then rename it, so that no other process
+        # sees a partly written file. Failure only means that nothing is cached.
+        (fd, temp_file_name) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as temp_fd:
+                write_data(temp_fd)
+            os.replace(temp_file_name, file_name)
+        except OSError:
+            try:
+                os.unlink(temp_file_name)
+            except OSError:
+                pass
+
+    def get_files(self) -> typing.List[typing.Tuple[float, int, str]]:
+        # Time of last use, size and name of each file in the cache
+        files = []
+        for name in os.listdir(self.directory):
+            if os.path.splitext(name)[1] in (ENTRY_EXTENSION, HASH_EXTENSION):
+                file_name = os.path.join(self.directory, name)
+                try:
+                    info = os.stat(file_name)
+                except OSError:
+                    continue        # removed by another process
+                files.append((info.st_mtime, info.st_size, file_name))
+        return files
+
+    def evict(self) -> None:
+        # Remove the least recently used files until the cache fits
+        files = sorted(self.get_files())
+        total = sum(size for (_, size, _) in files)
+        for (_, size, file_name) in files:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(file_name)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self) -> None:
+        for (_, _, file_name) in self.get_files():
+            try:
+                os.unlink(file_name)
+            except OSError:
+                pass
+
+def touch(file_name: str) -> None:
+    try:
+        os.utime(file_name)
+    except OSError:
+        pass
+
+def parse_size(text: str) -> int:
+    # Size in megabytes
+    return int(float(text) * (1 << 20))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Show or clear the cache of digitised captures used by sigtest.py")
+    parser.add_argument("directory", help="cache directory")
+    parser.add_argument("--clear", action="store_true",
+        help="remove everything from the cache")
+    args = parser.parse_args()
+
+    cache = EdgeCache(args.directory)
+    if args.clear:
+        cache.clear()
+    files = cache.get_files()
+    entries = [size for (_, size, file_name) in files if file_name.endswith(ENTRY_EXTENSION)]
+    print("{}: {} captures, {:1.1f} MB".format(args.directory, len(entries),
+            sum(size for (_, size, _) in files) / (1 << 20)))
+
+if __name__ == "__main__":
+    main()
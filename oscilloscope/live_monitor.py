@@ -0,0 +1,393 @@
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import sys
+import time
+import typing
+import numpy
+from binary_capture import (SAMPLE_FORMATS, BinaryCaptureHeader, get_code_digitiser,
+                header_from_json, header_to_json, load_binary_capture)
+from picoscope_decode import Digitiser
+from sigtest import MARKER_MASK, MARKER_VALUE, MASK_16, MASK_24
+from spdif_decode import AudioData, SPDIFDecoder
+from stats import Stats
+from wavtest import DEFAULT_MAX_ERRORS, PatternChecker
+
+
+# A live stream is a binary capture sent over a pipe or socket: one line of
+# JSON, with the same fields as the sidecar file of a binary capture, then the
+# raw ADC codes. If the JSON also gives the number of codes, another stream may
+# follow on the same connection: otherwise the stream runs to the end. Blocks of codes are queued for decoding, which runs in a
+# worker thread: when the queue is full, reading stops, so that a fast sender
+# is held back rather than data being lost. A status line is shown at
+# regular intervals, with the verdict for the data decoded since the last one.
+DEFAULT_BLOCK_SIZE = 1 << 18        # ADC codes
+DEFAULT_QUEUE_SIZE = 8              # blocks
+DEFAULT_INTERVAL = 0.5              # seconds
+DEFAULT_REPLAY_BLOCK_SIZE = 1 << 16
+DECODE_ERRORS = ("resync", "wrong_size", "wrong_sync_bits", "parity_error")
+
+Address = typing.Tuple[str, str, int]
+
+def parse_address(text: str) -> Address:
+    # "-" (standard input or output), "tcp:PORT", "tcp:HOST:PORT",
+    # "unix:PATH", or the path of a named pipe
+    if text == "-":
+        return ("stdio", "", 0)
+    if text.startswith("tcp:"):
+        fields = text[4:].rsplit(":", 1)
+        if len(fields) == 1:
+            return ("tcp", "127.0.0.1", int(fields[0]))
+        return ("tcp", fields[0], int(fields[1]))
+    if text.startswith("unix:"):
+        return ("unix", text[5:], 0)
+    return ("pipe", text, 0)
+
+class BlockResult:
+    # Counters after decoding a block, for the status line
+    def __init__(self, frames: int, checked: int, errors: int, slips: int,
+                decode_errors: int, codes: int, messages: typing.List[str]) -> None:
+        self.frames = frames
+        self.checked = checked
+        self.errors = errors
+        self.slips = slips
+        self.decode_errors = decode_errors
+        self.codes = codes
+        self.messages = messages
+
+class LiveDecoder:
+    # Digitises, decodes and checks one stream, a block at a time. The
+    # thresholds come from the midpoint of the first block, and the S/PDIF
+    # clock is found from it. The test pattern is checked from the first
+    # marker, which also gives the sample rate. Decoding errors are counted
+    # from the first frame: before then, the decoder is finding the start of
+    # a subframe in a stream which may begin anywhere. The stream usually
+    # ends part of the way through a frame: that frame is not checked, and
+    # the packet which is cut short is not counted as an error.
+    def __init__(self, header: BinaryCaptureHeader, mask: int, max_errors: int) -> None:
+        self.header = header
+        self.mask = mask
+        self.max_errors = max_errors
+        self.stats = Stats()
+        self.digitiser: typing.Optional[Digitiser] = None
+        self.decoder = SPDIFDecoder(stats=self.stats, osc_period=header.sample_interval)
+        self.checker: typing.Optional[PatternChecker] = None
+        self.num_frames = 0
+        self.num_codes = 0
+        self.lock_in_errors: typing.Optional[int] = None
+        self.truncated = 0
+
+    def decode(self, codes: numpy.ndarray) -> BlockResult:
+        if self.digitiser is None:
+            average = (float(codes.mean()) * self.header.scale) + self.header.offset
+            self.digitiser = get_code_digitiser(self.header, average)
+        self.num_codes += len(codes)
+        return self.check(self.decoder.feed(self.digitiser.digitise(codes)))
+
+    def flush(self) -> BlockResult:
+        wrong_size = self.stats.counters.get("wrong_size", 0)
+        audio = self.decoder.flush()
+        self.truncated = min(1, self.stats.counters.get("wrong_size", 0) - wrong_size)
+        return self.check(audio[:len(audio) - 1].view(numpy.recarray))
+
+    def check(self, audio: AudioData) -> BlockResult:
+        messages: typing.List[str] = []
+        if self.checker is None:
+            found = numpy.flatnonzero((audio.right & MARKER_MASK) == (MARKER_VALUE & MARKER_MASK))
+            if len(found) != 0:
+                sample_rate = int(audio.left[found[0]] >> 8) * 100
+                messages.append("marker found at frame {}: sample rate of test data {} Hz".format(
+                        self.num_frames + int(found[0]), sample_rate))
+                self.checker = PatternChecker(sample_rate, self.mask, self.max_errors,
+                                              self.num_frames)
+
+        self.num_frames += len(audio)
+        checked = errors = slips = 0
+        if self.checker is not None:
+            messages.extend(self.checker.check(audio.left, audio.right))
+            checked = self.checker.report.num_checked
+            errors = self.checker.report.num_errors
+            slips = self.checker.report.num_slips
+
+        decode_errors = sum(self.stats.counters.get(name, 0) for name in DECODE_ERRORS) - self.truncated
+        if (self.lock_in_errors is None) and (self.num_frames != 0):
+            self.lock_in_errors = decode_errors
+        decode_errors -= self.lock_in_errors or 0
+        return BlockResult(self.num_frames, checked, errors, slips, decode_errors,
+                           self.num_codes, messages)
+
+class MonitorStatus:
+    # Totals over all streams, and the totals at the previous status line
+    def __init__(self) -> None:
+        self.start_time = time.monotonic()
+        self.stream_totals = BlockResult(0, 0, 0, 0, 0, 0, [])     # finished streams
+        self.current = BlockResult(0, 0, 0, 0, 0, 0, [])           # the current stream
+        self.previous = self.total()
+        self.previous_time = self.start_time
+        self.latency = 0.0          # the longest time from receiving a block to checking it
+        self.streams = 0
+        self.osc_period: typing.Optional[float] = None
+        self.queue: typing.Optional["asyncio.Queue[typing.Optional[BlockItem]]"] = None
+
+    def total(self) -> BlockResult:
+        t = self.stream_totals
+        c = self.current
+        return BlockResult(t.frames + c.frames, t.checked + c.checked, t.errors + c.errors,
+                           t.slips + c.slips, t.decode_errors + c.decode_errors,
+                           t.codes + c.codes, [])
+
+    def end_stream(self) -> None:
+        self.stream_totals = self.total()
+        self.current = BlockResult(0, 0, 0, 0, 0, 0, [])
+
+    @property
+    def passed(self) -> bool:
+        total = self.total()
+        return (total.checked != 0) and (total.errors == 0) and (total.slips == 0)
+
+    def status_line(self) -> str:
+        # The verdict is for the data decoded since the previous status line:
+        # PASS if frames were checked without errors, FAIL for any error,
+        # otherwise WAIT (no signal, or the marker has not been found)
+        now = time.monotonic()
+        total = self.total()
+        before = self.previous
+        new_errors = ((total.errors - before.errors) + (total.slips - before.slips)
+                      + (total.decode_errors - before.decode_errors))
+        if new_errors != 0:
+            verdict = "FAIL"
+        elif total.checked > before.checked:
+            verdict = "PASS"
+        else:
+            verdict = "WAIT"
+
+        speed = ""
+        if (self.osc_period is not None) and (now > self.previous_time):
+            speed = "  speed {:1.2f}x".format(
+                    (total.codes - before.codes) * self.osc_period / (now - self.previous_time))
+        queued = ""
+        if self.queue is not None:
+            queued = "  queue {}/{}".format(self.queue.qsize(), self.queue.maxsize)
+
+        line = ("{:8.1f} s: {}  frames {}  checked {}  errors {}  slips {}  decode errors {}"
+                "{}{}  latency {:1.3f} s".format(now - self.start_time, verdict, total.frames,
+                total.checked, total.errors, total.slips, total.decode_errors,
+                queued, speed, self.latency))
+        self.previous = total
+        self.previous_time = now
+        self.latency = 0.0
+        return line
+
+BlockItem = typing.Tuple[numpy.ndarray, float]
+
+async def read_blocks(reader: asyncio.StreamReader, dtype: numpy.dtype, block_size: int,
+            queue: "asyncio.Queue[typing.Optional[BlockItem]]",
+            num_codes: typing.Optional[int] = None) -> None:
+    # Put blocks of codes in the queue (waiting while it is full), then None at the end:
+    # after num_codes codes, if given, or else at the end of the input
+    block_bytes = block_size * dtype.itemsize
+    remaining = num_codes * dtype.itemsize if num_codes is not None else None
+    data = b""
+    while True:
+        wanted = block_bytes - len(data)
+        if remaining is not None:
+            wanted = min(wanted, remaining)
+        part = await reader.read(wanted) if wanted != 0 else b""
+        if remaining is not None:
+            remaining -= len(part)
+        data += part
+        if (len(data) >= block_bytes) or ((len(part) == 0) and (len(data) != 0)):
+            size = len(data) - (len(data) % dtype.itemsize)
+            await queue.put((numpy.frombuffer(data[:size], dtype=dtype), time.monotonic()))
+            data = data[size:]
+        if len(part) == 0:
+            await queue.put(None)
+            return
+
+async def decode_blocks(decoder: LiveDecoder, executor: concurrent.futures.Executor,
+            status: MonitorStatus,
+            queue: "asyncio.Queue[typing.Optional[BlockItem]]") -> None:
+    # Decode each block from the queue in the executor, until None
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await queue.get()
+        if item is None:
+            result = await loop.run_in_executor(executor, decoder.flush)
+        else:
+            (codes, received) = item
+            result = await loop.run_in_executor(executor, decoder.decode, codes)
+            status.latency = max(status.latency, time.monotonic() - received)
+        status.current = result
+        for message in result.messages:
+            print(message)
+        if item is None:
+            return
+
+async def monitor_stream(reader: asyncio.StreamReader, args: argparse.Namespace,
+            executor: concurrent.futures.Executor, status: MonitorStatus) -> bool:
+    # Read the header, then decode the stream as it arrives. Returns True if
+    # another stream may follow (the header gave the number of codes).
+    line = await reader.readline()
+    if len(line) == 0:
+        return False
+    fields = json.loads(line)
+    header = header_from_json(fields)
+    num_codes: typing.Optional[int] = fields.get("codes")
+    status.streams += 1
+    status.osc_period = header.sample_interval
+    print("stream {}: {} codes, sample interval {:1.3f} microseconds".format(
+            status.streams, header.sample_format, header.sample_interval * 1e6))
+
+    queue: "asyncio.Queue[typing.Optional[BlockItem]]" = asyncio.Queue(args.queue_size)
+    status.queue = queue
+    decoder = LiveDecoder(header, MASK_16 if args.bits == 16 else MASK_24, args.max_errors)
+    try:
+        await asyncio.gather(
+            read_blocks(reader, SAMPLE_FORMATS[header.sample_format], args.block_size, queue,
+                        num_codes),
+            decode_blocks(decoder, executor, status, queue))
+    finally:
+        status.end_stream()
+        status.queue = None
+    print("stream {}: ended after {} frames".format(status.streams, decoder.num_frames))
+    return num_codes is not None
+
+async def report_status(status: MonitorStatus, interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        print(status.status_line(), flush=True)
+
+async def open_reader(address: Address) -> asyncio.StreamReader:
+    # Standard input or a named pipe
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    fd = sys.stdin.buffer if address[0] == "stdio" else open(address[1], "rb")
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), fd)
+    return reader
+
+async def monitor(args: argparse.Namespace,
+            status: typing.Optional[MonitorStatus] = None) -> bool:
+    # Monitor the source: a pipe carries the streams sent to it, but a server
+    # accepts any number of connections, one at a time, until interrupted
+    address = parse_address(args.source)
+    status = status if status is not None else MonitorStatus()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    reporter = asyncio.ensure_future(report_status(status, args.interval))
+    one_at_a_time = asyncio.Lock()
+
+    async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        async with one_at_a_time:
+            try:
+                while await monitor_stream(reader, args, executor, status):
+                    pass
+            except (ValueError, KeyError) as e:
+                print("stream rejected: {}: {}".format(type(e).__name__, e))
+            finally:
+                writer.close()
+
+    try:
+        if address[0] in ("stdio", "pipe"):
+            reader = await open_reader(address)
+            while await monitor_stream(reader, args, executor, status):
+                pass
+        else:
+            if address[0] == "tcp":
+                server = await asyncio.start_server(handle_client, address[1], address[2])
+            else:
+                server = await asyncio.start_unix_server(handle_client, address[1])
+            print("listening on {}".format(args.source), flush=True)
+            async with server:
+                await server.serve_forever()
+    finally:
+        reporter.cancel()
+        executor.shutdown()
+        print(status.status_line())
+
+    return status.passed
+
+async def replay(args: argparse.Namespace) -> None:
+    # Send a binary capture as a live stream, at the speed of the capture
+    # (or faster, or as fast as the receiver will accept if speed is 0). With
+    # loop, each pass is a separate stream, as the end of the capture does not
+    # join up with the start: the receiver begins decoding again at each pass.
+    (codes, header) = load_binary_capture(args.replay)
+    address = parse_address(args.source)
+    loop = asyncio.get_running_loop()
+    if address[0] == "tcp":
+        (_, writer) = await asyncio.open_connection(address[1], address[2])
+    elif address[0] == "unix":
+        (_, writer) = await asyncio.open_unix_connection(address[1])
+    else:
+        fd = sys.stdout.buffer if address[0] == "stdio" else open(address[1], "wb")
+        (transport, protocol) = await loop.connect_write_pipe(
+                lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()), fd)
+        writer = asyncio.StreamWriter(transport, protocol, None, loop)
+
+    fields = header_to_json(header)
+    fields["codes"] = len(codes)
+    block_time = DEFAULT_REPLAY_BLOCK_SIZE * header.sample_interval
+    start_time = time.monotonic()
+    sent = 0
+    while True:
+        writer.write((json.dumps(fields) + "\n").encode("utf-8"))
+        for i in range(0, len(codes), DEFAULT_REPLAY_BLOCK_SIZE):
+            writer.write(numpy.asarray(codes[i:i + DEFAULT_REPLAY_BLOCK_SIZE]).tobytes())
+            await writer.drain()
+            sent += 1
+            if args.speed > 0.0:
+                delay = start_time + (sent * block_time / args.speed) - time.monotonic()
+                if delay > 0.0:
+                    await asyncio.sleep(delay)
+        if not args.loop:
+            break
+
+    await writer.drain()
+    writer.close()
+    await writer.wait_closed()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Check a live S/PDIF signal for bit-exactness, continuously")
+    parser.add_argument("source", metavar="SOURCE",
+        help="- (standard input), a named pipe, unix:PATH or tcp:[HOST:]PORT "
+            "(listen for streams); with --replay, the destination")
+    parser.add_argument("--bits", type=int, choices=(16, 24), default=24,
+        help="bits checked in each sample (default 24)")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE,
+        help="ADC codes decoded at a time (default {})".format(DEFAULT_BLOCK_SIZE))
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+        help="blocks waiting to be decoded before reading stops (default {})".format(
+            DEFAULT_QUEUE_SIZE))
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL,
+        help="seconds between status lines (default {})".format(DEFAULT_INTERVAL))
+    parser.add_argument("--max-errors", type=int, default=DEFAULT_MAX_ERRORS,
+        help="number of errors and slips to show (default {}, 0 for no limit)".format(
+            DEFAULT_MAX_ERRORS))
+    parser.add_argument("--replay", metavar="CAPTURE.bin",
+        help="send a binary capture to SOURCE as a live stream, instead of monitoring")
+    parser.add_argument("--speed", type=float, default=1.0,
+        help="with --replay, the speed relative to the capture (default 1.0, 0 for no limit)")
+    parser.add_argument("--loop", action="store_true",
+        help="with --replay, send the capture repeatedly")
+    args = parser.parse_args()
+
+    if args.replay is not None:
+        try:
+            asyncio.run(replay(args))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    # A server runs until interrupted, and then reports whether every stream passed
+    status = MonitorStatus()
+    try:
+        asyncio.run(monitor(args, status))
+    except KeyboardInterrupt:
+        pass
+    if not status.passed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,242 @@
 
+import itertools
 import typing
+import numpy
 from spdif_decode import RawDigitalSignal
+from stats import Stats
 
 
-def picoscope_decode(csv_file_name: str) -> typing.Tuple[RawDigitalSignal, float]:
-    # Read raw data
-    times = []
-    analogue = []
-    time_scale = 1e-6
-    for line in open(csv_file_name, "rt"):
-        fields = line.rstrip().split(",")
+TIME_SCALES = {
+    "(ms)": 1e-3,
+    "(us)": 1e-6,
+    "(ns)": 1e-9,
+}
+DEFAULT_CHUNK_SIZE = 1 << 20    # lines
+
+# The digitiser's thresholds are this factor above and below the signal midpoint
+HYSTERESIS = 1.1
+
+CSVChunk = typing.Tuple[numpy.ndarray, numpy.ndarray, float]
+
+def parse_csv_lines(lines: typing.List[str], time_scale: float) -> CSVChunk:
+    (times, analogue, time_scale) = parse_csv_columns(lines, time_scale, 1)
+    return (times, analogue[:, 0], time_scale)
+
+def parse_csv_columns(lines: typing.List[str], time_scale: float, num_channels: int) -> CSVChunk:
+    # As parse_csv_lines, for the first num_channels channels (columns after
+    # the time): the analogue data has one column for each channel
+    columns = tuple(range(num_channels + 1))
+
+    # Skip header lines, which contain the time units
+    start = 0
+    while start < len(lines):
+        fields = lines[start].rstrip().split(",")
         try:
-            t = float(fields[0])
-            v = float(fields[1])
+            for column in columns:
+                float(fields[column])
+            break
         except Exception:
-            if line.startswith("(ms)"):
-                time_scale = 1e-3
-            elif line.startswith("(us)"):
-                time_scale = 1e-6
-            elif line.startswith("(ns)"):
-                time_scale = 1e-9
+            for (unit, scale) in TIME_SCALES.items():
+                if lines[start].startswith(unit):
+                    time_scale = scale
+
+        start += 1
+
+    if start >= len(lines):
+        return (numpy.zeros(0), numpy.zeros((0, num_channels)), time_scale)
 
-            continue
+    # Read raw data (time and channel A, B, ...) in bulk
+    try:
+        data = numpy.loadtxt(lines[start:], delimiter=",", usecols=columns,
+                    ndmin=2, dtype=numpy.float64)
+    except ValueError:
+        # Some lines contain non-numeric values (e.g. "-∞" for
+        # an out of range voltage): skip those lines, as the
+        # line-by-line parser did
+        rows = []
+        for line in lines[start:]:
+            fields = line.rstrip().split(",")
+            try:
+                rows.append([float(fields[column]) for column in columns])
+            except Exception:
+                continue
+        data = numpy.array(rows, dtype=numpy.float64).reshape(-1, len(columns))
 
-        times.append(t)
-        analogue.append(v)
+    return (data[:, 0], data[:, 1:], time_scale)
+
+def read_csv_chunks(csv_file_name: str,
+            chunk_size: int = DEFAULT_CHUNK_SIZE) -> typing.Iterator[CSVChunk]:
+    for (times, analogue, time_scale) in read_csv_column_chunks(csv_file_name, 1, chunk_size):
+        yield (times, analogue[:, 0], time_scale)
+
+def read_csv_column_chunks(csv_file_name: str, num_channels: int,
+            chunk_size: int = DEFAULT_CHUNK_SIZE) -> typing.Iterator[CSVChunk]:
+    # Read the CSV file in chunks of at most chunk_size lines, so that
+    # memory use does not depend on the length of the capture. The time
+    # units from the header apply to all of the following chunks.
+    time_scale = 1e-6
+    with open(csv_file_name, "rt") as fd:
+        while True:
+            lines = list(itertools.islice(fd, chunk_size))
+            if len(lines) == 0:
+                return
+
+            (times, analogue, time_scale) = parse_csv_columns(lines, time_scale, num_channels)
+            if len(times) != 0:
+                yield (times, analogue, time_scale)
+
+def get_csv_channel_names(csv_file_name: str) -> typing.List[str]:
+    # The names of the channels, from the first line of the CSV file
+    # (e.g. "Time,Channel A,Channel B"), or numbers if there is no header
+    with open(csv_file_name, "rt") as fd:
+        fields = fd.readline().rstrip().split(",")
+    try:
+        float(fields[0])
+        return ["Channel {}".format(i + 1) for i in range(len(fields) - 1)]
+    except ValueError:
+        return [field.strip() for field in fields[1:]]
+
+def read_csv_file(csv_file_name: str) -> CSVChunk:
+    all_times = []
+    all_analogue = []
+    time_scale = 1e-6
+    for (times, analogue, time_scale) in read_csv_chunks(csv_file_name):
+        all_times.append(times)
+        all_analogue.append(analogue)
 
-    osc_period = time_scale * ((times[-1] - times[0]) / (len(times) - 1))
+    return (numpy.concatenate(all_times or [numpy.zeros(0)]),
+            numpy.concatenate(all_analogue or [numpy.zeros(0)]),
+            time_scale)
+
+class CaptureSummary:
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.minimum = float("inf")
+        self.maximum = float("-inf")
+        self.first_time = 0.0
+        self.last_time = 0.0
+        self.time_scale = 1e-6
+
+    def update(self, times: numpy.ndarray, analogue: numpy.ndarray, time_scale: float) -> None:
+        if self.count == 0:
+            self.first_time = float(times[0])
+        self.last_time = float(times[-1])
+        self.time_scale = time_scale
+        self.count += len(analogue)
+        self.total += float(analogue.sum())
+        self.minimum = min(self.minimum, float(analogue.min()))
+        self.maximum = max(self.maximum, float(analogue.max()))
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count
+
+    @property
+    def osc_period(self) -> float:
+        return self.time_scale * ((self.last_time - self.first_time) / (self.count - 1))
+
+def summarise_csv_file(csv_file_name: str,
+            chunk_size: int = DEFAULT_CHUNK_SIZE) -> CaptureSummary:
+    summary = CaptureSummary()
+    for (times, analogue, time_scale) in read_csv_chunks(csv_file_name, chunk_size):
+        summary.update(times, analogue, time_scale)
+    return summary
+
+def digitise(analogue: numpy.ndarray, threshold0: float, threshold1: float,
+            state: bool = False) -> RawDigitalSignal:
+    # Hysteresis: the state becomes True above threshold1, False below
+    # threshold0, and holds its previous value in between. So the output
+    # at each sample is the value at the most recent sample which was
+    # outside the hysteresis band.
+    high = analogue > threshold1
+    decided = high | (analogue < threshold0)
+    last_decided = numpy.where(decided, numpy.arange(len(analogue)), -1)
+    numpy.maximum.accumulate(last_decided, out=last_decided)
+    return numpy.where(last_decided >= 0, high[last_decided], state)
+
+def get_thresholds(average: float) -> typing.Tuple[float, float]:
+    threshold1 = average * HYSTERESIS
+    threshold0 = average / HYSTERESIS
+    return (threshold0, threshold1)
+
+class Digitiser:
+    def __init__(self, threshold0: float, threshold1: float) -> None:
+        self.threshold0 = threshold0
+        self.threshold1 = threshold1
+        self.state = False
+
+    def digitise(self, analogue: numpy.ndarray) -> RawDigitalSignal:
+        # The hysteresis state carries over from the previous chunk
+        digital = digitise(analogue, self.threshold0, self.threshold1, self.state)
+        if len(digital) != 0:
+            self.state = bool(digital[-1])
+        return digital
+
+def digitise_chunks(chunks: typing.Iterator[numpy.ndarray], digitiser: Digitiser,
+            stats: Stats) -> typing.Iterator[RawDigitalSignal]:
+    while True:
+        with stats.stage("parse"):
+            analogue = next(chunks, None)
+        if analogue is None:
+            return
+
+        with stats.stage("digitise"):
+            digital = digitiser.digitise(analogue)
+        yield digital
+
+def print_summary(summary: CaptureSummary) -> None:
+    osc_period = summary.osc_period
     osc_freq = 1.0 / osc_period
     print("Oscilloscope clock period {:1.3f} microseconds".format(osc_period * 1e6))
     print("Oscilloscope clock frequency {:1.3f} MHz".format(osc_freq / 1e6))
-    print("Signal peak-to-peak: {:1.3f} to {:1.3f}".format(min(analogue), max(analogue)))
+    print("Signal peak-to-peak: {:1.3f} to {:1.3f}".format(summary.minimum, summary.maximum))
+    print("Signal midpoint: {:1.3f}".format(summary.average))
+
+def picoscope_decode_chunks(csv_file_name: str,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+            stats: typing.Optional[Stats] = None,
+            ) -> typing.Tuple[typing.Iterator[RawDigitalSignal], float]:
+    stats = stats if stats is not None else Stats()
 
-    # Digitise
-    average = sum(analogue) / len(analogue)
-    threshold1 = average * 1.1
-    threshold0 = average / 1.1
-    print("Signal midpoint: {:1.3f}".format(average))
+    # First pass: get the timing and the signal level
+    with stats.stage("parse"):
+        summary = summarise_csv_file(csv_file_name, chunk_size)
+    print_summary(summary)
 
-    digital: RawDigitalSignal = []
-    state = False
-    for i in range(len(analogue)):
-        if analogue[i] > threshold1:
-            state = True
-        elif analogue[i] < threshold0:
-            state = False
+    # Second pass: digitise
+    digitiser = Digitiser(*get_thresholds(summary.average))
+    chunks = digitise_chunks(
+                (analogue for (_, analogue, _) in read_csv_chunks(csv_file_name, chunk_size)),
+                digitiser, stats)
+    return (chunks, summary.osc_period)
 
-        digital.append(state)
+def read_csv_channels(csv_file_name: str,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+            stats: typing.Optional[Stats] = None,
+            ) -> typing.Tuple[typing.List[str], numpy.ndarray, typing.List[CaptureSummary]]:
+    # Read every channel of the CSV file in one pass: the result has the
+    # names of the channels, the analogue data (one column for each channel)
+    # and a summary of each channel. The whole capture is kept in memory,
+    # because the signal level of each channel is needed before digitising.
+    stats = stats if stats is not None else Stats()
+    names = get_csv_channel_names(csv_file_name)
+    summaries = [CaptureSummary() for _ in names]
+    parts = []
+    with stats.stage("parse"):
+        for (times, analogue, time_scale) in read_csv_column_chunks(
+                    csv_file_name, len(names), chunk_size):
+            for (i, summary) in enumerate(summaries):
+                summary.update(times, analogue[:, i], time_scale)
+            parts.append(analogue)
 
-    return (digital, osc_period)
+    if len(parts) == 0:
+        raise ValueError("No data found in " + csv_file_name)
 
+    osc_period = summaries[0].osc_period
+    print("Oscilloscope clock period {:1.3f} microseconds".format(osc_period * 1e6))
+    print("Oscilloscope clock frequency {:1.3f} MHz".format(1.0 / osc_period / 1e6))
+    for (name, summary) in zip(names, summaries):
+        print("{}: signal peak-to-peak: {:1.3f} to {:1.3f}, midpoint: {:1.3f}".format(
+                name, summary.minimum, summary.maximum, summary.average))
+    return (names, numpy.concatenate(parts), summaries)
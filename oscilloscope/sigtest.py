@@ -1,8 +1,25 @@
 
+import argparse
+import concurrent.futures
+import contextlib
+import functools
+import io
+import json
+import os
 import sys
 import typing
-from picoscope_decode import picoscope_decode
-from spdif_decode import biphase_mark_decode, spdif_decode, AudioData
+import numpy
+from picoscope_decode import (DEFAULT_CHUNK_SIZE, digitise, get_thresholds,
+                picoscope_decode_chunks, read_csv_channels)
+from binary_capture import binary_decode_chunks
+from edge_cache import DEFAULT_CACHE_SIZE, CachedEdges, EdgeCache, parse_size
+from spdif_decode import (biphase_mark_decode, biphase_mark_decode_runs,
+                parallel_biphase_mark_decode_runs, spdif_decode, spdif_decode_chunks,
+                AudioData, RawDigitalSignal, RunLengths, RunLengthFinder, SPDIFDecoder,
+                join_audio_data)
+from channel_status import ChannelStatusDecoder
+from stats import MAX_EXAMPLES, Stats
+from wav_file import get_24_bit_samples, load_wav_file
 
 
 PAYLOAD = [
@@ -24,6 +41,12 @@ MARKER_VALUE = 0x654321
 MARKER_MASK = 0xfff000
 REPEAT_SIZE = 40
 MASK_16 = 0xffff00
+MASK_24 = 0xffffff
+WALKING_1S_SIZE = 24
+PAYLOAD_16_POSITION = 25
+PAYLOAD_24_POSITION = 32
+CAPTURE_EXTENSIONS = (".csv", ".bin")
+FPGA_APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fpga", "app")
 
 def int_conv(unsigned_data: int, bits: int) -> int:
     assert 0 <= unsigned_data < (1 << bits)
@@ -40,8 +63,8 @@ def examine_walking_1s(samples: AudioData, bits: int) -> typing.Tuple[bool, int]
     for i in range(24):
         left = 1 << i
         right = left ^ 0xffffff
-        left_delta = abs(int_conv(left >> shift, bits) - int_conv(samples[i].left >> shift, bits))
-        right_delta = abs(int_conv(right >> shift, bits) - int_conv(samples[i].right >> shift, bits))
+        left_delta = abs(int_conv(left >> shift, bits) - int_conv(int(samples[i].left) >> shift, bits))
+        right_delta = abs(int_conv(right >> shift, bits) - int_conv(int(samples[i].right) >> shift, bits))
 
         if (left_delta > 1) or (right_delta > 1):
             # Too much error
@@ -55,13 +78,150 @@ def examine_walking_1s(samples: AudioData, bits: int) -> typing.Tuple[bool, int]
 
     return (small_error, incorrect)
 
-def examine_audio_data(audio: AudioData) -> bool:
+class PatternReport:
+    # Results of checking every repetition of the test pattern
+    def __init__(self) -> None:
+        self.num_frames = 0
+        self.num_blocks = 0                 # including partial blocks at each end
+        self.left_bit_errors = numpy.zeros(24, dtype=numpy.int64)   # per bit position
+        self.right_bit_errors = numpy.zeros(24, dtype=numpy.int64)
+        self.clean_16_bit = numpy.zeros(0, dtype=bool)  # verdict for each block
+        self.clean_24_bit = numpy.zeros(0, dtype=bool)
+        self.first_16_bit_failures: typing.List[int] = []  # frame numbers
+        self.first_24_bit_failures: typing.List[int] = []
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        return {
+            "frames": self.num_frames,
+            "blocks": self.num_blocks,
+            "blocks_16_bit_clean": int(numpy.count_nonzero(self.clean_16_bit)),
+            "blocks_24_bit_clean": int(numpy.count_nonzero(self.clean_24_bit)),
+            "left_bit_errors": [int(count) for count in self.left_bit_errors],
+            "right_bit_errors": [int(count) for count in self.right_bit_errors],
+            "first_16_bit_failures": list(self.first_16_bit_failures),
+            "first_24_bit_failures": list(self.first_24_bit_failures),
+        }
+
+class Verdict:
+    def __init__(self) -> None:
+        self.passed = False
+        self.clean_bits = 0     # 16 or 24 if the signal is clean to that depth
+        self.sample_rate = 0    # sample rate given in the test data
+        self.reason = ""        # reason for failure
+        self.pattern: typing.Optional[PatternReport] = None
+        self.reference_offset: typing.Optional[int] = None
+
+def get_pattern_block(sample_rate: int) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+    # Expected left and right samples for one repetition of the test pattern
+    left = numpy.zeros(REPEAT_SIZE, dtype=numpy.int64)
+    right = numpy.zeros(REPEAT_SIZE, dtype=numpy.int64)
+    for i in range(WALKING_1S_SIZE):
+        left[i] = 1 << i
+        right[i] = (1 << i) ^ 0xffffff
+
+    left[TRUE_MARKER_POSITION] = (sample_rate // 100) << 8
+    right[TRUE_MARKER_POSITION] = MARKER_VALUE
+
+    j = 0
+    for i in range(PAYLOAD_16_POSITION, PAYLOAD_24_POSITION):
+        left[i] = (PAYLOAD[j + 0] << 16) | (PAYLOAD[j + 1] << 8)
+        right[i] = (PAYLOAD[j + 2] << 16) | (PAYLOAD[j + 3] << 8)
+        j += 4
+
+    for i in range(PAYLOAD_24_POSITION, REPEAT_SIZE):
+        left[i] = (PAYLOAD[j + 0] << 16) | (PAYLOAD[j + 1] << 8) | (PAYLOAD[j + 2] << 0)
+        right[i] = (PAYLOAD[j + 3] << 16) | (PAYLOAD[j + 4] << 8) | (PAYLOAD[j + 5] << 0)
+        j += 6
+
+    return (left, right)
+
+def get_pattern_tolerance(bits: int) -> numpy.ndarray:
+    # Error allowed at each position in the test pattern (in units of the
+    # least significant bit), as in examine_walking_1s. The marker and the
+    # payload must be exact, except that 24-bit data may be rounded to 16 bits.
+    tolerance = numpy.zeros(REPEAT_SIZE, dtype=numpy.int64)
+    tolerance[:WALKING_1S_SIZE] = 1
+    if bits == 16:
+        tolerance[PAYLOAD_24_POSITION:] = 1
+    return tolerance
+
+def get_sample_errors(got: numpy.ndarray, expect: numpy.ndarray, bits: int) -> numpy.ndarray:
+    # Vectorised equivalent of the int_conv comparison in examine_walking_1s
+    shift = 24 - bits
+    sign = 1 << (bits - 1)
+    got = got >> shift
+    expect = expect >> shift
+    errors: numpy.ndarray = numpy.abs((got - ((got & sign) << 1)) - (expect - ((expect & sign) << 1)))
+    return errors
+
+def verify_pattern(audio: AudioData, marker_position: int, sample_rate: int) -> PatternReport:
+    # Compare every frame with the test pattern, aligned using the marker.
+    # Block 0 begins at the first frame (it may be a partial block), and
+    # each following block begins at position 0 in the pattern.
+    report = PatternReport()
+    report.num_frames = len(audio)
+    if len(audio) == 0:
+        return report
+
+    frames = numpy.arange(len(audio))
+    start = (marker_position - TRUE_MARKER_POSITION) % REPEAT_SIZE
+    position = (frames - start) % REPEAT_SIZE
+    block = (frames + ((REPEAT_SIZE - start) % REPEAT_SIZE)) // REPEAT_SIZE
+    report.num_blocks = int(block[-1]) + 1
+
+    (left_block, right_block) = get_pattern_block(sample_rate)
+    left = audio.left.astype(numpy.int64)
+    right = audio.right.astype(numpy.int64)
+    expect_left = left_block[position]
+    expect_right = right_block[position]
+
+    # Errors in each bit position
+    left_xor = left ^ expect_left
+    right_xor = right ^ expect_right
+    for i in range(24):
+        report.left_bit_errors[i] = numpy.count_nonzero(left_xor & (1 << i))
+        report.right_bit_errors[i] = numpy.count_nonzero(right_xor & (1 << i))
+
+    # Verdict for each block and each bit depth
+    for bits in (16, 24):
+        tolerance = get_pattern_tolerance(bits)[position]
+        failed = ((get_sample_errors(left, expect_left, bits) > tolerance)
+                | (get_sample_errors(right, expect_right, bits) > tolerance))
+        clean = numpy.bincount(block[failed], minlength=report.num_blocks) == 0
+        first_failures = [int(frame) for frame in numpy.flatnonzero(failed)[:MAX_EXAMPLES]]
+        if bits == 16:
+            report.clean_16_bit = clean
+            report.first_16_bit_failures = first_failures
+        else:
+            report.clean_24_bit = clean
+            report.first_24_bit_failures = first_failures
+
+    return report
+
+def report_pattern(audio: AudioData, report: PatternReport) -> None:
+    print("Checked {} frames in {} blocks: {} blocks are 16-bit clean, "
+            "{} blocks are 24-bit clean".format(report.num_frames, report.num_blocks,
+            numpy.count_nonzero(report.clean_16_bit),
+            numpy.count_nonzero(report.clean_24_bit)))
+
+    for (name, bit_errors) in (("left", report.left_bit_errors),
+                                ("right", report.right_bit_errors)):
+        if numpy.any(bit_errors != 0):
+            print("Bit errors ({}), bit 23 to bit 0: {}".format(name,
+                    " ".join(str(count) for count in bit_errors[::-1])))
+
+    for (bits, first_failures) in ((16, report.first_16_bit_failures),
+                                    (24, report.first_24_bit_failures)):
+        for frame in first_failures:
+            print("{}-bit error at frame {}: got {:06x} {:06x}".format(
+                    bits, frame, audio[frame].left, audio[frame].right))
+
+def examine_audio_data(audio: AudioData) -> Verdict:
     # Find the marker
     marker_position = -1
-    for i in range(len(audio)):
-        if (audio[i].right & MARKER_MASK) == (MARKER_VALUE & MARKER_MASK):
-            marker_position = i
-            break
+    found = numpy.flatnonzero((audio.right & MARKER_MASK) == (MARKER_VALUE & MARKER_MASK))
+    if len(found) != 0:
+        marker_position = int(found[0])
 
     if marker_position < 0:
         print("Unable to find the {:06x} marker within the audio data".format(
@@ -77,10 +237,36 @@ def examine_audio_data(audio: AudioData) -> bool:
                         "reduced to {:1.3f}: sample rate {:1.0f} Hz ?".format(
                     i, scale, (left / scale) * 100))
 
-        return False
+        verdict = Verdict()
+        verdict.reason = "marker not found"
+        return verdict
+
+    # Check the first repetition of the pattern in detail
+    verdict = examine_block(audio, marker_position)
+
+    # Then check every repetition
+    report = verify_pattern(audio, marker_position, verdict.sample_rate)
+    report_pattern(audio, report)
+    verdict.pattern = report
+
+    if (verdict.clean_bits >= 16) and not numpy.all(report.clean_16_bit):
+        verdict.passed = False
+        verdict.clean_bits = 0
+        verdict.reason = "16-bit error in block {}".format(
+                int(numpy.argmin(report.clean_16_bit)))
+    elif (verdict.clean_bits >= 24) and not numpy.all(report.clean_24_bit):
+        verdict.passed = False
+        verdict.clean_bits = 16
+        verdict.reason = "24-bit error in block {}".format(
+                int(numpy.argmin(report.clean_24_bit)))
+
+    return verdict
+
+def examine_block(audio: AudioData, marker_position: int) -> Verdict:
+    verdict = Verdict()
 
     # Rearrange data
-    samples: AudioData = []
+    indices: typing.List[int] = []
     for i in range(REPEAT_SIZE):
         j = i + marker_position - TRUE_MARKER_POSITION
         if j < 0:
@@ -89,10 +275,13 @@ def examine_audio_data(audio: AudioData) -> bool:
             j -= REPEAT_SIZE
         assert 0 <= j < len(audio)
 
-        samples.append(audio[j])
+        indices.append(j)
+
+    samples = audio[indices].view(numpy.recarray)
 
     assert (samples[TRUE_MARKER_POSITION].right & MARKER_MASK) == (MARKER_VALUE & MARKER_MASK)
-    print("Sample rate of test data: {} Hz".format((samples[TRUE_MARKER_POSITION].left >> 8) * 100))
+    verdict.sample_rate = int(samples[TRUE_MARKER_POSITION].left >> 8) * 100
+    print("Sample rate of test data: {} Hz".format(verdict.sample_rate))
 
     # Check walking 1s (16 bit mode)
     (small_error, incorrect) = examine_walking_1s(samples, 16)
@@ -123,10 +312,12 @@ def examine_audio_data(audio: AudioData) -> bool:
             print("at {} (16-bit): expect {:06x} {:06x}  got {:06x} {:06x}".format(
                     i, left, right, samples[i].left, samples[i].right))
             print("Error in 16-bit payload part, position {}: signal is not 16-bit clean".format(i))
-            return False
+            verdict.reason = "16-bit payload error"
+            return verdict
         j += 4
 
     print("Correct 16-bit payload part: signal is 16-bit clean")
+    verdict.clean_bits = 16
 
     # Final part of the repeating block: 24 bit data (8 samples)
     for i in range(32, REPEAT_SIZE):
@@ -136,39 +327,417 @@ def examine_audio_data(audio: AudioData) -> bool:
             print("at {} (24-bit): expect {:06x} {:06x}  got {:06x} {:06x}".format(
                     i, left, right, samples[i].left, samples[i].right))
             print("Error in 24-bit payload part, position {}: signal is not 24-bit clean".format(i))
-            return False
+            verdict.reason = "24-bit payload error"
+            return verdict
         j += 6
 
     if incorrect < 0:
         print("Correct 24-bit payload part: signal is 24-bit clean")
+        verdict.clean_bits = 24
     else:
         print("Correct 24-bit payload part but error in walking ones: signal is not 24-bit clean")
 
-    return True
-
-def main() -> None:
-    if len(sys.argv) != 2:
-        print("Usage: sigtest.py <input.csv>")
-        sys.exit(1)
-
-    (digital, osc_period) = picoscope_decode(sys.argv[1])
-    packets = biphase_mark_decode(digital, osc_period)
-    (audio, subcode_data) = spdif_decode(packets)
-
+    verdict.passed = True
+    return verdict
+
+def get_signed_samples(samples: numpy.ndarray) -> numpy.ndarray:
+    # Unsigned 24-bit samples to signed values
+    samples = samples.astype(numpy.int64)
+    signed: numpy.ndarray = samples - ((samples & 0x800000) << 1)
+    return signed
+
+def find_reference_offset(audio: AudioData, reference: numpy.ndarray) -> int:
+    # Find the position of the audio data within the reference (unsigned 24-bit
+    # samples, one row per frame, two channels), such that audio[i] matches
+    # reference[i + offset]. The cross-correlation of the two signals is found
+    # using the FFT, for every offset at which at least half of the shorter
+    # signal overlaps the longer one, and the offset with the highest correlation
+    # is chosen. If the audio data is repetitive, any matching offset may be chosen.
+    size = 1
+    while size < (len(audio) + len(reference) - 1):
+        size *= 2
+
+    product = numpy.zeros((size // 2) + 1, dtype=numpy.complex128)
+    for (got, expect) in ((audio.left, reference[:, 0]), (audio.right, reference[:, 1])):
+        product += (numpy.fft.rfft(get_signed_samples(expect), size)
+                    * numpy.conj(numpy.fft.rfft(get_signed_samples(got), size)))
+    correlation = numpy.fft.irfft(product, size)
+
+    offsets = numpy.arange(1 - len(audio), len(reference))
+    overlap = (numpy.minimum(len(reference), offsets + len(audio))
+                - numpy.maximum(0, offsets))
+    valid = overlap >= max(1, min(len(audio), len(reference)) // 2)
+    scores = numpy.where(valid, correlation[offsets % size], -numpy.inf)
+    return int(offsets[numpy.argmax(scores)])
+
+def compare_with_reference(audio: AudioData, reference: numpy.ndarray) -> Verdict:
+    # Compare the audio data with the reference, after aligning them
+    verdict = Verdict()
+    if (len(audio) == 0) or (len(reference) == 0):
+        verdict.reason = "no audio data to compare"
+        return verdict
+
+    offset = find_reference_offset(audio, reference)
+    start = max(0, -offset)
+    end = min(len(audio), len(reference) - offset)
+    got_left = audio.left[start:end].astype(numpy.int64)
+    got_right = audio.right[start:end].astype(numpy.int64)
+    expect_left = reference[start + offset:end + offset, 0].astype(numpy.int64)
+    expect_right = reference[start + offset:end + offset, 1].astype(numpy.int64)
+    verdict.reference_offset = offset
+    print("Audio data frame {} matches reference frame {}: comparing {} frames".format(
+            start, start + offset, end - start))
+
+    # Frames which are not exact, not 16-bit clean, or differ by more than
+    # 1 bit (as for the walking 1s) at 16 bits or 24 bits
+    not_exact = (got_left != expect_left) | (got_right != expect_right)
+    not_16_bit = (((got_left ^ expect_left) | (got_right ^ expect_right)) & MASK_16) != 0
+    rounding: typing.Dict[int, numpy.ndarray] = {}
+    for bits in (16, 24):
+        rounding[bits] = ((get_sample_errors(got_left, expect_left, bits) > 1)
+                        | (get_sample_errors(got_right, expect_right, bits) > 1))
+
+    for frame in numpy.flatnonzero(not_exact)[:MAX_EXAMPLES]:
+        print("at {}: expect {:06x} {:06x}  got {:06x} {:06x}".format(start + frame,
+                expect_left[frame], expect_right[frame], got_left[frame], got_right[frame]))
+
+    print("Frames which are not exact: {}".format(numpy.count_nonzero(not_exact)))
+    print("Frames which are not 16-bit clean: {}".format(numpy.count_nonzero(not_16_bit)))
+    for bits in (16, 24):
+        print("Frames with more than +/- 1 bit error at {}-bit: {}".format(
+                bits, numpy.count_nonzero(rounding[bits])))
+
+    if not numpy.any(not_exact):
+        print("Exact match with the reference: signal is 24-bit clean")
+        verdict.clean_bits = 24
+        verdict.passed = True
+    elif not numpy.any(not_16_bit):
+        print("Match with the reference for 16-bit: signal is 16-bit clean")
+        verdict.clean_bits = 16
+        verdict.reason = "24-bit mismatch with reference"
+    elif not numpy.any(rounding[16]):
+        print("Match with the reference for 16-bit with at most +/- 1 bit error")
+        verdict.reason = "16-bit rounding error"
+    else:
+        print("Audio data does not match the reference")
+        verdict.reason = "mismatch with reference"
+    return verdict
+
+def load_reference(wav_file_name: str) -> numpy.ndarray:
+    (samples, wav_format) = load_wav_file(wav_file_name)
+    if wav_format.channels != 2:
+        raise ValueError("Reference WAV file must have 2 channels")
+    print("Reference: {} frames at {} Hz, {} bits".format(wav_format.num_frames,
+            wav_format.sample_rate, wav_format.bits_per_sample))
+    return get_24_bit_samples(samples)
+
+def read_capture_chunks(file_name: str, stats: typing.Optional[Stats] = None,
+            ) -> typing.Tuple[typing.Iterator[RawDigitalSignal], float]:
+    if file_name.lower().endswith(".bin"):
+        return binary_decode_chunks(file_name, DEFAULT_CHUNK_SIZE, stats)
+    else:
+        return picoscope_decode_chunks(file_name, DEFAULT_CHUNK_SIZE, stats)
+
+def read_capture_runs(file_name: str, stats: Stats,
+            cache: typing.Optional[EdgeCache] = None,
+            ) -> typing.Tuple[RunLengths, int, float]:
+    # The run lengths of the digitised signal, the position of the first edge
+    # and the oscilloscope sample period: from the cache, if possible
+    key = None
+    if cache is not None:
+        with stats.stage("cache"):
+            key = cache.get_key(file_name)
+            edges = cache.load(key)
+        if edges is not None:
+            stats.count("cache_hit")
+            print("Oscilloscope clock period {:1.3f} microseconds".format(edges.osc_period * 1e6))
+            print("Oscilloscope clock frequency {:1.3f} MHz".format(1.0 / edges.osc_period / 1e6))
+            print("Digitised signal from the cache: {} runs".format(len(edges.runs)))
+            return (edges.runs, edges.first_edge, edges.osc_period)
+        stats.count("cache_miss")
+
+    (chunks, osc_period) = read_capture_chunks(file_name, stats)
+    finder = RunLengthFinder()
+    parts = []
+    for digital in chunks:
+        with stats.stage("bmc"):
+            parts.append(finder.feed(digital))
+    runs = numpy.concatenate(parts or [numpy.zeros(0, dtype=numpy.int64)])
+    first_edge = finder.first_edge if finder.first_edge is not None else 0
+    if (cache is not None) and (key is not None):
+        with stats.stage("cache"):
+            cache.store(key, CachedEdges(runs, first_edge, osc_period))
+    return (runs, first_edge, osc_period)
+
+def test_capture(file_name: str, stats: Stats,
+            parallel: bool = False, jobs: typing.Optional[int] = None,
+            adaptive: bool = False, reference: typing.Optional[str] = None,
+            matcher: bool = False, cache: typing.Optional[EdgeCache] = None) -> Verdict:
+    status = ChannelStatusDecoder(stats)
+    if parallel or (cache is not None):
+        # The run lengths of the whole capture are needed
+        (runs, first_edge, osc_period) = read_capture_runs(file_name, stats, cache)
+        if parallel:
+            packets = parallel_biphase_mark_decode_runs(runs, first_edge, osc_period, jobs,
+                            stats=stats, adaptive=adaptive)
+        else:
+            packets = biphase_mark_decode_runs(runs, first_edge, osc_period, stats, adaptive)
+        (audio, subcode_data) = spdif_decode(packets, stats, status)
+    else:
+        # Decode one chunk at a time, without holding the whole capture
+        (chunks, osc_period) = read_capture_chunks(file_name, stats)
+        (audio, subcode_data) = spdif_decode_chunks(chunks, osc_period, stats, status, adaptive)
+    if status.last is not None:
+        print("Channel status ({} blocks): {}".format(status.num_blocks, status.last.describe()))
+        print("Channel status register (D2 debug mode): {:08x}".format(
+                status.last.subcode_register()))
+        if "status_changed" in stats.counters:
+            print("Channel status changed: {} times".format(stats.counters["status_changed"]))
 
     print("Audio data received:")
     for sample in audio:
         print("{:06x} {:06x}".format(sample.left, sample.right))
 
+    if matcher:
+        # The model of the FPGA matcher is in FPGA_APP_DIR, which main() adds to the path
+        from matcher_model import describe_changes, interleave, model_matcher
+        (data, is_left) = interleave(audio.left, audio.right)
+        changes = describe_changes(model_matcher(data, is_left), is_left)
+        if len(changes) == 0:
+            print("FPGA matcher: never synchronised (a whole block after the marker is needed)")
+        for line in changes:
+            print("FPGA " + line)
+
     if len(audio) <= REPEAT_SIZE:
         print("Insufficient samples captured (need more than {})".format(REPEAT_SIZE))
-        sys.exit(1)
+        verdict = Verdict()
+        verdict.reason = "insufficient samples"
+        return verdict
 
     # remove final sample (may be incomplete)
-    audio.pop()
+    audio = audio[:-1].view(numpy.recarray)
 
     # analyse
-    if not examine_audio_data(audio):
+    with stats.stage("check"):
+        if reference is not None:
+            return compare_with_reference(audio, load_reference(reference))
+        return examine_audio_data(audio)
+
+def check_pieces(file_name: str, piece_size: int, stats: Stats,
+            adaptive: bool = False) -> bool:
+    # Decode the capture with the incremental decoder, in pieces of the given
+    # size and then in one piece: the audio data should be the same
+    (chunks, _) = read_capture_chunks(file_name, stats)
+    digital = numpy.concatenate(list(chunks) or [numpy.zeros(0, dtype=bool)])
+    whole = SPDIFDecoder(stats=Stats(), adaptive=adaptive)
+    expect = join_audio_data([whole.feed(digital), whole.flush()])
+    decoder = SPDIFDecoder(stats=stats, adaptive=adaptive)
+    output = [decoder.feed(digital[start:start + piece_size])
+              for start in range(0, len(digital), piece_size)]
+    output.append(decoder.flush())
+    got = join_audio_data(output)
+
+    if (len(got) == len(expect)) and numpy.array_equal(got.left, expect.left) \
+            and numpy.array_equal(got.right, expect.right):
+        print("Decoded in pieces of {} samples: {} frames, same as in one piece".format(
+                piece_size, len(got)))
+        return True
+    print("Decoded in pieces of {} samples: {} frames, but {} frames in one piece{}".format(
+            piece_size, len(got), len(expect),
+            "" if len(got) != len(expect) else " (with different samples)"))
+    return False
+
+def decode_channel(analogue: numpy.ndarray, average: float, osc_period: float,
+            adaptive: bool = False) -> typing.Tuple[AudioData, str, Stats]:
+    # Digitise and decode one channel of a capture in a worker process:
+    # the result includes the output, so that it is not mixed up with
+    # the output for other channels
+    stats = Stats()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        with stats.stage("digitise"):
+            digital = digitise(analogue, *get_thresholds(average))
+        packets = biphase_mark_decode(digital, osc_period, stats, adaptive)
+        status = ChannelStatusDecoder(stats)
+        (audio, _) = spdif_decode(packets, stats, status)
+        if status.last is not None:
+            print("Channel status ({} blocks): {}".format(status.num_blocks, status.last.describe()))
+        print("Audio data received: {} frames".format(len(audio)))
+    return (audio, output.getvalue(), stats)
+
+def test_channels(file_name: str, stats: Stats, jobs: typing.Optional[int] = None,
+            adaptive: bool = False) -> bool:
+    # Decode every channel of a CSV capture, e.g. the source and the output of each
+    # stage of a chain of devices, and compare each channel with the one before it,
+    # in order to find the first stage which is not bit-exact
+    if file_name.lower().endswith(".bin"):
+        raise ValueError("Binary captures have only one channel")
+
+    (names, analogue, summaries) = read_csv_channels(file_name, stats=stats)
+    osc_period = summaries[0].osc_period
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(decode_channel, analogue[:, i], summary.average,
+                                   osc_period, adaptive)
+                   for (i, summary) in enumerate(summaries)]
+        decoded = [future.result() for future in futures]
+
+    all_audio = []
+    for (name, (audio, output, channel_stats)) in zip(names, decoded):
+        print("{}:".format(name))
+        print(output, end="")
+        stats.merge(channel_stats)
+        all_audio.append(audio[:-1].view(numpy.recarray))    # remove final sample (may be incomplete)
+
+    # Compare each pair of neighbouring channels, sample by sample
+    first_failure = None
+    with stats.stage("check"):
+        for i in range(1, len(names)):
+            print("Comparing {} with {}:".format(names[i], names[i - 1]))
+            reference = numpy.column_stack((all_audio[i - 1].left, all_audio[i - 1].right))
+            verdict = compare_with_reference(all_audio[i], reference)
+            if (not verdict.passed) and (first_failure is None):
+                first_failure = (names[i - 1], names[i], verdict.reason)
+
+    if len(names) < 2:
+        print("Only one channel: nothing to compare")
+        return False
+    if first_failure is not None:
+        print("Bit-exactness is lost between {} and {}: {}".format(*first_failure))
+        return False
+    print("All channels match exactly")
+    return True
+
+def batch_test_capture(file_name: str, adaptive: bool = False,
+            reference: typing.Optional[str] = None,
+            cache: typing.Optional[EdgeCache] = None) -> typing.Dict[str, typing.Any]:
+    # Test a capture without printing anything: the result is a summary
+    summary: typing.Dict[str, typing.Any] = {"file": file_name}
+    stats = Stats()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            verdict = test_capture(file_name, stats, adaptive=adaptive, reference=reference,
+                                   cache=cache)
+    except Exception as e:
+        verdict = Verdict()
+        verdict.reason = "{}: {}".format(type(e).__name__, e)
+
+    summary["passed"] = verdict.passed
+    summary["clean_bits"] = verdict.clean_bits
+    summary["sample_rate"] = verdict.sample_rate
+    summary["reason"] = verdict.reason
+    if verdict.pattern is not None:
+        summary["pattern"] = verdict.pattern.to_json()
+    if verdict.reference_offset is not None:
+        summary["reference_offset"] = verdict.reference_offset
+    summary["stats"] = stats.to_json()
+    return summary
+
+def find_captures(paths: typing.List[str]) -> typing.List[str]:
+    file_names: typing.List[str] = []
+    for path in paths:
+        if os.path.isdir(path):
+            for (root, _, names) in os.walk(path):
+                for name in names:
+                    if os.path.splitext(name)[1].lower() in CAPTURE_EXTENSIONS:
+                        file_names.append(os.path.join(root, name))
+        else:
+            file_names.append(path)
+
+    return sorted(file_names)
+
+def batch_main(paths: typing.List[str], jobs: typing.Optional[int],
+            summary_file_name: typing.Optional[str], adaptive: bool = False,
+            reference: typing.Optional[str] = None,
+            cache: typing.Optional[EdgeCache] = None) -> bool:
+    file_names = find_captures(paths)
+    all_passed = True
+    with contextlib.ExitStack() as stack:
+        fd = sys.stdout
+        if summary_file_name is not None:
+            fd = stack.enter_context(open(summary_file_name, "wt"))
+
+        # One JSON line per capture, in the order given
+        executor = stack.enter_context(
+            concurrent.futures.ProcessPoolExecutor(max_workers=jobs))
+        for summary in executor.map(functools.partial(batch_test_capture,
+                    adaptive=adaptive, reference=reference, cache=cache), file_names):
+            fd.write(json.dumps(summary) + "\n")
+            fd.flush()
+            all_passed = all_passed and summary["passed"]
+
+    return all_passed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Check S/PDIF oscilloscope captures for bit-exactness")
+    parser.add_argument("captures", nargs="+", metavar="input.csv | input.bin",
+        help="capture file (or, in batch mode, capture files and directories)")
+    parser.add_argument("--batch", action="store_true",
+        help="test many captures in parallel, writing a JSON summary line for each")
+    parser.add_argument("--parallel", action="store_true",
+        help="decode a single large capture in parallel segments")
+    parser.add_argument("--jobs", "-j", type=int,
+        help="number of worker processes for --batch or --parallel "
+            "(default: number of CPUs)")
+    parser.add_argument("--adaptive", action="store_true",
+        help="estimate the S/PDIF clock from the start of the capture, "
+            "then track it while decoding (for captures with clock drift)")
+    parser.add_argument("--reference", metavar="WAV",
+        help="compare the audio data with a reference WAV file, "
+            "instead of looking for the test pattern")
+    parser.add_argument("--matcher", action="store_true",
+        help="show the output of a model of the FPGA matcher for the audio data")
+    parser.add_argument("--channels", action="store_true",
+        help="decode every channel of a CSV capture in parallel, and compare each channel "
+            "with the one before it (e.g. the source, then the output of each stage)")
+    parser.add_argument("--pieces", type=int, metavar="SIZE",
+        help="check that decoding the capture in pieces of SIZE samples gives "
+            "the same audio data as decoding it in one piece")
+    parser.add_argument("--summary", metavar="FILE",
+        help="write the batch mode summary to FILE instead of standard output")
+    parser.add_argument("--cache", metavar="DIR",
+        help="keep digitised captures in DIR, so that each capture is parsed only once")
+    parser.add_argument("--cache-size", type=parse_size, default=DEFAULT_CACHE_SIZE,
+        metavar="MB", help="maximum size of the cache (default {} MB)".format(
+            DEFAULT_CACHE_SIZE >> 20))
+    parser.add_argument("--stats", metavar="FILE",
+        help="write counters and timing for each stage to FILE as JSON "
+            "(use - for standard output)")
+    args = parser.parse_args()
+
+    cache = EdgeCache(args.cache, args.cache_size) if args.cache is not None else None
+    if (args.pieces is not None) and (args.pieces < 1):
+        parser.error("--pieces must be at least 1")
+    if args.channels and (args.batch or args.parallel):
+        parser.error("--channels cannot be used with --batch or --parallel")
+    if args.batch:
+        if not batch_main(args.captures, args.jobs, args.summary, args.adaptive,
+                          args.reference, cache):
+            sys.exit(1)
+        return
+
+    if len(args.captures) != 1:
+        parser.error("only one capture can be tested, unless --batch is used")
+    if args.matcher:
+        sys.path.append(FPGA_APP_DIR)
+
+    stats = Stats()
+    if args.pieces is not None:
+        passed = check_pieces(args.captures[0], args.pieces, stats, args.adaptive)
+    elif args.channels:
+        passed = test_channels(args.captures[0], stats, args.jobs, args.adaptive)
+    else:
+        passed = test_capture(args.captures[0], stats, args.parallel, args.jobs,
+                              args.adaptive, args.reference, args.matcher, cache).passed
+
+    if args.stats == "-":
+        print(json.dumps(stats.to_json(), indent=4))
+    elif args.stats is not None:
+        with open(args.stats, "wt") as fd:
+            json.dump(stats.to_json(), fd, indent=4)
+            fd.write("\n")
+
+    if not passed:
         sys.exit(1)
 
 
@@ -1,18 +1,71 @@
 
-import collections
+import concurrent.futures
 import enum
+import sys
 import typing
-
-
-RawDigitalSignal = typing.List[bool]
-RawSPDIFPackets = typing.List[typing.List[bool]] 
-RawSubcodeData = typing.List[bool]
-
-class Sample:
-    left = 0
-    right = 0
-
-AudioData = typing.List[Sample]
+import numpy
+from channel_status import ChannelStatusDecoder
+from stats import Stats
+
+
+RawDigitalSignal = numpy.ndarray
+RunLengths = numpy.ndarray
+PulseWidths = numpy.ndarray
+RawSubcodeData = numpy.ndarray
+
+class Preamble(enum.IntEnum):
+    NONE = 0
+    B = 1
+    M = 2
+    W = 3
+
+class RawSPDIFPackets:
+    # One packet per subframe. Bit i of each subframe is time slot i of the
+    # packet, so bits 0-3 are the preamble, 4-27 are audio data (LSB first),
+    # 28 is validity, 29 is user data, 30 is channel status and 31 is parity.
+    # The preamble kind is stored separately, as is the number of time slots
+    # received, which is less than 32 for an incomplete packet, and the
+    # position (sample number) of the end of the preamble.
+    def __init__(self, preambles: numpy.ndarray, subframes: numpy.ndarray,
+                sizes: numpy.ndarray, positions: numpy.ndarray) -> None:
+        self.preambles = preambles
+        self.subframes = subframes
+        self.sizes = sizes
+        self.positions = positions
+
+    def __len__(self) -> int:
+        return len(self.subframes)
+
+    def select(self, index: numpy.ndarray) -> "RawSPDIFPackets":
+        return RawSPDIFPackets(self.preambles[index], self.subframes[index],
+                    self.sizes[index], self.positions[index])
+
+SAMPLE_DTYPE = numpy.dtype([("left", numpy.uint32), ("right", numpy.uint32)])
+
+# Audio data is a record array with "left" and "right" fields,
+# so audio[i].left and audio.left both work
+AudioData = numpy.recarray
+
+def new_packets(preambles: typing.Sequence[int] = (),
+            subframes: typing.Sequence[int] = (),
+            sizes: typing.Sequence[int] = (),
+            positions: typing.Sequence[int] = ()) -> RawSPDIFPackets:
+    return RawSPDIFPackets(numpy.array(preambles, dtype=numpy.uint8),
+                numpy.array(subframes, dtype=numpy.uint32),
+                numpy.array(sizes, dtype=numpy.int64),
+                numpy.array(positions, dtype=numpy.int64))
+
+def join_packets(parts: typing.List[RawSPDIFPackets]) -> RawSPDIFPackets:
+    return RawSPDIFPackets(numpy.concatenate([p.preambles for p in parts]),
+                numpy.concatenate([p.subframes for p in parts]),
+                numpy.concatenate([p.sizes for p in parts]),
+                numpy.concatenate([p.positions for p in parts]))
+
+def new_audio_data(size: int) -> AudioData:
+    return numpy.zeros(size, dtype=SAMPLE_DTYPE).view(numpy.recarray)
+
+def join_audio_data(parts: typing.List[AudioData]) -> AudioData:
+    return numpy.concatenate([new_audio_data(0)] + parts).view(numpy.recarray)
 
 class SyncState(enum.Enum):
     NONE = enum.auto()
@@ -25,35 +78,104 @@ class SyncState(enum.Enum):
     W_FOOTER = enum.auto()
     DESYNC = enum.auto()
 
-B_PACKET = [True, False, False, False]
-M_PACKET = [False, False, True, False]
-W_PACKET = [False, True, False, False]
+# Preamble time slots, as bits 0-3 of a subframe
+PREAMBLE_BITS = {
+    Preamble.B: 0b0001,
+    Preamble.M: 0b0100,
+    Preamble.W: 0b0010,
+}
+SUBFRAME_SIZE = 32
+AUDIO_SHIFT = 4
+AUDIO_MASK = 0xffffff
+VALIDITY_BIT = 28
+USER_BIT = 29
+STATUS_BIT = 30
+
+# Messages for the errors detected by SubframeDecoder, in the order they are checked
+PACKET_ERRORS = {
+    "wrong_size": "Malformed packet - wrong size (skip)",
+    "wrong_sync_bits": "Malformed packet - wrong sync bits (skip)",
+    "await_bm": "Await B/M packet (skip)",
+    "invalid_bit": "invalid bit is set",
+    "bit_29": "bit 29 is set",
+    "parity_error": "parity error detected",
+}
+
+# Parallel decoding: segment size and overlap, in runs
+DEFAULT_SEGMENT_SIZE = 1 << 20
+DEFAULT_OVERLAP = 1 << 10
+MIN_OVERLAP = SUBFRAME_SIZE * 2      # a subframe has at most two runs per time slot
+
+# Pulse widths, as multiples of the S/PDIF clock pulse width
+SHORT_PULSE = 1
+LONG_PULSE = 2
+SYNC_PULSE = 3
+
+# Adaptive clock tracking: the clock pulse width is estimated from a prefix
+# of the signal (in runs), then tracked with an exponential moving average
+ADAPTIVE_PREFIX = 1 << 12
+ADAPTIVE_RATE = 1.0 / 256.0
+
+
+def get_run_lengths(digital: RawDigitalSignal) -> typing.Tuple[RunLengths, int]:
+    # Find the position of each edge (change of state). The run lengths are
+    # the times between consecutive edges: the partial runs before the first
+    # edge and after the final edge are not included. Also returns the
+    # position of the first edge, so that run positions can be reported.
+    edges = numpy.flatnonzero(digital[1:] != digital[:-1]) + 1
+    if len(edges) == 0:
+        return (numpy.zeros(0, dtype=numpy.int64), 0)
+    return (numpy.diff(edges), int(edges[0]))
+
+class RunLengthFinder:
+    # As get_run_lengths, for a signal supplied in pieces of any size,
+    # including an edge between one piece and the next. Each call to feed()
+    # returns the runs that were completed by that piece of the signal.
+    def __init__(self) -> None:
+        self.level: typing.Optional[bool] = None
+        self.first_edge: typing.Optional[int] = None
+        self.last_edge: typing.Optional[int] = None
+        self.num_samples = 0
+
+    def feed(self, digital: RawDigitalSignal) -> RunLengths:
+        if len(digital) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+
+        if self.level is None:
+            self.level = bool(digital[0])
+        previous = numpy.concatenate(([self.level], digital[:-1]))
+        edges = numpy.flatnonzero(digital != previous) + self.num_samples
+        self.num_samples += len(digital)
+        self.level = bool(digital[-1])
+        if len(edges) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+
+        if self.last_edge is None:
+            # The partial run before the first edge is not included
+            self.first_edge = int(edges[0])
+            runs = numpy.diff(edges)
+        else:
+            runs = numpy.diff(edges, prepend=self.last_edge)
 
+        self.last_edge = int(edges[-1])
+        return runs
 
-def biphase_mark_decode(digital: RawDigitalSignal, osc_period: float) -> RawSPDIFPackets:
+def get_best_hold_time(runs: RunLengths) -> int:
     # Get S/PDIF clock pulse width
-    hold_time = -len(digital)
-    hold_time_histogram: typing.Dict[int, int] = collections.defaultdict(lambda: 0)
-    max_hold_time = 0
-    for i in range(1, len(digital)):
-        if digital[i] == digital[i - 1]:
-            hold_time += 1
-        else:
-            hold_time_histogram[hold_time] += 1
-            max_hold_time = max(hold_time, max_hold_time)
-            hold_time = 1
+    max_hold_time = int(runs.max()) if len(runs) != 0 else 0
+    hold_time_histogram = numpy.bincount(runs, minlength=(max_hold_time * 2) + 2)
 
-    for (hold_time, count) in sorted(hold_time_histogram.items()):
-        if hold_time > 0:
-            print("hold_time width {} has count {}".format(hold_time, count))
+    for width in numpy.flatnonzero(hold_time_histogram):
+        print("hold_time width {} has count {}".format(
+            width, hold_time_histogram[width]))
 
     best_score = -1
     best_hold_time = 1
     for hold_time in range(1, max_hold_time):
-        peak0 = (hold_time_histogram.get(hold_time - 1, 0)
-                + hold_time_histogram.get(hold_time, 0))
-        peak1 = (hold_time_histogram.get(hold_time * 2 , 0)
-                + hold_time_histogram.get(hold_time * 2 + 1, 0))
+        peak0 = (hold_time_histogram[hold_time - 1]
+                + hold_time_histogram[hold_time])
+        peak1 = (hold_time_histogram[hold_time * 2]
+                + hold_time_histogram[hold_time * 2 + 1])
 
         score = peak0 + peak1
         #print("hold time {} has score {}".format(hold_time, score))
@@ -61,159 +183,668 @@ def biphase_mark_decode(digital: RawDigitalSignal, osc_period: float) -> RawSPDI
             best_score = score
             best_hold_time = hold_time
 
-    # What's the S/PDIF bit rate? (Time to send a single bit)
-    spdif_period = best_hold_time * osc_period * 2
-    spdif_freq = 1.0 / spdif_period
-    print("S/PDIF clock frequency {:1.3f} MHz".format(spdif_freq / 1e6))
+    return best_hold_time
 
+def get_widths(hold_time: int) -> typing.Tuple[int, int]:
     # Thresholds for longer pulses
-    width1 = ((best_hold_time * 2) - 0)
-    width2 = ((best_hold_time * 3) - 0)
-    print("width0", best_hold_time)
-    print("width1", width1)
-    print("width2", width2)
-
-    # Get binary data
-    pulse = -len(digital)
-    packets: RawSPDIFPackets = [[]]
-    skip = False
-    inhibit = False
-    sync_state = SyncState.DESYNC
-
-    for i in range(1, len(digital)):
-        if digital[i] == digital[i - 1]:
-            pulse += 1
-        else:
+    width1 = ((hold_time * 2) - 0)
+    width2 = ((hold_time * 3) - 0)
+    return (width1, width2)
+
+def classify_pulses(runs: RunLengths, width1: float, width2: float) -> PulseWidths:
+    return ((runs >= width1).astype(numpy.uint8)
+            + (runs >= width2).astype(numpy.uint8)
+            + SHORT_PULSE)
+
+def get_adaptive_widths(unit: float) -> typing.Tuple[float, float]:
+    # Thresholds for longer pulses, midway between the expected widths
+    return (unit * 1.5, unit * 2.5)
+
+def fit_unit(runs: RunLengths, unit: float, width1: float, width2: float,
+            iterations: int) -> typing.Tuple[float, float]:
+    # Classify each run, find the average width of one clock pulse, and
+    # repeat with thresholds based on that width. Returns the width and
+    # the mean squared error of the fit (relative to the width).
+    error = float("inf")
+    for i in range(iterations + 1):
+        usable = runs < (width2 + unit)
+        if not numpy.any(usable):
+            break
+        widths = classify_pulses(runs[usable], width1, width2)
+        error = float(numpy.mean(((runs[usable] - (widths * unit)) / unit) ** 2))
+        if i < iterations:
+            unit = float(runs[usable].sum()) / float(widths.sum())
+            (width1, width2) = get_adaptive_widths(unit)
+    return (unit, error)
+
+def estimate_unit(runs: RunLengths, hold_time: int, iterations: int = 4) -> float:
+    # Refine the clock pulse width, starting from hold_time. The fit normally
+    # begins with the fixed thresholds from get_widths(), as these work well
+    # when there are only a few samples per pulse. If the fit is much better
+    # when beginning with midpoint thresholds, that is used instead.
+    (unit, error) = fit_unit(runs, float(hold_time), *get_widths(hold_time), iterations)
+    (other_unit, other_error) = fit_unit(runs, float(hold_time),
+                            *get_adaptive_widths(hold_time), iterations)
+    if (other_error * 2.0) < error:
+        return other_unit
+    return unit
+
+class BiphaseMarkDecoder:
+    # Decodes biphase mark code into packets. The decoder state is kept
+    # between calls to feed() or feed_runs(), so the signal can be
+    # supplied in pieces of any size. Each call returns the packets that
+    # were completed by that piece of the signal. Resyncs are counted in
+    # stats if they are within [report_start, report_end).
+    def __init__(self, hold_time: int, position: int = 0,
+                stats: typing.Optional[Stats] = None) -> None:
+        (self.width1, self.width2) = get_widths(hold_time)
+        self.stats = stats if stats is not None else Stats()
+        self.report_start = 0
+        self.report_end = sys.maxsize
+        self.sync_state = SyncState.DESYNC
+        self.preamble = Preamble.NONE
+        self.subframe = 0
+        self.size = 0
+        self.skip = False
+        self.position = position
+        self.packet_position = position
+        self.edges = RunLengthFinder()
+
+    def feed(self, digital: RawDigitalSignal) -> RawSPDIFPackets:
+        started = self.edges.first_edge is not None
+        runs = self.edges.feed(digital)
+        if (not started) and (self.edges.first_edge is not None):
+            self.position = self.packet_position = self.edges.first_edge
+        if len(runs) == 0:
+            return new_packets()
+        return self.feed_runs(runs)
+
+    def classify(self, runs: RunLengths) -> typing.Iterable[int]:
+        widths: typing.List[int] = classify_pulses(runs, self.width1, self.width2).tolist()
+        return widths
+
+    def feed_runs(self, runs: RunLengths) -> RawSPDIFPackets:
+        # Get binary data
+        position = self.position
+        preambles = []
+        subframes = []
+        sizes = []
+        positions = []
+        resyncs = []
+        packet_position = self.packet_position
+        preamble = self.preamble
+        subframe = self.subframe
+        size = self.size
+        skip = self.skip
+        sync_state = self.sync_state
+
+        for (pulse, width) in zip(runs.tolist(), self.classify(runs)):
+            position += pulse
             if sync_state == SyncState.NONE:
-                if pulse >= width2:
+                if width == SYNC_PULSE:
                     # Synchronisation mark
                     sync_state = SyncState.START
-                elif pulse >= width1:
+                elif width == LONG_PULSE:
                     # Ordinary data (0)
-                    packets[-1].append(False)
+                    size += 1
                     skip = False
                 else:
                     # Ordinary data (1)
                     if not skip:
-                        packets[-1].append(True)
+                        if size < SUBFRAME_SIZE:
+                            subframe |= 1 << size
+                        size += 1
                         skip = True
                     else:
                         skip = False
 
             elif sync_state == SyncState.START:
-                if pulse >= width2:
+                if width == SYNC_PULSE:
                     sync_state = SyncState.M_HEADER # 111000 received, 10 remaining
-                elif pulse >= width1:
+                elif width == LONG_PULSE:
                     sync_state = SyncState.W_HEADER # 11100 received, 100 remaining
                 else:
                     sync_state = SyncState.B_HEADER # 1110 received, 1000 remaining
 
             elif sync_state == SyncState.M_HEADER:
-                if pulse >= width1:
+                if width != SHORT_PULSE:
                     sync_state = SyncState.DESYNC   # expected 10
                 else:
                     sync_state = SyncState.M_FOOTER # 0 remaining
 
             elif sync_state == SyncState.W_HEADER:
-                if pulse >= width1:
+                if width != SHORT_PULSE:
                     sync_state = SyncState.DESYNC   # expected 100
                 else:
                     sync_state = SyncState.W_FOOTER # 00 remaining
-                
+
             elif sync_state == SyncState.B_HEADER:
-                if pulse >= width1:
+                if width != SHORT_PULSE:
                     sync_state = SyncState.DESYNC   # expected 1000
                 else:
                     sync_state = SyncState.B_FOOTER # 000 remaining
 
             elif sync_state == SyncState.M_FOOTER:
-                if pulse >= width1:
+                if width != SHORT_PULSE:
                     sync_state = SyncState.DESYNC   # expected 0
                 else:
                     sync_state = SyncState.NONE
-                    packets.append(M_PACKET[:])
+                    preambles.append(preamble)
+                    subframes.append(subframe)
+                    sizes.append(size)
+                    positions.append(packet_position)
+                    packet_position = position
+                    preamble = Preamble.M
+                    subframe = PREAMBLE_BITS[preamble]
+                    size = 4
 
             elif sync_state == SyncState.W_FOOTER:
-                if (pulse < width1) or (pulse >= width2):
+                if width != LONG_PULSE:
                     sync_state = SyncState.DESYNC   # expected 00
                 else:
                     sync_state = SyncState.NONE
-                    packets.append(W_PACKET[:])
-                
+                    preambles.append(preamble)
+                    subframes.append(subframe)
+                    sizes.append(size)
+                    positions.append(packet_position)
+                    packet_position = position
+                    preamble = Preamble.W
+                    subframe = PREAMBLE_BITS[preamble]
+                    size = 4
+
             elif sync_state == SyncState.B_FOOTER:
-                if pulse < width2:
+                if width != SYNC_PULSE:
                     sync_state = SyncState.DESYNC   # expected 000
                 else:
                     sync_state = SyncState.NONE
-                    packets.append(B_PACKET[:])
+                    preambles.append(preamble)
+                    subframes.append(subframe)
+                    sizes.append(size)
+                    positions.append(packet_position)
+                    packet_position = position
+                    preamble = Preamble.B
+                    subframe = PREAMBLE_BITS[preamble]
+                    size = 4
 
             elif sync_state == SyncState.DESYNC:
-                if pulse >= width2:
+                if width == SYNC_PULSE:
                     # Synchronisation mark
                     sync_state = SyncState.START
-                    print("resync at", i)
+                    resyncs.append(position)
+
+        self.position = position
+        self.packet_position = packet_position
+        self.preamble = preamble
+        self.subframe = subframe
+        self.size = size
+        self.skip = skip
+        self.sync_state = sync_state
+
+        resync_positions = numpy.array(resyncs, dtype=numpy.int64)
+        self.stats.add("resync", resync_positions[(resync_positions >= self.report_start)
+                                                & (resync_positions < self.report_end)])
+        return new_packets(preambles, subframes, sizes, positions)
+
+    def flush(self) -> RawSPDIFPackets:
+        # Return the final packet, which may be incomplete
+        packets = new_packets([self.preamble], [self.subframe], [self.size],
+                    [self.packet_position])
+        self.preamble = Preamble.NONE
+        self.subframe = 0
+        self.size = 0
+        return packets
+
+class AdaptiveBiphaseMarkDecoder(BiphaseMarkDecoder):
+    # As BiphaseMarkDecoder, but the clock pulse width (unit) is tracked
+    # while decoding, so that the decoder stays synchronised if the clock
+    # drifts. Each pulse is classified using thresholds midway between
+    # the expected widths, then the unit is updated from the pulse width.
+    def __init__(self, unit: float, position: int = 0,
+                stats: typing.Optional[Stats] = None) -> None:
+        BiphaseMarkDecoder.__init__(self, max(1, int(round(unit))), position, stats)
+        self.unit = unit
+
+    def classify(self, runs: RunLengths) -> typing.Iterable[int]:
+        unit = self.unit
+        for pulse in runs.tolist():
+            if pulse < (unit * 1.5):
+                width = SHORT_PULSE
+            elif pulse < (unit * 2.5):
+                width = LONG_PULSE
+            else:
+                width = SYNC_PULSE
+                if pulse >= (unit * 3.5):
+                    # Not a valid pulse: don't track it
+                    yield width
+                    continue
+
+            unit += ((pulse / width) - unit) * ADAPTIVE_RATE
+            yield width
+
+        self.unit = unit
+
+def get_clock(runs: RunLengths, osc_period: float) -> int:
+    best_hold_time = get_best_hold_time(runs)
 
-            pulse = 1
+    # What's the S/PDIF bit rate? (Time to send a single bit)
+    spdif_period = best_hold_time * osc_period * 2
+    spdif_freq = 1.0 / spdif_period
+    print("S/PDIF clock frequency {:1.3f} MHz".format(spdif_freq / 1e6))
 
+    (width1, width2) = get_widths(best_hold_time)
+    print("width0", best_hold_time)
+    print("width1", width1)
+    print("width2", width2)
+    return best_hold_time
+
+def get_adaptive_clock(runs: RunLengths, osc_period: float) -> float:
+    # Estimate the clock from the start of the signal only
+    prefix = runs[:ADAPTIVE_PREFIX]
+    unit = estimate_unit(prefix, get_best_hold_time(prefix))
+    print("S/PDIF clock frequency {:1.3f} MHz".format(1.0 / (unit * osc_period * 2) / 1e6))
+    print("unit width {:1.3f}".format(unit))
+    return unit
+
+def get_declared_unit(sample_rate: int, osc_period: float) -> float:
+    # Clock pulse width for the sample rate given in the channel status:
+    # there are 128 clock pulses in each frame
+    return 1.0 / (sample_rate * 128 * osc_period)
+
+def report_resyncs(stats: Stats) -> None:
+    examples = stats.examples.get("resync", [])
+    for position in examples:
+        print("resync at", position)
+    more = stats.counters.get("resync", 0) - len(examples)
+    if more > 0:
+        print("... and {} more resyncs".format(more))
+
+def biphase_mark_decode(digital: RawDigitalSignal, osc_period: float,
+            stats: typing.Optional[Stats] = None,
+            adaptive: bool = False) -> RawSPDIFPackets:
+    stats = stats if stats is not None else Stats()
+    with stats.stage("bmc"):
+        (runs, first_edge) = get_run_lengths(digital)
+    return biphase_mark_decode_runs(runs, first_edge, osc_period, stats, adaptive)
+
+def biphase_mark_decode_runs(runs: RunLengths, first_edge: int, osc_period: float,
+            stats: typing.Optional[Stats] = None,
+            adaptive: bool = False) -> RawSPDIFPackets:
+    # As biphase_mark_decode, for the run lengths of the signal (from get_run_lengths)
+    stats = stats if stats is not None else Stats()
+    bmc_stats = Stats()
+    with stats.stage("bmc"):
+        decoder: BiphaseMarkDecoder
+        if adaptive:
+            decoder = AdaptiveBiphaseMarkDecoder(
+                    get_adaptive_clock(runs, osc_period), first_edge, bmc_stats)
+        else:
+            decoder = BiphaseMarkDecoder(get_clock(runs, osc_period), first_edge, bmc_stats)
+        packets = join_packets([decoder.feed_runs(runs), decoder.flush()])
+
+    if isinstance(decoder, AdaptiveBiphaseMarkDecoder):
+        print("S/PDIF clock frequency at end {:1.3f} MHz".format(
+                1.0 / (decoder.unit * osc_period * 2) / 1e6))
+    report_resyncs(bmc_stats)
+    bmc_stats.count("packets", len(packets))
+    stats.merge(bmc_stats)
     print("Packets", len(packets))
     return packets
 
-def spdif_decode(packets: RawSPDIFPackets) -> typing.Tuple[AudioData, RawSubcodeData]:
-    output: AudioData = []
-    subcode: RawSubcodeData = []
-    channel = 0
-    for packet in packets:
-        if len(packet) < 32:
-            print("Malformed packet - wrong size (skip)")
-            continue
-
-        if packet[:4] == B_PACKET:
-            subcode.clear()
-            output.append(Sample())
-            channel = 0
-        elif packet[:4] == M_PACKET:
-            output.append(Sample())
-            channel = 0
-        elif packet[:4] == W_PACKET:
-            if len(output) == 0:
-                print("Await B/M packet (skip)")
-                continue
-            channel += 1
-        else:
-            print("Malformed packet - wrong sync bits (skip)")
-            continue
+def decode_segment(runs: RunLengths, hold_time: int, position: int,
+            start: int, end: int, adaptive: bool = False,
+            ) -> typing.Tuple[RawSPDIFPackets, Stats]:
+    # Decode runs from position, but only keep the packets whose preamble ends
+    # within [start, end). The decoder begins in the DESYNC state, and
+    # resynchronises at the first preamble: the runs before start are a lead-in
+    # which is long enough to ensure this. Resyncs are expected in the lead-in,
+    # so only the resyncs within [start, end) are counted. In adaptive mode,
+    # the clock is estimated again from the start of the segment.
+    stats = Stats()
+    decoder: BiphaseMarkDecoder
+    if adaptive:
+        decoder = AdaptiveBiphaseMarkDecoder(
+                estimate_unit(runs[:ADAPTIVE_PREFIX], hold_time), position, stats)
+    else:
+        decoder = BiphaseMarkDecoder(hold_time, position, stats)
+    decoder.report_start = start
+    decoder.report_end = end
+    packets = join_packets([decoder.feed_runs(runs), decoder.flush()])
+    return (packets.select((packets.positions >= start) & (packets.positions < end)), stats)
+
+def parallel_biphase_mark_decode(digital: RawDigitalSignal, osc_period: float,
+            jobs: typing.Optional[int] = None,
+            segment_size: int = DEFAULT_SEGMENT_SIZE,
+            overlap: int = DEFAULT_OVERLAP,
+            stats: typing.Optional[Stats] = None,
+            adaptive: bool = False) -> RawSPDIFPackets:
+    stats = stats if stats is not None else Stats()
+    with stats.stage("bmc"):
+        (runs, first_edge) = get_run_lengths(digital)
+    return parallel_biphase_mark_decode_runs(runs, first_edge, osc_period, jobs,
+                segment_size, overlap, stats, adaptive)
+
+def parallel_biphase_mark_decode_runs(runs: RunLengths, first_edge: int, osc_period: float,
+            jobs: typing.Optional[int] = None,
+            segment_size: int = DEFAULT_SEGMENT_SIZE,
+            overlap: int = DEFAULT_OVERLAP,
+            stats: typing.Optional[Stats] = None,
+            adaptive: bool = False) -> RawSPDIFPackets:
+    if overlap < MIN_OVERLAP:
+        raise ValueError("Overlap must be at least {} runs (one subframe)".format(MIN_OVERLAP))
+    stats = stats if stats is not None else Stats()
+    bmc_stats = Stats()
+    with stats.stage("bmc"):
+        # The clock is found once, for the whole signal
+        hold_time = get_clock(runs, osc_period)
+
+        # Split the runs into segments, each decoded with some overlap
+        # at each end: so that the decoder is synchronised at the start of
+        # the segment, and so that the final packet in the segment is complete
+        edges = numpy.concatenate(([first_edge], first_edge + numpy.cumsum(runs)))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = []
+            for segment_start in range(0, max(len(runs), 1), segment_size):
+                segment_end = min(segment_start + segment_size, len(runs))
+                decode_start = max(0, segment_start - overlap)
+                decode_end = min(len(runs), segment_end + overlap)
+
+                # The initial (empty) packet belongs to the first segment only
+                start = int(edges[segment_start]) + (1 if segment_start != 0 else 0)
+                end = int(edges[segment_end]) + 1
+
+                futures.append(executor.submit(decode_segment,
+                        runs[decode_start:decode_end], hold_time,
+                        int(edges[decode_start]), start, end, adaptive))
+
+            parts = []
+            for future in futures:
+                (part, segment_stats) = future.result()
+                parts.append(part)
+                bmc_stats.merge(segment_stats)
+
+            packets = join_packets(parts)
+
+    report_resyncs(bmc_stats)
+    bmc_stats.count("packets", len(packets))
+    stats.merge(bmc_stats)
+    print("Packets", len(packets))
+    return packets
 
-        # Audio data here (24 bits)
-        audio = 0
-        for i in range(27, 3, -1):
-            audio = audio << 1
-            if packet[i]:
-                audio |= 1
+def get_parity(data: numpy.ndarray) -> numpy.ndarray:
+    data = data.copy()
+    for shift in (16, 8, 4, 2, 1):
+        data ^= data >> shift
+    return data & 1
+
+class SubframeDecoder:
+    # Decodes packets into audio samples. As with BiphaseMarkDecoder,
+    # the state is kept between calls to decode(). Each call returns
+    # the samples that were completed by the packets: the most recent
+    # sample is held back, as the following packets may add to it.
+    # Errors are counted in stats (see PACKET_ERRORS). Channel status
+    # bits are passed to a ChannelStatusDecoder.
+    def __init__(self, stats: typing.Optional[Stats] = None,
+                status: typing.Optional[ChannelStatusDecoder] = None) -> None:
+        self.channel = 0
+        self.open_sample = new_audio_data(0)
+        self.subcode: RawSubcodeData = numpy.zeros(0, dtype=bool)
+        self.stats = stats if stats is not None else Stats()
+        self.status = status if status is not None else ChannelStatusDecoder(self.stats)
+
+    def decode(self, packets: RawSPDIFPackets) -> AudioData:
+        complete = packets.sizes >= SUBFRAME_SIZE
+        self.stats.add("wrong_size", packets.positions[~complete])
+        preambles = packets.preambles[complete]
+        subframes = packets.subframes[complete]
+        positions = packets.positions[complete]
+
+        self.stats.add("wrong_sync_bits", positions[preambles == Preamble.NONE])
+
+        # Each B or M packet begins a new sample (channel 0), and each W packet
+        # moves on to the next channel. W packets before the first B/M are skipped.
+        is_block_start = preambles == Preamble.B
+        is_start = is_block_start | (preambles == Preamble.M)
+        is_next = preambles == Preamble.W
+        num_started = numpy.cumsum(is_start)
+        sample_index = num_started - 1 + len(self.open_sample)
+        self.stats.add("await_bm", positions[is_next & (sample_index < 0)])
+        accepted = (is_start | is_next) & (sample_index >= 0)
+
+        next_count = numpy.cumsum(is_next)
+        channel = numpy.where(num_started != 0,
+                next_count - numpy.maximum.accumulate(numpy.where(is_start, next_count, 0)),
+                next_count + self.channel)
+        if len(channel) != 0:
+            self.channel = int(channel[-1])
 
-        if channel == 0:
-            output[-1].left = audio
-        elif channel == 1:
-            output[-1].right = audio
+        # Audio data here (24 bits)
+        audio = (subframes >> AUDIO_SHIFT) & AUDIO_MASK
+        output = new_audio_data(len(self.open_sample) + int(numpy.count_nonzero(is_start)))
+        output[:len(self.open_sample)] = self.open_sample
+        output.left[sample_index[is_start]] = audio[is_start]
+        is_right = accepted & (channel == 1)
+        output.right[sample_index[is_right]] = audio[is_right]
 
         # Validity
-        if packet[28]:
-            print("invalid bit is set")
+        accepted_subframes = subframes[accepted]
+        accepted_positions = positions[accepted]
+        self.stats.add("invalid_bit",
+                accepted_positions[((accepted_subframes >> VALIDITY_BIT) & 1) != 0])
 
         # Subcode/status bit
-        if packet[29]:
-            print("bit 29 is set")
-
-        if channel == 0:
-            subcode.append(packet[30])
+        self.stats.add("bit_29",
+                accepted_positions[((accepted_subframes >> USER_BIT) & 1) != 0])
 
         # Parity
-        count = 0
-        for p in packet[4:32]:
-            if p:
-                count += 1
-
-        if (count % 2) != 0:
-            print("parity error detected")
-
-    return (output, subcode)
-
+        self.stats.add("parity_error",
+                accepted_positions[get_parity(accepted_subframes >> AUDIO_SHIFT) != 0])
+
+        # Channel status bits from channel 0
+        status_bits = ((subframes[is_start] >> STATUS_BIT) & 1).astype(bool)
+        self.status.feed(status_bits, is_block_start[is_start], positions[is_start])
+
+        # ... since the most recent B packet
+        block_starts = numpy.flatnonzero(is_block_start)
+        if len(block_starts) != 0:
+            is_start[:block_starts[-1]] = False
+            self.subcode = numpy.zeros(0, dtype=bool)
+        self.subcode = numpy.concatenate((self.subcode,
+                status_bits[len(status_bits) - int(numpy.count_nonzero(is_start)):]))
+
+        # Hold back the most recent sample
+        self.open_sample = output[len(output) - 1:].copy().view(numpy.recarray)
+        return output[:len(output) - 1].view(numpy.recarray)
+
+    def flush(self) -> AudioData:
+        # Return the most recent sample, which may be incomplete
+        output = self.open_sample
+        self.open_sample = new_audio_data(0)
+        return output
+
+def spdif_decode(packets: RawSPDIFPackets,
+            stats: typing.Optional[Stats] = None,
+            status: typing.Optional[ChannelStatusDecoder] = None,
+            ) -> typing.Tuple[AudioData, RawSubcodeData]:
+    stats = stats if stats is not None else Stats()
+    decoder = SubframeDecoder(Stats(), status)
+    with stats.stage("subframe"):
+        output = join_audio_data([decoder.decode(packets), decoder.flush()])
+
+    report_packet_errors(decoder.stats)
+    decoder.stats.count("frames", len(output))
+    stats.merge(decoder.stats)
+    return (output, decoder.subcode)
+
+def report_packet_errors(stats: Stats) -> None:
+    for (name, message) in PACKET_ERRORS.items():
+        if name in stats.counters:
+            print("{}: {} packets".format(message, stats.counters[name]))
+
+def spdif_decode_chunks(chunks: typing.Iterator[RawDigitalSignal], osc_period: float,
+            stats: typing.Optional[Stats] = None,
+            status: typing.Optional[ChannelStatusDecoder] = None,
+            adaptive: bool = False) -> typing.Tuple[AudioData, RawSubcodeData]:
+    # As biphase_mark_decode followed by spdif_decode, for a signal supplied in
+    # pieces (from picoscope_decode_chunks or binary_decode_chunks), so that the
+    # whole capture is not in memory. The start of the signal is held back until
+    # there are ADAPTIVE_PREFIX runs, and the clock is found from those runs.
+    stats = stats if stats is not None else Stats()
+    bmc_stats = Stats()
+    subframes = SubframeDecoder(Stats(), status)
+    decoder: typing.Optional[BiphaseMarkDecoder] = None
+    pending: typing.List[RawDigitalSignal] = []
+    num_packets = 0
+    output = []
+    finished = False
+    while not finished:
+        digital = next(chunks, None)
+        if digital is None:
+            finished = True
+            digital = numpy.zeros(0, dtype=bool)
+
+        with stats.stage("bmc"):
+            if decoder is None:
+                pending.append(digital)
+                digital = numpy.concatenate(pending)
+                (runs, _) = get_run_lengths(digital)
+                if (len(runs) < ADAPTIVE_PREFIX) and not finished:
+                    continue
+                pending = []
+                if adaptive:
+                    decoder = AdaptiveBiphaseMarkDecoder(
+                            get_adaptive_clock(runs, osc_period), 0, bmc_stats)
+                else:
+                    decoder = BiphaseMarkDecoder(get_clock(runs, osc_period), 0, bmc_stats)
+            packets = decoder.feed(digital)
+            if finished:
+                packets = join_packets([packets, decoder.flush()])
+            num_packets += len(packets)
+
+        with stats.stage("subframe"):
+            output.append(subframes.decode(packets))
+            if finished:
+                output.append(subframes.flush())
+
+    if isinstance(decoder, AdaptiveBiphaseMarkDecoder):
+        print("S/PDIF clock frequency at end {:1.3f} MHz".format(
+                1.0 / (decoder.unit * osc_period * 2) / 1e6))
+    report_resyncs(bmc_stats)
+    bmc_stats.count("packets", num_packets)
+    stats.merge(bmc_stats)
+    print("Packets", num_packets)
+
+    audio = join_audio_data(output)
+    report_packet_errors(subframes.stats)
+    subframes.stats.count("frames", len(audio))
+    stats.merge(subframes.stats)
+    return (audio, subframes.subcode)
+
+class SPDIFDecoder:
+    # Decodes S/PDIF incrementally: the digitised signal (or its run lengths)
+    # can be supplied in pieces of any size, and each call returns the audio
+    # samples that are complete. If the hold time is not known, the signal is
+    # held back until there are ADAPTIVE_PREFIX runs (or until flush()), and the
+    # clock is estimated from those runs, so the result does not depend on the
+    # size of the pieces. In adaptive mode, the clock is then tracked.
+    # But if the oscilloscope clock period is known, and the channel status
+    # has given the sample rate, the clock is not estimated: the status may
+    # come from an earlier stream, or from before a call to restart().
+    def __init__(self, hold_time: typing.Optional[int] = None,
+                stats: typing.Optional[Stats] = None,
+                adaptive: bool = False,
+                osc_period: typing.Optional[float] = None,
+                status: typing.Optional[ChannelStatusDecoder] = None) -> None:
+        self.stats = stats if stats is not None else Stats()
+        self.adaptive = adaptive
+        self.osc_period = osc_period
+        self.bmc: typing.Optional[BiphaseMarkDecoder] = None
+        self.subframes = SubframeDecoder(self.stats, status)
+        # Signal held back until the clock is known: pieces of the digitised
+        # signal or of the run lengths, and the number of complete runs
+        self.pending_digital: typing.List[RawDigitalSignal] = []
+        self.pending_runs: typing.List[RunLengths] = []
+        self.pending_edges = 0
+        self.pending_level: typing.Optional[bool] = None
+        if hold_time is not None:
+            self.bmc = self.new_bmc(numpy.zeros(0, dtype=numpy.int64), hold_time)
+
+    def get_declared_unit(self) -> typing.Optional[float]:
+        last = self.subframes.status.last
+        if (self.osc_period is None) or (last is None) or (last.sample_rate is None):
+            return None
+        return get_declared_unit(last.sample_rate, self.osc_period)
+
+    def new_bmc(self, runs: RunLengths,
+                hold_time: typing.Optional[int] = None) -> BiphaseMarkDecoder:
+        unit = self.get_declared_unit() if hold_time is None else None
+        if unit is not None:
+            self.stats.count("declared_clock")
+            if self.adaptive:
+                return AdaptiveBiphaseMarkDecoder(unit, 0, self.stats)
+            return BiphaseMarkDecoder(max(1, int(round(unit))), 0, self.stats)
+        prefix = runs[:ADAPTIVE_PREFIX]
+        if hold_time is None:
+            hold_time = get_best_hold_time(prefix)
+        if self.adaptive:
+            return AdaptiveBiphaseMarkDecoder(estimate_unit(prefix, hold_time), 0, self.stats)
+        return BiphaseMarkDecoder(hold_time, 0, self.stats)
+
+    def feed(self, digital: RawDigitalSignal) -> AudioData:
+        if (self.bmc is None) and (self.get_declared_unit() is None):
+            # Hold back the signal, counting its edges, until the clock can be estimated
+            if len(digital) == 0:
+                return new_audio_data(0)
+            level = self.pending_level if self.pending_level is not None else bool(digital[0])
+            self.pending_edges += (int(digital[0]) != level) + int(
+                    numpy.count_nonzero(digital[1:] != digital[:-1]))
+            self.pending_level = bool(digital[-1])
+            self.pending_digital.append(digital)
+            if self.pending_edges <= ADAPTIVE_PREFIX:
+                return new_audio_data(0)
+            digital = numpy.concatenate(self.pending_digital)
+            self.pending_digital = []
+        if self.bmc is None:
+            (runs, _) = get_run_lengths(digital)
+            self.bmc = self.new_bmc(runs)
+        return self.subframes.decode(self.bmc.feed(digital))
+
+    def feed_runs(self, runs: RunLengths) -> AudioData:
+        if (self.bmc is None) and (self.get_declared_unit() is None):
+            self.pending_runs.append(runs)
+            if sum(len(part) for part in self.pending_runs) < ADAPTIVE_PREFIX:
+                return new_audio_data(0)
+            runs = numpy.concatenate(self.pending_runs)
+            self.pending_runs = []
+        if self.bmc is None:
+            self.bmc = self.new_bmc(runs)
+        return self.subframes.decode(self.bmc.feed_runs(runs))
+
+    def flush(self) -> AudioData:
+        # The clock is estimated from the signal held back, if it is not known yet
+        output = []
+        if self.bmc is None:
+            if len(self.pending_digital) != 0:
+                digital = numpy.concatenate(self.pending_digital)
+                self.bmc = self.new_bmc(get_run_lengths(digital)[0])
+                output.append(self.subframes.decode(self.bmc.feed(digital)))
+            elif len(self.pending_runs) != 0:
+                runs = numpy.concatenate(self.pending_runs)
+                self.bmc = self.new_bmc(runs)
+                output.append(self.subframes.decode(self.bmc.feed_runs(runs)))
+        self.pending_digital = []
+        self.pending_runs = []
+        self.pending_edges = 0
+        self.pending_level = None
+        if self.bmc is not None:
+            output.append(self.subframes.decode(self.bmc.flush()))
+        output.append(self.subframes.flush())
+        return join_audio_data(output)
+
+    def restart(self) -> AudioData:
+        # Begin again after a break in the signal, returning the samples
+        # from before the break. The most recent channel status is kept.
+        output = self.flush()
+        self.bmc = None
+        self.subframes.status.restart()
+        self.subframes = SubframeDecoder(self.stats, self.subframes.status)
+        return output
@@ -0,0 +1,41 @@
+
+import enum
+import numpy
+
+
+# Biphase mark encoding of S/PDIF subframes, the reverse of spdif_decode.py.
+# Used to generate test signals, both for the FPGA test bench and for the
+# synthetic captures of benchmark.py.
+
+class HeaderType(enum.Enum):
+    B = enum.auto()
+    W = enum.auto()
+    M = enum.auto()
+
+# Preamble pulse widths (in single pulses) for each header type, following
+# the initial 3: the same as in bmc_packetise (make_test_bench.py)
+PREAMBLES = {
+    HeaderType.B: [3, 1, 1, 3],
+    HeaderType.W: [3, 2, 1, 2],
+    HeaderType.M: [3, 3, 1, 1],
+}
+
+def bmc_encode(audio: numpy.ndarray, headers: numpy.ndarray, single: float = 1.0) -> numpy.ndarray:
+    # Encode a whole sequence of subframes at once. audio contains 32-bit samples
+    # and headers contains HeaderType values (one per subframe). The result is the
+    # time between each state change and the next, where a single pulse is single.
+    data = audio.astype(numpy.uint64) >> numpy.uint64(8)
+    bits = ((data[:, None] >> numpy.arange(28, dtype=numpy.uint64)) & numpy.uint64(1)).astype(numpy.uint8)
+
+    # determine parity: bit 27 is toggled for each 1 bit in the data
+    bits[:, 27] ^= numpy.bitwise_xor.reduce(bits, axis=1)
+
+    # encoded signal: each row is one subframe, with the preamble followed by
+    # two pulse widths for each bit; the zero widths (after a 0 bit) are then removed
+    pulses = numpy.zeros((len(audio), 4 + (28 * 2)), dtype=numpy.uint8)
+    for (header, preamble) in PREAMBLES.items():
+        pulses[headers == header, :4] = preamble
+    pulses[:, 4::2] = 2 - bits
+    pulses[:, 5::2] = bits
+    widths = pulses.flatten()
+    return numpy.asarray(widths[widths != 0] * single)
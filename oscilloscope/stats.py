@@ -0,0 +1,76 @@
+
+import contextlib
+import time
+import tracemalloc
+import typing
+import numpy
+
+
+MAX_EXAMPLES = 10
+
+class Stats:
+    # Counters for events in each pipeline stage, with the positions of the
+    # first few examples of each event, and the time spent in each stage.
+    # If tracemalloc is running, the peak memory used by each stage is
+    # also recorded.
+    def __init__(self, max_examples: int = MAX_EXAMPLES) -> None:
+        self.max_examples = max_examples
+        self.counters: typing.Dict[str, int] = {}
+        self.examples: typing.Dict[str, typing.List[int]] = {}
+        self.stage_time: typing.Dict[str, float] = {}
+        self.stage_peak_memory: typing.Dict[str, int] = {}
+
+    def count(self, name: str, count: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def add(self, name: str, positions: typing.Union[typing.Sequence[int], numpy.ndarray]) -> None:
+        # Count events, recording the positions of the first few
+        if len(positions) == 0:
+            return
+        self.count(name, len(positions))
+        examples = self.examples.setdefault(name, [])
+        space = self.max_examples - len(examples)
+        if space > 0:
+            examples.extend(int(position) for position in positions[:space])
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> typing.Iterator[None]:
+        tracing = tracemalloc.is_tracing()
+        before = 0
+        if tracing:
+            tracemalloc.reset_peak()
+            (before, _) = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_time[name] = self.stage_time.get(name, 0.0) + time.perf_counter() - start
+            if tracing:
+                (_, peak) = tracemalloc.get_traced_memory()
+                self.stage_peak_memory[name] = max(
+                        self.stage_peak_memory.get(name, 0), peak - before)
+
+    def merge(self, other: "Stats") -> None:
+        for (name, count) in other.counters.items():
+            self.count(name, count)
+        for (name, examples) in other.examples.items():
+            space = self.max_examples - len(self.examples.get(name, []))
+            self.examples.setdefault(name, []).extend(examples[:max(0, space)])
+        for (name, stage_time) in other.stage_time.items():
+            self.stage_time[name] = self.stage_time.get(name, 0.0) + stage_time
+        for (name, peak) in other.stage_peak_memory.items():
+            self.stage_peak_memory[name] = max(self.stage_peak_memory.get(name, 0), peak)
+
+    def to_json(self) -> typing.Dict[str, typing.Any]:
+        stages: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        for (name, stage_time) in self.stage_time.items():
+            stages[name] = {"time": stage_time}
+            if name in self.stage_peak_memory:
+                stages[name]["peak_memory"] = self.stage_peak_memory[name]
+
+        return {
+            "counters": dict(self.counters),
+            "examples": {name: list(examples) for (name, examples) in self.examples.items()},
+            "stages": stages,
+        }
+
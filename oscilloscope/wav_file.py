@@ -0,0 +1,168 @@
+
+import struct
+import typing
+import numpy
+
+
+# WAV files are RIFF files: a "RIFF" header, then a sequence of chunks, each
+# with a 4 byte ID and a 32-bit little-endian size, padded to an even size.
+# Only the "fmt " and "data" chunks are used; others (e.g. "LIST") are skipped.
+RIFF_HEADER = struct.Struct("<4sI4s")
+CHUNK_HEADER = struct.Struct("<4sI")
+FORMAT_CHUNK = struct.Struct("<HHIIHH")
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xfffe
+SAMPLE_DTYPES: typing.Dict[int, numpy.dtype] = {
+    2: numpy.dtype("<i2"),
+    3: numpy.dtype("u1"),       # no 24-bit type: converted by get_24_bit_samples
+    4: numpy.dtype("<i4"),
+}
+
+class WavFormat:
+    def __init__(self, channels: int, sample_rate: int, block_align: int,
+                bits_per_sample: int, data_offset: int, data_size: int) -> None:
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.block_align = block_align
+        self.bits_per_sample = bits_per_sample
+        self.data_offset = data_offset      # position of the data chunk contents
+        self.data_size = data_size
+
+    @property
+    def bytes_per_sample(self) -> int:
+        return self.block_align // self.channels
+
+    @property
+    def num_frames(self) -> int:
+        return self.data_size // self.block_align
+
+def read_wav_format(fd: typing.BinaryIO) -> WavFormat:
+    (riff, riff_size, wave) = RIFF_HEADER.unpack(fd.read(RIFF_HEADER.size))
+    if (riff != b"RIFF") or (wave != b"WAVE"):
+        raise ValueError("Not a WAV file")
+
+    fmt: typing.Optional[typing.Tuple[int, ...]] = None
+    while True:
+        header = fd.read(CHUNK_HEADER.size)
+        if len(header) < CHUNK_HEADER.size:
+            raise ValueError("No data chunk in WAV file")
+        (chunk_id, chunk_size) = CHUNK_HEADER.unpack(header)
+        if chunk_id == b"fmt ":
+            fmt = FORMAT_CHUNK.unpack(fd.read(FORMAT_CHUNK.size))
+            fd.seek(chunk_size - FORMAT_CHUNK.size, 1)
+        elif chunk_id == b"data":
+            break
+        else:
+            fd.seek(chunk_size, 1)
+        if chunk_size & 1:
+            fd.seek(1, 1)
+
+    if fmt is None:
+        raise ValueError("No format chunk before the data chunk in WAV file")
+
+    # The extensible format is accepted, assuming that the sub-format is PCM
+    (format_tag, channels, sample_rate, _, block_align, bits_per_sample) = fmt
+    if format_tag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_EXTENSIBLE):
+        raise ValueError("Unsupported WAV format 0x{:04x}: PCM is required".format(format_tag))
+    if channels == 0:
+        raise ValueError("WAV file has no channels")
+
+    # Some writers give a block alignment too small for the samples
+    # (e.g. fpga/test/test_44100_data): the sample size is used instead
+    block_align = max(block_align, channels * ((bits_per_sample + 7) // 8))
+    if (block_align % channels) != 0:
+        raise ValueError("Invalid WAV block alignment")
+
+    # The data chunk size may be wrong if recording was interrupted:
+    # it is limited to the size of the file
+    data_offset = fd.tell()
+    fd.seek(0, 2)
+    data_size = min(chunk_size, fd.tell() - data_offset)
+    wav_format = WavFormat(channels, sample_rate, block_align, bits_per_sample,
+                data_offset, data_size)
+    if wav_format.bytes_per_sample not in SAMPLE_DTYPES:
+        raise ValueError("Unsupported WAV sample size: {} bytes".format(
+                wav_format.bytes_per_sample))
+    return wav_format
+
+def load_wav_file(wav_file_name: str) -> typing.Tuple[numpy.ndarray, WavFormat]:
+    # The samples are memory-mapped, with one row per frame
+    # (for 24-bit samples, the bytes of each sample are a further dimension)
+    with open(wav_file_name, "rb") as fd:
+        wav_format = read_wav_format(fd)
+
+    shape: typing.Tuple[int, ...] = (wav_format.num_frames, wav_format.channels)
+    if wav_format.bytes_per_sample == 3:
+        shape += (3, )
+    if wav_format.num_frames == 0:
+        return (numpy.zeros(shape, dtype=SAMPLE_DTYPES[wav_format.bytes_per_sample]), wav_format)
+    samples = numpy.memmap(wav_file_name, dtype=SAMPLE_DTYPES[wav_format.bytes_per_sample],
+                mode="r", offset=wav_format.data_offset, shape=shape)
+    return (samples, wav_format)
+
+def get_24_bit_samples(samples: numpy.ndarray) -> numpy.ndarray:
+    # Convert samples from load_wav_file to unsigned 24-bit values, as in
+    # AudioData: 16-bit samples are the upper bits, and 32-bit samples
+    # are truncated to their upper 24 bits
+    if samples.dtype == SAMPLE_DTYPES[3]:
+        parts = samples.astype(numpy.uint32)
+        return parts[..., 0] | (parts[..., 1] << 8) | (parts[..., 2] << 16)
+
+    data = samples.astype(numpy.int64)
+    if samples.dtype == SAMPLE_DTYPES[2]:
+        data = data << 8
+    else:
+        data = data >> 8
+    return (data & 0xffffff).astype(numpy.uint32)
+
+def get_32_bit_samples(samples: numpy.ndarray) -> numpy.ndarray:
+    # Convert samples from load_wav_file to unsigned 32-bit values,
+    # as in a 32-bit WAV file: shorter samples are the upper bits
+    if samples.dtype == SAMPLE_DTYPES[3]:
+        return get_24_bit_samples(samples) << 8
+
+    data = samples.astype(numpy.int64)
+    if samples.dtype == SAMPLE_DTYPES[2]:
+        data = data << 16
+    return (data & 0xffffffff).astype(numpy.uint32)
+
+class WavWriter:
+    # Write a PCM WAV file in blocks of frames: the chunk sizes
+    # are filled in when the file is closed
+    def __init__(self, wav_file_name: str, channels: int, sample_rate: int,
+                bits_per_sample: int = 16) -> None:
+        self.bytes_per_sample = (bits_per_sample + 7) // 8
+        self.dtype = SAMPLE_DTYPES[self.bytes_per_sample]
+        self.channels = channels
+        self.data_size = 0
+        self.fd = open(wav_file_name, "wb")
+        block_align = channels * self.bytes_per_sample
+        self.fd.write(RIFF_HEADER.pack(b"RIFF", 0, b"WAVE"))
+        self.fd.write(CHUNK_HEADER.pack(b"fmt ", FORMAT_CHUNK.size))
+        self.fd.write(FORMAT_CHUNK.pack(WAVE_FORMAT_PCM, channels, sample_rate,
+                sample_rate * block_align, block_align, bits_per_sample))
+        self.fd.write(CHUNK_HEADER.pack(b"data", 0))
+
+    def write(self, samples: numpy.ndarray) -> None:
+        # One row per frame, as from load_wav_file (but 24-bit samples are not supported)
+        assert self.bytes_per_sample != 3
+        data = numpy.ascontiguousarray(samples, dtype=self.dtype).tobytes()
+        self.fd.write(data)
+        self.data_size += len(data)
+
+    def close(self) -> None:
+        if self.data_size & 1:
+            self.fd.write(b"\0")
+        data_offset = RIFF_HEADER.size + CHUNK_HEADER.size + FORMAT_CHUNK.size + CHUNK_HEADER.size
+        self.fd.seek(0)
+        self.fd.write(RIFF_HEADER.pack(b"RIFF",
+                data_offset - 8 + self.data_size + (self.data_size & 1), b"WAVE"))
+        self.fd.seek(data_offset - CHUNK_HEADER.size)
+        self.fd.write(CHUNK_HEADER.pack(b"data", self.data_size))
+        self.fd.close()
+
+    def __enter__(self) -> "WavWriter":
+        return self
+
+    def __exit__(self, *_: typing.Any) -> None:
+        self.close()
@@ -0,0 +1,157 @@
+
+import argparse
+import sys
+import typing
+import numpy
+from sigtest import (MARKER_MASK, MARKER_VALUE, MASK_16, MASK_24, REPEAT_SIZE,
+                TRUE_MARKER_POSITION, get_pattern_block)
+from wav_file import get_24_bit_samples, load_wav_file
+
+
+# Frames checked at a time: memory use depends on this, not on the file size
+DEFAULT_WINDOW_SIZE = 1 << 20
+DEFAULT_MAX_ERRORS = 100
+
+class RecordingReport:
+    def __init__(self) -> None:
+        self.num_frames = 0
+        self.first_frame: typing.Optional[int] = None   # first marker
+        self.num_checked = 0
+        self.num_errors = 0
+        self.num_slips = 0
+        self.left_bit_errors = numpy.zeros(24, dtype=numpy.int64)
+        self.right_bit_errors = numpy.zeros(24, dtype=numpy.int64)
+
+class PatternChecker:
+    # Check a recording of the test pattern (from siggen) one window at a time.
+    # Each frame is compared with the pattern, aligned using the most recent
+    # marker, so that the check continues correctly after a slip (samples
+    # lost or repeated). Frames before the first marker are not checked.
+    # Frames are numbered from start_frame.
+    def __init__(self, sample_rate: int, mask: int,
+                max_errors: int = DEFAULT_MAX_ERRORS, start_frame: int = 0) -> None:
+        self.sample_rate = sample_rate
+        self.max_errors = max_errors
+        (self.left_block, self.right_block) = get_pattern_block(sample_rate)
+        self.left_block &= mask
+        self.right_block &= mask
+        self.report = RecordingReport()
+        self.report.num_frames = start_frame
+        self.last_marker: typing.Optional[int] = None
+
+    def check(self, left: numpy.ndarray, right: numpy.ndarray) -> typing.List[str]:
+        # Check the next window (24-bit samples): the result is the messages
+        # for errors and slips within it, in order
+        report = self.report
+        sample_rate = self.sample_rate
+        max_errors = self.max_errors
+        window_start = report.num_frames
+        left = left.astype(numpy.int64)
+        right = right.astype(numpy.int64)
+        frames = numpy.arange(window_start, window_start + len(left))
+        report.num_frames += len(left)
+
+        # Find the most recent marker for each frame
+        is_marker = (right & MARKER_MASK) == (MARKER_VALUE & MARKER_MASK)
+        markers = numpy.where(is_marker, frames, -1)
+        if (self.last_marker is not None) and (len(markers) != 0):
+            markers[0] = max(markers[0], self.last_marker)
+        markers = numpy.maximum.accumulate(markers)
+
+        # Messages for this window, sorted by frame number
+        messages: typing.List[typing.Tuple[int, str]] = []
+
+        # A marker which is not a whole number of blocks after the previous one is a slip
+        marker_frames = frames[is_marker]
+        previous = numpy.concatenate((
+                [self.last_marker if self.last_marker is not None else -1], marker_frames[:-1]))
+        slips = (previous >= 0) & (((marker_frames - previous) % REPEAT_SIZE) != 0)
+        for (frame, before) in zip(marker_frames[slips].tolist(), previous[slips].tolist()):
+            if (max_errors == 0) or (report.num_slips < max_errors):
+                moved = ((frame - before + (REPEAT_SIZE // 2)) % REPEAT_SIZE) - (REPEAT_SIZE // 2)
+                messages.append((frame, "slip at frame {} ({:1.6f} s): "
+                        "marker moved by {} frames".format(
+                        frame, frame / sample_rate, moved)))
+            report.num_slips += 1
+
+        if len(marker_frames) != 0:
+            if report.first_frame is None:
+                report.first_frame = int(marker_frames[0])
+            self.last_marker = int(marker_frames[-1])
+
+        # Compare with the pattern
+        checked = markers >= 0
+        position = (frames - markers + TRUE_MARKER_POSITION) % REPEAT_SIZE
+        left_xor = numpy.where(checked, left ^ self.left_block[position], 0)
+        right_xor = numpy.where(checked, right ^ self.right_block[position], 0)
+        report.num_checked += int(numpy.count_nonzero(checked))
+        for i in range(24):
+            report.left_bit_errors[i] += numpy.count_nonzero(left_xor & (1 << i))
+            report.right_bit_errors[i] += numpy.count_nonzero(right_xor & (1 << i))
+
+        errors = numpy.flatnonzero((left_xor | right_xor) != 0)
+        if max_errors != 0:
+            errors_shown = errors[:max(0, max_errors - report.num_errors)]
+        else:
+            errors_shown = errors
+        for index in errors_shown.tolist():
+            messages.append((int(frames[index]), "error at frame {} ({:1.6f} s): "
+                    "got {:06x} {:06x}  error bits {:06x} {:06x}".format(frames[index],
+                    frames[index] / sample_rate,
+                    left[index], right[index], left_xor[index], right_xor[index])))
+        report.num_errors += len(errors)
+
+        return [message for (_, message) in sorted(messages)]
+
+def verify_recording(wav_file_name: str, window_size: int = DEFAULT_WINDOW_SIZE,
+            max_errors: int = DEFAULT_MAX_ERRORS) -> RecordingReport:
+    # Check a WAV recording of the test pattern with a PatternChecker
+    (samples, wav_format) = load_wav_file(wav_file_name)
+    if wav_format.channels != 2:
+        raise ValueError("WAV file must have 2 channels")
+
+    print("{} frames at {} Hz, {} bits".format(wav_format.num_frames,
+            wav_format.sample_rate, wav_format.bits_per_sample))
+    checker = PatternChecker(wav_format.sample_rate,
+            MASK_16 if wav_format.bits_per_sample == 16 else MASK_24, max_errors)
+    for window_start in range(0, wav_format.num_frames, window_size):
+        window = get_24_bit_samples(samples[window_start:window_start + window_size])
+        for message in checker.check(window[:, 0], window[:, 1]):
+            print(message)
+
+    return checker.report
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Check a WAV recording of the test pattern for bit-exactness")
+    parser.add_argument("wav_file", metavar="input.wav")
+    parser.add_argument("--max-errors", type=int, default=DEFAULT_MAX_ERRORS,
+        help="number of errors and slips to show (default {}, 0 for no limit)".format(
+            DEFAULT_MAX_ERRORS))
+    parser.add_argument("--window-size", type=int, default=DEFAULT_WINDOW_SIZE,
+        help="frames to check at a time (default {})".format(DEFAULT_WINDOW_SIZE))
+    args = parser.parse_args()
+
+    report = verify_recording(args.wav_file, args.window_size, args.max_errors)
+    if report.first_frame is None:
+        print("Unable to find the {:06x} marker within the recording".format(MARKER_VALUE))
+        sys.exit(1)
+
+    print("First marker at frame {}: earlier frames are not checked".format(report.first_frame))
+    print("Checked {} frames: {} errors, {} slips".format(
+            report.num_checked, report.num_errors, report.num_slips))
+    for (name, bit_errors) in (("left", report.left_bit_errors),
+                                ("right", report.right_bit_errors)):
+        if numpy.any(bit_errors != 0):
+            print("Bit errors ({}), bit 23 to bit 0: {}".format(name,
+                    " ".join(str(count) for count in bit_errors[::-1])))
+
+    if (report.num_errors != 0) or (report.num_slips != 0):
+        print("Recording is not bit-exact")
+        sys.exit(1)
+
+    print("Recording is bit-exact")
+
+
+if __name__ == "__main__":
+    main()